@@ -1,5 +1,7 @@
 from typing import Union
 from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_right
+import ipaddress
 
 import regex
 import yaml
@@ -18,14 +20,120 @@ def load_blacklists():
     GlobalVars.blacklisted_usernames = Blacklist(Blacklist.USERNAMES).parse()
     GlobalVars.blacklisted_numbers_raw = Blacklist(Blacklist.NUMBERS).parse()
     GlobalVars.watched_numbers_raw = Blacklist(Blacklist.WATCHED_NUMBERS).parse()
-    GlobalVars.blacklisted_nses = Blacklist(Blacklist.NSES).parse()
-    GlobalVars.watched_nses = Blacklist(Blacklist.WATCHED_NSES).parse()
-    GlobalVars.blacklisted_cidrs = Blacklist(Blacklist.CIDRS).parse()
-    GlobalVars.watched_cidrs = Blacklist(Blacklist.WATCHED_CIDRS).parse()
+    GlobalVars.blacklisted_nses = NSIndex(Blacklist(Blacklist.NSES).parse())
+    GlobalVars.watched_nses = NSIndex(Blacklist(Blacklist.WATCHED_NSES).parse())
+    GlobalVars.blacklisted_cidrs = IPIndex(Blacklist(Blacklist.CIDRS).parse())
+    GlobalVars.watched_cidrs = IPIndex(Blacklist(Blacklist.WATCHED_CIDRS).parse())
     # GlobalVars.blacklisted_asns = Blacklist(Blacklist.ASNS).parse()
     GlobalVars.watched_asns = Blacklist(Blacklist.WATCHED_ASNS).parse()
 
 
+class IPIndex:
+    """
+    An index of IP addresses and CIDR ranges (e.g. '1.2.3.4' and '1.2.3.0/24') for finding the entry which
+    contains an address. Each entry is kept as the integer range of addresses it covers, sorted by start. CIDR
+    ranges are either nested or don't overlap, so each range has a parent, which is the smallest range
+    containing it. A lookup bisects to the last range starting at or before the address, then walks up
+    through the parents, so it takes at most one step per bit of prefix length.
+    """
+    def __init__(self, entries=()):
+        self._entries = list(entries)
+        ranges = {4: {}, 6: {}}
+        for entry in self._entries:
+            network = ipaddress.ip_network(entry, strict=False)
+            key = (int(network.network_address), -int(network.broadcast_address))
+            ranges[network.version].setdefault(key, entry)
+        # Key: IP version; Value: (starts, ends, parents, entries)
+        self._ranges = {version: self._build(version_ranges) for version, version_ranges in ranges.items()}
+
+    @staticmethod
+    def _build(version_ranges):
+        starts, ends, parents, entries = [], [], [], []
+        enclosing = []
+        for (start, negative_end), entry in sorted(version_ranges.items()):
+            while enclosing and ends[enclosing[-1]] < start:
+                enclosing.pop()
+            parents.append(enclosing[-1] if enclosing else -1)
+            enclosing.append(len(starts))
+            starts.append(start)
+            ends.append(-negative_end)
+            entries.append(entry)
+        return starts, ends, parents, entries
+
+    def get_entry(self, address):
+        """
+        Get the most specific entry which contains address, or None, if there isn't one or address isn't
+        a valid IP address.
+        """
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return None
+        starts, ends, parents, entries = self._ranges[address.version]
+        address = int(address)
+        index = bisect_right(starts, address) - 1
+        while index >= 0 and ends[index] < address:
+            index = parents[index]
+        return entries[index] if index >= 0 else None
+
+    def __contains__(self, address):
+        return self.get_entry(address) is not None
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class NSIndex:
+    """
+    An index of name server list entries. A domain matches a string entry (e.g. 'example.com.') when any of its
+    name servers is a subdomain of the entry, and matches a list entry when its name servers are exactly those in
+    the list. String entries are kept in a trie of their labels, last label first, and list entries in a set of
+    frozensets, so a lookup takes one step per label of each name server, rather than one per entry.
+    """
+    def __init__(self, entries=()):
+        self._entries = list(entries)
+        self._suffix_trie = {}
+        self._name_server_sets = set()
+        for entry in self._entries:
+            if isinstance(entry, list):
+                self._name_server_sets.add(frozenset(name_server.lower() for name_server in entry))
+                continue
+            node = self._suffix_trie
+            for label in reversed(entry.lower().split('.')):
+                node = node.setdefault(label, {})
+            # None marks the end of an entry. It can't be a label.
+            node[None] = entry
+
+    def _get_suffix_entry(self, name_server):
+        node = self._suffix_trie
+        labels = name_server.split('.')
+        # The name server must be a proper subdomain of the entry, so its first label is never compared.
+        for label in reversed(labels[1:]):
+            node = node.get(label, None)
+            if node is None:
+                return None
+            if None in node:
+                return node[None]
+        return None
+
+    def matches(self, name_servers):
+        """
+        Check if a domain with the given (lower case) name servers matches any entry.
+        """
+        if frozenset(name_servers) in self._name_server_sets:
+            return True
+        return any(self._get_suffix_entry(name_server) is not None for name_server in name_servers)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class BlacklistParser:
     def __init__(self, filename: str):
         self._filename = filename
@@ -163,7 +271,7 @@ class TSVDictParser(BlacklistParser):
 
 class YAMLParserCIDR(BlacklistParser):
     """
-    YAML parser for IP blacklist (name suggests we should move to proper CIDR eventually).
+    YAML parser for IP blacklists. Items have either an "ip" or a "cidr" range, with "base" and "mask" members.
 
     Base class for parsers for YAML files with simple schema validation.
     """
@@ -189,8 +297,16 @@ class YAMLParserCIDR(BlacklistParser):
                 continue
             yield item
 
+    def _get_entry(self, item):
+        """
+        Get the list entry for an item: its primary key or, for CIDR ranges, "base/mask"
+        """
+        if self.SCHEMA_PRIKEY not in item and 'cidr' in item:
+            return '{0}/{1}'.format(item['cidr']['base'], item['cidr']['mask'])
+        return item[self.SCHEMA_PRIKEY]
+
     def parse(self):
-        return [item[self.SCHEMA_PRIKEY] for item in self._parse()]
+        return [self._get_entry(item) for item in self._parse()]
 
     def _write(self, callback):
         d = {
@@ -198,7 +314,7 @@ class YAMLParserCIDR(BlacklistParser):
             'Schema_version': self.SCHEMA_VERSION,
             'items': sorted(
                 self._parse(keep_disabled=True),
-                key=lambda x: x[self.SCHEMA_PRIKEY])
+                key=self._get_entry)
         }
         callback(d)
         with open(self._filename, 'w', encoding='utf-8') as f:
@@ -217,12 +333,11 @@ class YAMLParserCIDR(BlacklistParser):
             if not ip_regex.match(item['ip']):
                 raise ValueError('Field "ip" is not a valid IP address: {0}'.format(
                     item['ip']))
-            '''
             if 'cidr' in item:
                 raise ValueError(
                     'Cannot have both "ip" and "cidr" members: {0!r}'.format(item))
         elif 'cidr' in item:
-            if not 'base' in item['cidr'] or not 'mask' in item['cidr']:
+            if 'base' not in item['cidr'] or 'mask' not in item['cidr']:
                 raise ValueError('Field "cidr" must have members "base" and "mask"')
             if not ip_regex.match(item['cidr']['base']):
                 raise ValueError('Field "base" is not a valid IP address: {0}'.format(
@@ -231,9 +346,8 @@ class YAMLParserCIDR(BlacklistParser):
             if mask < 0 or mask > 32:
                 raise ValueError('Field "mask" must be between 0 and 32: {0}'.format(
                     item['cidr']['mask']))
-            '''
         else:
-            raise ValueError('Item needs to have an "ip" member field: {0!r}'.format(item))
+            raise ValueError('Item needs to have an "ip" or a "cidr" member field: {0!r}'.format(item))
 
     def validate(self):
         for item in self._parse():
@@ -241,28 +355,25 @@ class YAMLParserCIDR(BlacklistParser):
 
     def add(self, item):
         self._validate(item)
-        prikey = self.SCHEMA_PRIKEY
 
         def add_callback(d):
-            item_normalized = self._normalize(item[prikey])
+            item_normalized = self._normalize(self._get_entry(item))
             for compare in d['items']:
-                if self._normalize(compare[prikey]) == item_normalized:
+                if self._normalize(self._get_entry(compare)) == item_normalized:
                     raise KeyError('{0} already in list {1}'.format(
-                        compare[prikey], d['items']))
+                        self._get_entry(compare), d['items']))
             d['items'].append(item)
 
         self._write(add_callback)
 
     def remove(self, item):
-        prikey = self.SCHEMA_PRIKEY
-
         def remove_callback(d):
             for i, compare in enumerate(d['items']):
-                if compare[prikey] == item[prikey]:
+                if self._get_entry(compare) == self._get_entry(item):
                     break
             else:
                 raise ValueError('No {0} found in list {1}'.format(
-                    item[prikey], d['items']))
+                    self._get_entry(item), d['items']))
             del d['items'][i]
 
         self._write(remove_callback)
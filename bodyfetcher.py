@@ -5,18 +5,18 @@ import threading
 import copy
 from itertools import chain
 from operator import itemgetter
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import requests
 import psutil
 
 from globalvars import GlobalVars
-from spamhandling import handle_spam, check_if_spam
+from spamhandling import handle_spam_unless_community_bumped, check_if_spam
 from datahandling import (add_or_update_api_data, clear_api_data, schedule_store_bodyfetcher_queue,
                           schedule_store_bodyfetcher_max_ids, add_queue_timing_data)
 from chatcommunicate import tell_rooms_with
 from classes import Post, PostParseError
-from helpers import (log, log_current_thread, append_to_current_thread_name,
+from helpers import (log, log_current_thread, log_current_exception, append_to_current_thread_name,
                      convert_new_scan_to_spam_result_if_new_reasons, add_to_global_bodyfetcher_queue_in_new_thread,
                      get_se_api_default_params_questions_answers_posts_add_site, get_se_api_url_for_route)
 import recently_scanned_posts as rsp
@@ -27,6 +27,12 @@ from tasks import Tasks
 class BodyFetcher:
     queue_lock = threading.Lock()
     queue = {}
+    # The sites in the queue which have enough posts queued to be processed, in the order in which they became
+    # ready. Sites which are in special_cases or are time_sensitive are processed before other sites.
+    # These are only changed under the queue_lock. Keys are sites; values are when the earliest post still in the
+    # site's queue was queued (UTC datetime), or None, if that's not known.
+    ready_special_sites = {}
+    ready_sites = {}
 
     max_ids_lock = threading.Lock()
     previous_max_ids = {}
@@ -128,6 +134,22 @@ class BodyFetcher:
     api_data_lock = threading.Lock()
 
     check_queue_lock = threading.Lock()
+    # The CPU use is sampled in a background thread, so that dispatching doesn't wait for a sample.
+    CPU_USE_SAMPLE_INTERVAL = 1
+    cpu_use = 0.0
+    cpu_use_sampler_thread = None
+    cpu_use_sampler_thread_lock = threading.Lock()
+    # Whether it was the time of day when the time_sensitive sites are special, when the site readiness was last
+    # checked. This is under the check_queue_lock.
+    time_sensitive_window = None
+    # Waiting before dispatching provides time for multiple potential WebSocket events to queue the same post,
+    # along with some time for the SE API to update and have information on the new post. A ready site isn't
+    # dispatched until its earliest queued post has been queued for this long. Nothing sleeps for this: when the
+    # only ready sites are too recent, a dispatch is scheduled for when the first of them can go.
+    QUEUE_COALESCE_TIME = 1
+    QUEUE_COALESCE_TIMEDELTA = timedelta(seconds=QUEUE_COALESCE_TIME)
+    # The Tasks handle for the scheduled dispatch, which is under the check_queue_lock.
+    coalesced_dispatch_handle = None
     # CPU starvation updates are under the check_queue_lock
     cpu_starvation_last_thread_not_launched_timestamp = None
     cpu_starvation_posted_in_chat_timestamp = None
@@ -135,17 +157,9 @@ class BodyFetcher:
     thread_starvation_delayed_warnings_lock = threading.RLock()
     thread_starvation_delayed_warnings = None
 
-    def add_to_queue(self, hostname, question_id, should_check_site=False, source=None):
-        # For the Sandbox questions on MSE, we choose to ignore the entire question and all answers.
-        ignored_mse_questions = [
-            3122,    # Formatting Sandbox
-            51812,   # The API sandbox
-            296077,  # Sandbox archive
-        ]
-        if question_id in ignored_mse_questions and hostname == "meta.stackexchange.com":
-            return  # don't check meta sandbox, it's full of weird posts
-
-        thread_stats = {
+    @staticmethod
+    def get_new_thread_stats(source):
+        return {
             'thread_count': 1,
             'source_EditWatcher': 1 if 'EditWatcher' in source else 0,
             'source_155-questions-active': 1 if '155-questions-active' in source else 0,
@@ -158,6 +172,18 @@ class BodyFetcher:
             'api_calls': 0,
         }
 
+    def add_to_queue(self, hostname, question_id, should_check_site=False, source=None):
+        # For the Sandbox questions on MSE, we choose to ignore the entire question and all answers.
+        ignored_mse_questions = [
+            3122,    # Formatting Sandbox
+            51812,   # The API sandbox
+            296077,  # Sandbox archive
+        ]
+        if question_id in ignored_mse_questions and hostname == "meta.stackexchange.com":
+            return  # don't check meta sandbox, it's full of weird posts
+
+        thread_stats = self.get_new_thread_stats(source)
+
         try:
             with self.queue_lock:
                 if hostname not in self.queue:
@@ -183,6 +209,7 @@ class BodyFetcher:
                 # This line only works if we are using a dict in the self.queue[hostname] object, which we
                 # should be with the previous conversion code.
                 self.queue[hostname][str(question_id)] = datetime.utcnow()
+                self.update_site_readiness(hostname)
                 flovis_dict = None
                 if GlobalVars.flovis is not None:
                     flovis_dict = {sk: list(sq.keys()) for sk, sq in self.queue.items()}
@@ -190,56 +217,87 @@ class BodyFetcher:
             if flovis_dict is not None:
                 GlobalVars.flovis.stage('bodyfetcher/enqueued', hostname, question_id, flovis_dict)
 
-            have_scan_thread_count_lock = False
-            try:
-                have_scan_thread_count_lock = self.scan_thread_count_semaphore.acquire(blocking=False)
-                if not have_scan_thread_count_lock:
-                    # There are already too many scan threads.
-                    if not self.send_thread_starvation_warning_if_appropriate():
-                        log_current_thread('info', "Already at maximum scan threads"
-                                                   + " ({}).".format(self.max_scan_thread_count)
-                                                   + " Not starting an additional scan thread.")
-                    thread_stats['thread_limit'] += 1
-                    return
-                if should_check_site:
-                    # The call to add_to_queue indicated that the site should be immediately processed.
-                    if self.acquire_site_processing_lock(hostname, thread_stats):
-                        try:
-                            with self.queue_lock:
-                                new_posts = self.queue.pop(hostname, None)
-                            if new_posts:
-                                schedule_store_bodyfetcher_queue()
-                                self.make_api_call_for_site_and_restore_thread_name(hostname, new_posts, thread_stats)
-                        except Exception:
-                            raise
-                        finally:
-                            # We're done processing the site, so release the processing lock.
-                            self.release_site_processing_lock(hostname)
+            self.dispatch_queue(thread_stats, hostname if should_check_site else None)
+        except Exception:
+            thread_stats['all_errors'] += 1
+            raise
+        finally:
+            GlobalVars.PostScanStat.add(thread_stats)
 
-                site_and_posts = True
-                while site_and_posts:
+    def dispatch_queue(self, thread_stats, immediate_site=None):
+        """
+        Process the ready sites in the queue, if there's a free scan thread. immediate_site is processed first,
+        whether or not it's ready.
+        """
+        have_scan_thread_count_lock = False
+        try:
+            have_scan_thread_count_lock = self.scan_thread_count_semaphore.acquire(blocking=False)
+            if not have_scan_thread_count_lock:
+                # There are already too many scan threads.
+                if not self.send_thread_starvation_warning_if_appropriate():
+                    log_current_thread('info', "Already at maximum scan threads"
+                                               + " ({}).".format(self.max_scan_thread_count)
+                                               + " Not starting an additional scan thread.")
+                thread_stats['thread_limit'] += 1
+                return
+            if immediate_site is not None:
+                # The call to add_to_queue indicated that the site should be immediately processed.
+                if self.acquire_site_processing_lock(immediate_site, thread_stats):
                     try:
-                        site_and_posts = self.get_first_queue_item_to_process(thread_stats)
-                        if site_and_posts:
+                        with self.queue_lock:
+                            new_posts = self.queue.pop(immediate_site, None)
+                            self.update_site_readiness(immediate_site)
+                        if new_posts:
                             schedule_store_bodyfetcher_queue()
-                            self.make_api_call_for_site_and_restore_thread_name(*site_and_posts, thread_stats)
+                            self.make_api_call_for_site_and_restore_thread_name(immediate_site, new_posts,
+                                                                                thread_stats)
                     except Exception:
                         raise
                     finally:
                         # We're done processing the site, so release the processing lock.
-                        if site_and_posts and site_and_posts is not True:
-                            self.release_site_processing_lock(site_and_posts[0])
-            except Exception:
-                raise
-            finally:
-                if have_scan_thread_count_lock:
-                    self.scan_thread_count_semaphore.release()
+                        self.release_site_processing_lock(immediate_site)
+
+            site_and_posts = True
+            while site_and_posts:
+                try:
+                    site_and_posts = self.get_first_queue_item_to_process(thread_stats)
+                    if site_and_posts:
+                        schedule_store_bodyfetcher_queue()
+                        self.make_api_call_for_site_and_restore_thread_name(*site_and_posts, thread_stats)
+                except Exception:
+                    raise
+                finally:
+                    # We're done processing the site, so release the processing lock.
+                    if site_and_posts and site_and_posts is not True:
+                        self.release_site_processing_lock(site_and_posts[0])
         except Exception:
-            thread_stats['all_errors'] += 1
             raise
+        finally:
+            if have_scan_thread_count_lock:
+                self.scan_thread_count_semaphore.release()
+
+    def start_coalesced_dispatch(self):
+        # This runs in Tasks, so the dispatch gets its own thread.
+        threading.Thread(name="bodyfetcher coalesced dispatch", target=self.coalesced_dispatch).start()
+
+    def coalesced_dispatch(self):
+        with self.check_queue_lock:
+            BodyFetcher.coalesced_dispatch_handle = None
+        thread_stats = self.get_new_thread_stats('BodyFetcher coalesced dispatch')
+        try:
+            self.dispatch_queue(thread_stats)
+        except Exception:
+            thread_stats['all_errors'] += 1
+            log_current_exception()
         finally:
             GlobalVars.PostScanStat.add(thread_stats)
 
+    def schedule_coalesced_dispatch(self, delay):
+        # The caller must hold the check_queue_lock. An already scheduled dispatch is for a site which became
+        # ready earlier, so it's at least as soon as this one needs to be.
+        if BodyFetcher.coalesced_dispatch_handle is None:
+            BodyFetcher.coalesced_dispatch_handle = Tasks.later(self.start_coalesced_dispatch, after=delay)
+
     def make_api_call_for_site_and_restore_thread_name(self, site, new_posts, thread_stats):
         self.thread_starvation_warning_thread_launched()
         current_thread = threading.current_thread()
@@ -356,19 +414,68 @@ class BodyFetcher:
         # The thread lock for this is the check_queue_lock
         self.cpu_starvation_last_thread_not_launched_timestamp = None
 
+    @staticmethod
+    def is_time_sensitive_window():
+        return datetime.utcnow().hour in range(4, 12)
+
+    def get_site_queue_threshold(self, site):
+        """
+        Get (whether the site is a special site, the number of posts which need to be queued for the site)
+        """
+        if site in self.time_sensitive and self.is_time_sensitive_window():
+            return True, 1
+        if site in self.special_cases:
+            return True, self.special_cases[site]
+        return False, self.threshold
+
+    def update_site_readiness(self, site):
+        # The caller must hold the queue_lock.
+        # A site which is already ready keeps its place in the order.
+        is_special, site_threshold = self.get_site_queue_threshold(site)
+        ready, not_ready = (self.ready_special_sites, self.ready_sites) if is_special \
+            else (self.ready_sites, self.ready_special_sites)
+        not_ready.pop(site, None)
+        site_queue = self.queue.get(site, {})
+        if len(site_queue) < site_threshold:
+            ready.pop(site, None)
+        elif site not in ready:
+            ready[site] = min((queued_time for queued_time in site_queue.values() if queued_time is not None),
+                              default=None)
+
+    def rebuild_site_readiness(self):
+        with self.queue_lock:
+            self.ready_special_sites = {}
+            self.ready_sites = {}
+            for site in self.queue:
+                self.update_site_readiness(site)
+
+    @classmethod
+    def sample_cpu_use(cls):
+        while True:
+            try:
+                cls.cpu_use = psutil.cpu_percent(interval=cls.CPU_USE_SAMPLE_INTERVAL)
+            except Exception:
+                # Keep sampling, rather than leaving cpu_use frozen.
+                log_current_exception()
+                time.sleep(cls.CPU_USE_SAMPLE_INTERVAL)
+
+    def get_cpu_use(self):
+        with self.cpu_use_sampler_thread_lock:
+            if BodyFetcher.cpu_use_sampler_thread is None:
+                BodyFetcher.cpu_use_sampler_thread = threading.Thread(name="BodyFetcher CPU use sampler",
+                                                                      target=BodyFetcher.sample_cpu_use, daemon=True)
+                BodyFetcher.cpu_use_sampler_thread.start()
+        return BodyFetcher.cpu_use
+
     def get_first_queue_item_to_process(self, thread_stats):
-        # We use a copy of the queue keys (sites) and lengths in order to allow
-        # the queue to be changed in other threads.
-        # Overall this results in a FIFO for sites which have reached their threshold, because
-        # dicts are guaranteed to be iterated in insertion order in Python >= 3.6.
-        # We use self.check_queue_lock here to fully dispatch one queued site at a time and allow
-        # consolidation of multiple WebSocket events for the same real-world event.
+        # Overall this results in a FIFO for sites which have reached their threshold. Sites which are in
+        # special_cases or time_sensitive are taken first. Which sites have reached their threshold is kept
+        # up to date as posts are added to and removed from the queue, so this only looks at those sites.
+        # We use self.check_queue_lock here to fully dispatch one queued site at a time.
         with self.check_queue_lock:
             site_to_handle = None
             try:
-                # Getting the CPU activity also provides time for multiple potential WebSocket events to queue
-                # the same post along with some time for the SE API to update and have information on the new post.
-                cpu_use = psutil.cpu_percent(interval=1)
+                cpu_use = self.get_cpu_use()
                 if cpu_use > self.LAUNCH_PROCESSING_THREAD_MAXIMUM_CPU_USE_THRESHOLD:
                     # We are already maxing out the CPU.
                     # Having additional threads processing posts is counterproductive.
@@ -378,51 +485,40 @@ class BodyFetcher:
                     thread_stats['high_CPU'] += 1
                     return None
                 self.cpu_starvation_warning_thread_launched()
-                special_sites = []
-                is_time_sensitive_time = datetime.utcnow().hour in range(4, 12)
+                is_time_sensitive_window = self.is_time_sensitive_window()
+                if is_time_sensitive_window != self.time_sensitive_window:
+                    # The readiness of the time_sensitive sites is only updated when their queue changes, so
+                    # move them to the right ready dict when the time of day crosses into or out of the window.
+                    self.time_sensitive_window = is_time_sensitive_window
+                    self.rebuild_site_readiness()
                 with self.queue_lock:
-                    sites_in_queue = {site: len(values) for site, values in self.queue.items()}
-                # Get sites listed in special cases and as time_sensitive
-                for site, length in sites_in_queue.items():
-                    if site in self.special_cases:
-                        special_sites.append(site)
-                        if length >= self.special_cases[site]:
-                            if self.acquire_site_processing_lock(site, thread_stats):
-                                site_to_handle = site
-                                break
-                    if is_time_sensitive_time and site in self.time_sensitive:
-                        special_sites.append(site)
-                        if length >= 1:
-                            if self.acquire_site_processing_lock(site, thread_stats):
-                                site_to_handle = site
-                                break
-                else:
-                    # We didn't find a special site which met the applicable threshold.
-                    # Remove the sites which we've already considered from our copy of the queue's keys.
-                    for site in special_sites:
-                        sites_in_queue.pop(site, None)
-
-                    # If we don't have any special sites with their queue filled, take the first
-                    # one without a special case
-                    for site, length in sites_in_queue.items():
-                        if length >= self.threshold:
-                            if self.acquire_site_processing_lock(site, thread_stats):
-                                site_to_handle = site
-                                break
-
-                if site_to_handle is not None:
+                    ready_sites = list(chain(self.ready_special_sites.items(), self.ready_sites.items()))
+                now = datetime.utcnow()
+                first_coalesced_time = None
+                for site, queued_time in ready_sites:
+                    if queued_time is not None and queued_time > now - self.QUEUE_COALESCE_TIMEDELTA:
+                        # See QUEUE_COALESCE_TIME
+                        if first_coalesced_time is None or queued_time < first_coalesced_time:
+                            first_coalesced_time = queued_time
+                        continue
+                    if not self.acquire_site_processing_lock(site, thread_stats):
+                        continue
+                    site_to_handle = site
                     # We already have a site processing lock, so if we have new_posts, then we're good to go.
                     with self.queue_lock:
                         new_posts = self.queue.pop(site_to_handle, None)
+                        self.update_site_readiness(site_to_handle)
                     if new_posts:
                         # We've identified a site and have a list of new posts to fetch.
                         return (site, new_posts)
-                    else:
-                        # We don't actually have any posts to process, so need to give up the site processing lock
-                        # we already obtained.
-                        self.release_site_processing_lock(site_to_handle)
-                        site_to_handle = None
-                # There's no site in the queue which has met the applicable threshold.
+                    # We don't actually have any posts to process, so need to give up the site processing lock
+                    # we already obtained.
+                    self.release_site_processing_lock(site_to_handle)
+                    site_to_handle = None
+                # There's no site in the queue which has met the applicable threshold and waited long enough.
+                if first_coalesced_time is not None:
+                    delay = (first_coalesced_time + self.QUEUE_COALESCE_TIMEDELTA - now).total_seconds()
+                    self.schedule_coalesced_dispatch(delay)
                 return None
             # We don't have a finally here, as we're only releasing upon an exception.
             except Exception:
@@ -581,6 +677,7 @@ class BodyFetcher:
                         self.queue[site].update(new_posts)
                     else:
                         self.queue[site] = new_posts
+                    self.update_site_readiness(site)
                 return
 
             with self.api_data_lock:
@@ -893,7 +990,7 @@ class BodyFetcher:
                 if not question_doesnt_need_scan:
                     end_post_stat_time_and_start_new('scan_question', ' scan', no_low_output=False)
                     is_spam, reason, why = convert_new_scan_to_spam_result_if_new_reasons(
-                        check_if_spam(post_),
+                        check_if_spam(post_, defer_community_bump_check=True),
                         compare_info,
                         match_ignore=self.IGNORED_IGNORED_SPAM_CHECKS_IF_WORSE_SPAM
                     )
@@ -905,9 +1002,9 @@ class BodyFetcher:
                             if do_flovis:
                                 GlobalVars.flovis.stage('bodyfetcher/api_response/spam', site, question_id,
                                                         {'post': pnb, 'check_if_spam': [is_spam, reason, why]})
-                            handle_spam(post=post_,
-                                        reasons=reason,
-                                        why=why)
+                            handle_spam_unless_community_bumped(post=post_,
+                                                                reasons=reason,
+                                                                why=why)
                         except Exception as e:
                             log('error', "Exception in handle_spam:", e)
                     elif do_flovis:
@@ -963,7 +1060,7 @@ class BodyFetcher:
 
                             end_post_stat_time_and_start_new('scan_answer', ' scan', no_low_output=False)
                             is_spam, reason, why = convert_new_scan_to_spam_result_if_new_reasons(
-                                check_if_spam(answer_),
+                                check_if_spam(answer_, defer_community_bump_check=True),
                                 compare_info,
                                 match_ignore=self.IGNORED_IGNORED_SPAM_CHECKS_IF_WORSE_SPAM
                             )
@@ -976,9 +1073,9 @@ class BodyFetcher:
                                     if do_flovis:
                                         GlobalVars.flovis.stage('bodyfetcher/api_response/spam', site, answer_id,
                                                                 {'post': anb, 'check_if_spam': [is_spam, reason, why]})
-                                    handle_spam(answer_,
-                                                reasons=reason,
-                                                why=why)
+                                    handle_spam_unless_community_bumped(answer_,
+                                                                        reasons=reason,
+                                                                        why=why)
                                 except Exception as e:
                                     log('error', "Exception in handle_spam:", e)
                             elif do_flovis:
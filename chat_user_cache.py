@@ -0,0 +1,95 @@
+# coding=utf-8
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ChatUserCache:
+    """
+    A process wide cache of chat user names, keyed by (chat host, user ID), and of the current users in each room,
+    keyed by (chat host, room ID), so pinging the users who want notifications doesn't make HTTPS requests to chat
+    for every report.
+
+    Once an entry is older than its refresh time, the cached value is still returned, but it's fetched again in the
+    background. Entries which are older than their TTL are fetched while the caller waits. Failed fetches are cached
+    for ERROR_TTL seconds and raise the exception which the fetch raised.
+    """
+    NAME_REFRESH_AFTER = 60 * 60
+    NAME_TTL = 24 * 60 * 60
+    CURRENT_USERS_REFRESH_AFTER = 30
+    CURRENT_USERS_TTL = 5 * 60
+    ERROR_TTL = 5 * 60
+    MAXIMUM_ENTRIES = 20000
+    _refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='ChatUserCache refresh')
+    # Key: ('name', host, user_id) or ('current users', host, room_id); Value: (fetch timestamp, value, exception)
+    _cache = {}
+    # Keys which are being refreshed in the background
+    _refreshing = set()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _fetch(key, fetch, is_refresh=False):
+        value, exception = None, None
+        try:
+            value = fetch()
+        except Exception as exc:
+            exception = exc
+        with ChatUserCache._lock:
+            ChatUserCache._refreshing.discard(key)
+            if is_refresh and exception is not None:
+                # Keep using the value we have, until it reaches its TTL.
+                return value, exception
+            cache = ChatUserCache._cache
+            cache.pop(key, None)
+            cache[key] = (time.time(), value, exception)
+            if len(cache) > ChatUserCache.MAXIMUM_ENTRIES:
+                # dicts are in insertion order, so these are the oldest entries
+                for old_key in list(cache.keys())[:len(cache) - ChatUserCache.MAXIMUM_ENTRIES]:
+                    del cache[old_key]
+        return value, exception
+
+    @staticmethod
+    def _get(key, fetch, refresh_after, ttl):
+        now = time.time()
+        with ChatUserCache._lock:
+            entry = ChatUserCache._cache.get(key, None)
+            needs_refresh = False
+            if entry is not None:
+                fetch_time, _, exception = entry
+                entry_ttl = ChatUserCache.ERROR_TTL if exception is not None else ttl
+                if fetch_time + entry_ttl <= now:
+                    entry = None
+                elif exception is None and fetch_time + refresh_after <= now and key not in ChatUserCache._refreshing:
+                    ChatUserCache._refreshing.add(key)
+                    needs_refresh = True
+        if needs_refresh:
+            ChatUserCache._refresh_executor.submit(ChatUserCache._fetch, key, fetch, is_refresh=True)
+        if entry is not None:
+            _, value, exception = entry
+        else:
+            value, exception = ChatUserCache._fetch(key, fetch)
+        if exception is not None:
+            raise exception.with_traceback(None)
+        return value
+
+    @staticmethod
+    def get_user_name(client, user_id):
+        """
+        Get the name of the chat user, which is client.get_user(user_id).name.
+        """
+        return ChatUserCache._get(('name', client.host, user_id), lambda: client.get_user(user_id).name,
+                                  ChatUserCache.NAME_REFRESH_AFTER, ChatUserCache.NAME_TTL)
+
+    @staticmethod
+    def get_current_users_in_room(client, room_id):
+        """
+        Get the list of (user ID, user name) tuples for the users currently in the chat room.
+        """
+        return ChatUserCache._get(('current users', client.host, room_id),
+                                  lambda: client._br.get_current_users_in_room(room_id),
+                                  ChatUserCache.CURRENT_USERS_REFRESH_AFTER, ChatUserCache.CURRENT_USERS_TTL)
+
+    @staticmethod
+    def clear():
+        with ChatUserCache._lock:
+            ChatUserCache._cache.clear()
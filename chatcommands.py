@@ -40,6 +40,7 @@ from tasks import Tasks
 import dns.resolver
 from dns.exception import DNSException
 import number_homoglyphs
+from dns_cache import DNSCache
 import phone_numbers
 
 
@@ -1016,6 +1017,8 @@ def stat(operation, from_stats=None, to_stats=None, alias_used="stats"):
         'high_CPU': 0,
         'thread_limit': 0,
         'site_limited': '',
+        'dns_cache': '',
+        'domain_parse_cache': '',
     }
     known_operations = [
         'clear',
@@ -1115,6 +1118,18 @@ def stat(operation, from_stats=None, to_stats=None, alias_used="stats"):
                                                          stats.pop('source_EditWatcher', 0),
                                                          stats.pop('source_BF_re-reqest', 0))
         stats['site_limited'] = '{}, SO({}), nonSO({})'.format(limited_threads, *threads_limited_so_non_so)
+        # The DNS and domain parse caches count for the whole process, rather than for each stats set.
+        dns_cache_stats = DNSCache.get_stats()
+        dns_cache_misses = dns_cache_stats['misses']
+        stats['dns_cache'] = 'hits({}), misses({}), avg lookup({} s) since start'.format(
+            dns_cache_stats['hits'], dns_cache_misses,
+            round(dns_cache_stats['lookup_time'] / dns_cache_misses, 3) if dns_cache_misses else 0)
+        domain_parse_cache_stats = findspam.DomainParseCache.get_stats()
+        domain_parse_cache_hits = domain_parse_cache_stats['hits']
+        domain_parse_cache_lookups = domain_parse_cache_hits + domain_parse_cache_stats['misses']
+        stats['domain_parse_cache'] = 'lookups({}), hit rate({}%) since start'.format(
+            domain_parse_cache_lookups,
+            round(100 * domain_parse_cache_hits / domain_parse_cache_lookups, 1) if domain_parse_cache_lookups else 0)
         # Round all the floats to 2 digits after the decimal point
         for key, value in stats.items():
             if type(value) is float:
@@ -1649,8 +1664,8 @@ def bisect_regex_in_n_size_chunks(size, test_text, regexes, bookend=True, timeou
     return {'matches': matches, 'timeouts': timeouts}
 
 
-def bisect_number_list(s, full_number_list, filename):
-    candidates, normalized_candidates, deobfuscated_candidates = phone_numbers.get_all_candidates(s)
+def bisect_number_list(all_candidates, full_number_list, filename):
+    candidates, normalized_candidates, deobfuscated_candidates = all_candidates
 
     def type_sort(text):
         if text == 'verbatim':
@@ -1679,8 +1694,10 @@ def bisect_number_list(s, full_number_list, filename):
 
 def get_watch_and_blacklist_number_bisects(s):
     number_matching = []
-    number_matching.extend(bisect_number_list(s, GlobalVars.blacklisted_numbers_full, 'blacklisted_numbers.txt'))
-    number_matching.extend(bisect_number_list(s, GlobalVars.watched_numbers_full, 'watched_numbers.txt'))
+    all_candidates = findspam.get_number_candidates(s)
+    number_matching.extend(bisect_number_list(all_candidates, GlobalVars.blacklisted_numbers_full,
+                                              'blacklisted_numbers.txt'))
+    number_matching.extend(bisect_number_list(all_candidates, GlobalVars.watched_numbers_full, 'watched_numbers.txt'))
     number_matching = [(raw_pattern, line_and_filename, ' matched ' + match_types, full_match_list)
                        for (raw_pattern, line_and_filename, match_types, full_match_list) in number_matching]
     return number_matching
@@ -1871,12 +1888,8 @@ def notify(msg, room_id, se_site, always_ping):
 # temp command
 @command(privileged=True)
 def migrate_notifications():
-    for i, notification in enumerate(GlobalVars.notifications):
-        if len(notification) == 4:
-            GlobalVars.notifications[i] = notification + (True,)
-
-    with open("notifications.p", "wb") as f:
-        pickle.dump(GlobalVars.notifications, f, protocol=pickle.HIGHEST_PROTOCOL)
+    # Notifications without always_ping are given always_ping=True when they're loaded.
+    datahandling.store_journaled_pickle("notifications.p")
 
     return "shoutouts to simpleflips"
 
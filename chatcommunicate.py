@@ -4,6 +4,7 @@ from chatexchange.browser import LoginError
 from chatexchange.messages import Message
 from chatexchange_extension import Client
 import collections
+import heapq
 import itertools
 import os
 import os.path
@@ -20,7 +21,7 @@ import copy
 import datahandling
 import metasmoke
 import classes.feedback
-from helpers import log, redact_passwords, log_current_exception
+from helpers import log, redact_passwords, log_current_exception, TokenBucket
 from globalvars import GlobalVars
 from parsing import fetch_post_id_and_site_from_url, fetch_post_url_from_msg_content, fetch_owner_url_from_msg_content
 from tasks import Tasks
@@ -77,6 +78,10 @@ _last_messages_lock = threading.RLock()
 # queue.Queue() is already thread safe, so doesn't need manual locks.
 _msg_queue = queue.Queue()
 
+# Key: _client.host; Value: HostSender
+_host_senders = {}
+_host_senders_lock = threading.RLock()
+
 _pickle_run = threading.Event()
 
 
@@ -266,53 +271,144 @@ def pickle_last_messages():
         datahandling.dump_pickle("messageData.p", last_messages_copy)
 
 
-def send_messages():
-    while True:
-        room, msg, report_data = _msg_queue.get()
-        if len(msg) > 500 and "\n" not in msg:
-            log('warn', 'The following message was over 500 characters')
-            log('warn', msg)
-            msg = msg[:490] + "\n" + msg[490:]
+class HostSender:
+    """
+    Sends the messages for one chat host from its own thread. Chat's rate limit is per account, so the host's token
+    bucket models it for all the rooms on the host, so we usually wait before sending, rather than being throttled.
+    Each room has its own queue. Reports are sent before any other messages, and otherwise the rooms take turns, so
+    a backlog of messages for one room doesn't hold up the messages for other rooms. Chat's throttling and duplicate
+    message responses are handled by chatexchange's _do_action_despite_throttling().
+    """
+    BURST = 4
+    MESSAGES_PER_SECOND = 0.5
+    MAXIMUM_FAILURES = 3
+    REPORT_PRIORITY = 0
+    DEFAULT_PRIORITY = 1
+
+    def __init__(self, host):
+        self.host = host
+        self.condition = threading.Condition()
+        # Key: room ID; Value: heap of (priority, sequence, room, msg, report_data, failures). The rooms take turns
+        # in this order. These are under the condition's lock.
+        self.room_queues = collections.OrderedDict()
+        self.unfinished = 0
+        self.bucket = TokenBucket(self.BURST, self.MESSAGES_PER_SECOND)
+        self._sequence = itertools.count()
+        self.thread = threading.Thread(name="message sender {}".format(host), target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, room, msg, report_data):
+        priority = self.REPORT_PRIORITY if report_data else self.DEFAULT_PRIORITY
+        with self.condition:
+            self.unfinished += 1
+            self._push((priority, next(self._sequence), room, msg, report_data, 0))
+
+    def _push(self, item):
+        # The caller must hold the condition's lock.
+        heapq.heappush(self.room_queues.setdefault(item[2].room.id, []), item)
+        self.condition.notify_all()
+
+    def _take(self):
+        """
+        Wait for a message, then take the one which should be sent next.
+        """
+        with self.condition:
+            while not self.room_queues:
+                self.condition.wait()
+            room_queues = self.room_queues
+            # The first room in the turn order which has a message with the highest priority.
+            room_id = min(room_queues, key=lambda room_id: room_queues[room_id][0][0])
+            room_queue = room_queues[room_id]
+            item = heapq.heappop(room_queue)
+            if room_queue:
+                room_queues.move_to_end(room_id)
+            else:
+                del room_queues[room_id]
+            return item
+
+    def _finish(self):
+        with self.condition:
+            self.unfinished -= 1
+            self.condition.notify_all()
+
+    def join(self):
+        """
+        Wait until all the messages which have been put have been sent or given up on.
+        """
+        with self.condition:
+            while self.unfinished:
+                self.condition.wait()
+
+    def run(self):
+        while True:
+            # Wait for the rate limit before taking a message, so we send whatever should be sent next then.
+            time.sleep(self.bucket.get_delay())
+            priority, sequence, room, msg, report_data, failures = self._take()
+            self.bucket.take()
+            try:
+                response = room.room._client._do_action_despite_throttling(("send", room.room.id, msg))
+                message_id = response.json()["id"]
+            except Exception:
+                log_current_exception()
+                failures += 1
+                if failures < self.MAXIMUM_FAILURES:
+                    with self.condition:
+                        self._push((priority, sequence, room, msg, report_data, failures))
+                    continue
+                log('error', 'Giving up on sending a message to {}/{} after {} failures: {}:: report data: {}'.format(
+                    self.host, room.room.id, failures, msg, report_data))
+            else:
+                record_sent_message(room, message_id, report_data)
+            self._finish()
 
-        full_retries = 0
 
-        while full_retries < 3:
-            try:
-                response = room.room._client._do_action_despite_throttling(("send", room.room.id, msg)).json()
+def get_host_sender(room):
+    host = room.room._client.host
+    with _host_senders_lock:
+        if host not in _host_senders:
+            _host_senders[host] = HostSender(host)
+        return _host_senders[host]
 
-                if "id" in response:
-                    identifier = (room.room._client.host, room.room.id)
-                    message_id = response["id"]
 
-                    with _last_messages_lock:
-                        if identifier not in _last_messages.messages:
-                            _last_messages.messages[identifier] = collections.deque((message_id,))
-                        else:
-                            last = _last_messages.messages[identifier]
+def record_sent_message(room, message_id, report_data):
+    identifier = (room.room._client.host, room.room.id)
 
-                            if len(last) > 100:
-                                last.popleft()
+    with _last_messages_lock:
+        if identifier not in _last_messages.messages:
+            _last_messages.messages[identifier] = collections.deque((message_id,))
+        else:
+            last = _last_messages.messages[identifier]
+
+            if len(last) > 100:
+                last.popleft()
 
-                            last.append(message_id)
+            last.append(message_id)
 
-                    if report_data:
-                        with _last_messages_lock:
-                            _last_messages.reports[(room.room._client.host, message_id)] = report_data
+    if report_data:
+        with _last_messages_lock:
+            _last_messages.reports[(room.room._client.host, message_id)] = report_data
+
+            if len(_last_messages.reports) > 50:
+                _last_messages.reports.popitem(last=False)
 
-                            if len(_last_messages.reports) > 50:
-                                _last_messages.reports.popitem(last=False)
+        if room.deletion_watcher:
+            callback = room.room._client.get_message(message_id).delete
 
-                        if room.deletion_watcher:
-                            callback = room.room._client.get_message(message_id).delete
+            GlobalVars.deletion_watcher.subscribe(report_data[0], callback=callback, timeout=120)
 
-                            GlobalVars.deletion_watcher.subscribe(report_data[0], callback=callback, timeout=120)
+    _pickle_run.set()
 
-                    _pickle_run.set()
 
-                break
-            except requests.exceptions.HTTPError:
-                full_retries += 1
+def send_messages():
+    # This only hands each message to the sender for its host, so it never waits for chat.
+    while True:
+        room, msg, report_data = _msg_queue.get()
+        if len(msg) > 500 and "\n" not in msg:
+            log('warn', 'The following message was over 500 characters')
+            log('warn', msg)
+            msg = msg[:490] + "\n" + msg[490:]
 
+        get_host_sender(room).put(room, msg, report_data)
         _msg_queue.task_done()
 
 
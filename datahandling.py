@@ -10,6 +10,10 @@ import time
 import math
 import threading
 import copy
+import heapq
+import itertools
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from pathlib import Path
 
 import requests
@@ -18,11 +22,13 @@ import regex
 
 from globalvars import GlobalVars
 import metasmoke
-from parsing import api_parameter_from_link, post_id_from_link
+from parsing import api_parameter_from_link, post_id_from_link, to_protocol_relative
 import blacklists
 from helpers import (ErrorLogs, log, log_current_exception, redact_passwords, get_se_api_default_params,
                      get_se_api_url_for_route)
 from tasks import Tasks
+import recently_scanned_posts as rsp
+from chat_user_cache import ChatUserCache
 
 last_feedbacked = None
 PICKLE_STORAGE = "pickles/"
@@ -40,6 +46,47 @@ bodyfetcher_queue_save_handle = None
 bodyfetcher_queue_save_handle_lock = threading.Lock()
 recently_scanned_posts_save_handle = None
 recently_scanned_posts_save_handle_lock = threading.Lock()
+# The API call counts are saved at most once per API_DATA_SAVE_DELAY seconds, and when exiting.
+API_DATA_SAVE_DELAY = 60
+api_data_save_handle = None
+api_data_save_handle_lock = threading.Lock()
+
+# Pickles of collections which are changed one entry at a time. Each change is appended to the pickle's journal
+# file, rather than rewriting the whole pickle. The journal is replayed onto the pickle when it's loaded and
+# is compacted into the pickle once it has JOURNAL_COMPACTION_THRESHOLD entries.
+# Key: pickle file name; Value: the GlobalVars attribute which holds the collection
+JOURNALED_PICKLES = {
+    "falsePositives.p": "false_positives",
+    "whitelistedUsers.p": "whitelisted_users",
+    "blacklistedUsers.p": "blacklisted_users",
+    "ignoredPosts.p": "ignored_posts",
+    "autoIgnoredPosts.p": "auto_ignored_posts",
+    "notifications.p": "notifications",
+    "whyData.p": "why_data",
+    "metasmokePostIds.p": "metasmoke_ids",
+}
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_COMPACTION_THRESHOLD = 1000
+# Key: pickle file name; Value: number of entries in the journal
+journal_lengths = {}
+journal_lock = threading.RLock()
+
+AUTO_IGNORED_POST_MAX_AGE_IN_DAYS = 7
+# Heap of (date ignored, sequence number, (post_id, site)) for expiring GlobalVars.auto_ignored_posts
+auto_ignored_posts_expiry = []
+auto_ignored_posts_sequence = itertools.count()
+auto_ignored_posts_lock = threading.RLock()
+
+# The posts metasmoke has for a post URL are looked up on a thread pool and kept for COMMUNITY_BUMP_CACHE_TTL
+# seconds, so detecting posts bumped by Community doesn't need to hold up the scan threads.
+COMMUNITY_BUMP_CACHE_TTL = 10 * 60
+COMMUNITY_BUMP_ERROR_TTL = 30
+COMMUNITY_BUMP_CACHE_MAXIMUM_ENTRIES = 10000
+COMMUNITY_BUMP_LOOKUP_TIMEOUT = 10
+community_bump_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='Community bump lookup')
+# Key: protocol relative post URL; Value: (expiry timestamp, Future for the metasmoke posts)
+community_bump_cache = {}
+community_bump_cache_lock = threading.Lock()
 
 
 class Any:
@@ -90,8 +137,19 @@ def dump_pickle(path, item, protocol=pickle.HIGHEST_PROTOCOL):
     if os.path.isfile(path):  # Remove old one
         os.remove(path)
     newpath = os.path.join(PICKLE_STORAGE, path)
-    with open(newpath, "wb") as f:
-        pickle.dump(item, f, protocol=protocol)
+    # Write to a temporary file which is then renamed over the old file, so that the file is never left
+    # partially written.
+    fd, temppath = tempfile.mkstemp(prefix=path + '.', suffix='.tmp', dir=PICKLE_STORAGE)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(item, f, protocol=protocol)
+        os.replace(temppath, newpath)
+    except BaseException:
+        try:
+            os.remove(temppath)
+        except OSError:
+            pass
+        raise
 
 
 def remove_pickle(path):
@@ -111,11 +169,106 @@ def has_pickle(path):
     return os.path.isfile(newpath) or os.path.isfile(path)
 
 
+def _get_journal_path(path):
+    return os.path.join(PICKLE_STORAGE, path + JOURNAL_SUFFIX)
+
+
+def _apply_journal_entry(collection, operation, args):
+    # The operations are idempotent, so replaying entries which are already in the pickle does no harm.
+    if operation == 'add':
+        value, = args
+        if isinstance(collection, set):
+            collection.add(value)
+        elif isinstance(collection, dict):
+            collection.setdefault(value, None)
+        elif value not in collection:
+            collection.append(value)
+    elif operation == 'remove':
+        value, = args
+        if isinstance(collection, set):
+            collection.discard(value)
+        elif isinstance(collection, dict):
+            collection.pop(value, None)
+        elif value in collection:
+            collection.remove(value)
+    elif operation == 'set':
+        key, value = args
+        collection[key] = value
+    elif operation == 'delete':
+        key, = args
+        collection.pop(key, None)
+    else:
+        raise ValueError("Unknown journal operation: {!r}".format(operation))
+
+
+def journal_pickle_change(path, operation, *args):
+    """
+    Record a change to the collection for one of the JOURNALED_PICKLES. The change must already have been made
+    to the collection in GlobalVars. operation is one of:
+      'add', value: add value to a set, add it as a key of a dict used as a set, or append it to a list, if it's
+                    not already in the list
+      'remove', value: remove value from a set, a dict used as a set, or a list
+      'set', key, value: set a dict key
+      'delete', key: delete a dict key
+    """
+    with journal_lock:
+        create_pickle_storage_if_not_exist()
+        with open(_get_journal_path(path), "ab") as f:
+            pickle.dump((operation, args), f, protocol=pickle.HIGHEST_PROTOCOL)
+        journal_lengths[path] = journal_lengths.get(path, 0) + 1
+        if journal_lengths[path] >= JOURNAL_COMPACTION_THRESHOLD:
+            store_journaled_pickle(path)
+
+
+def store_journaled_pickle(path):
+    """
+    Write the whole collection for one of the JOURNALED_PICKLES and discard its journal.
+    """
+    with journal_lock:
+        # Copying is atomic, but pickling a collection which another thread is changing might not be.
+        dump_pickle(path, getattr(GlobalVars, JOURNALED_PICKLES[path]).copy())
+        try:
+            os.remove(_get_journal_path(path))
+        except FileNotFoundError:
+            pass
+        journal_lengths[path] = 0
+
+
+def replay_pickle_journal(path):
+    """
+    Apply the changes in the journal for one of the JOURNALED_PICKLES to the collection in GlobalVars, which
+    should have just been loaded from the pickle. Pickles written before journaling existed have no journal,
+    so they need no migration.
+    """
+    journal_path = _get_journal_path(path)
+    with journal_lock:
+        if not os.path.isfile(journal_path):
+            return
+        collection = getattr(GlobalVars, JOURNALED_PICKLES[path])
+        entry_count = 0
+        with open(journal_path, "rb") as f:
+            while True:
+                try:
+                    operation, args = pickle.load(f, encoding='utf-8')
+                except EOFError:
+                    break
+                except Exception:
+                    # The last entry may have been partially written, if we crashed while writing it.
+                    log('warning', 'Discarding unreadable entries at the end of {}'.format(journal_path))
+                    break
+                _apply_journal_entry(collection, operation, args)
+                entry_count += 1
+        log('debug', 'Replayed {} entries from {}'.format(entry_count, journal_path))
+        store_journaled_pickle(path)
+
+
 # methods to load files and filter data in them:
 # load_blacklists() is defined in a separate module blacklists.py, though
 def load_files():
     if has_pickle("falsePositives.p"):
         GlobalVars.false_positives = load_pickle("falsePositives.p", encoding='utf-8')
+        if not isinstance(GlobalVars.false_positives, dict):
+            GlobalVars.false_positives = dict.fromkeys(GlobalVars.false_positives)
     if has_pickle("whitelistedUsers.p"):
         GlobalVars.whitelisted_users = load_pickle("whitelistedUsers.p", encoding='utf-8')
         if not isinstance(GlobalVars.whitelisted_users, set):
@@ -126,12 +279,27 @@ def load_files():
             GlobalVars.blacklisted_users = {data[0]: data[1:] for data in GlobalVars.blacklisted_users}
     if has_pickle("ignoredPosts.p"):
         GlobalVars.ignored_posts = load_pickle("ignoredPosts.p", encoding='utf-8')
+        if not isinstance(GlobalVars.ignored_posts, dict):
+            GlobalVars.ignored_posts = dict.fromkeys(GlobalVars.ignored_posts)
     if has_pickle("autoIgnoredPosts.p"):
         GlobalVars.auto_ignored_posts = load_pickle("autoIgnoredPosts.p", encoding='utf-8')
+        if not isinstance(GlobalVars.auto_ignored_posts, dict):
+            GlobalVars.auto_ignored_posts = {(post_id, site): date_ignored
+                                             for post_id, site, date_ignored in GlobalVars.auto_ignored_posts}
     if has_pickle("notifications.p"):
         GlobalVars.notifications = load_pickle("notifications.p", encoding='utf-8')
+        if not isinstance(GlobalVars.notifications, dict):
+            GlobalVars.notifications = get_notifications_from_list(GlobalVars.notifications)
     if has_pickle("whyData.p"):
         GlobalVars.why_data = load_pickle("whyData.p", encoding='utf-8')
+        if not isinstance(GlobalVars.why_data, dict):
+            GlobalVars.why_data = dict(GlobalVars.why_data)
+    if has_pickle("metasmokePostIds.p"):
+        GlobalVars.metasmoke_ids = load_pickle("metasmokePostIds.p", encoding='utf-8')
+    for path in JOURNALED_PICKLES:
+        replay_pickle_journal(path)
+    filter_why()
+    rebuild_auto_ignored_posts_expiry()
     # Switch from apiCalls.pickle to apiCalls.p
     # Correction was on 2020-11-02. Handling the apiCalls.pickle file should be able to be removed shortly thereafter.
     if has_pickle("apiCalls.pickle"):
@@ -144,6 +312,7 @@ def load_files():
         GlobalVars.api_calls_per_site = load_pickle("apiCalls.p", encoding='utf-8')
     if has_pickle("bodyfetcherQueue.p"):
         GlobalVars.bodyfetcher.queue = load_pickle("bodyfetcherQueue.p", encoding='utf-8')
+        GlobalVars.bodyfetcher.rebuild_site_readiness()
     if has_pickle("bodyfetcherMaxIds.p"):
         GlobalVars.bodyfetcher.previous_max_ids = load_pickle("bodyfetcherMaxIds.p", encoding='utf-8')
     if has_pickle("codePrivileges.p"):
@@ -152,8 +321,6 @@ def load_files():
         GlobalVars.reason_weights = load_pickle("reasonWeights.p", encoding='utf-8')
     if has_pickle("cookies.p"):
         GlobalVars.cookies = load_pickle("cookies.p", encoding='utf-8')
-    if has_pickle("metasmokePostIds.p"):
-        GlobalVars.metasmoke_ids = load_pickle("metasmokePostIds.p", encoding='utf-8')
     if has_pickle("ms_ajax_queue.p"):
         with metasmoke.Metasmoke.ms_ajax_queue_lock:
             metasmoke.Metasmoke.ms_ajax_queue = load_pickle("ms_ajax_queue.p")
@@ -166,7 +333,8 @@ def load_files():
             fill_site_id_dict_by_id_from_site_id_dict()
     if has_pickle("recentlyScannedPosts.p"):
         with GlobalVars.recently_scanned_posts_lock:
-            GlobalVars.recently_scanned_posts = load_pickle("recentlyScannedPosts.p", encoding='utf-8')
+            GlobalVars.recently_scanned_posts = rsp.get_recently_scanned_posts_from_pickle(
+                load_pickle("recentlyScannedPosts.p", encoding='utf-8'))
     if has_pickle("postScanStats2.p"):
         with GlobalVars.PostScanStat.rw_lock:
             GlobalVars.PostScanStat.stats = load_pickle("postScanStats2.p", encoding='utf-8')
@@ -174,17 +342,35 @@ def load_files():
     blacklists.load_blacklists()
 
 
-def filter_auto_ignored_posts():
+def rebuild_auto_ignored_posts_expiry():
+    global auto_ignored_posts_expiry
+    with auto_ignored_posts_lock:
+        auto_ignored_posts_expiry = [(date_ignored, next(auto_ignored_posts_sequence), post_site_id)
+                                     for post_site_id, date_ignored in GlobalVars.auto_ignored_posts.items()]
+        heapq.heapify(auto_ignored_posts_expiry)
+
+
+def _expire_auto_ignored_posts():
+    """
+    Remove the auto-ignored posts which are more than AUTO_IGNORED_POST_MAX_AGE_IN_DAYS days old, returning
+    the (post_id, site) keys which were removed.
+    """
     today_date = datetime.today()
-    to_remove = []
-    for aip in GlobalVars.auto_ignored_posts:
-        day_ignored = aip[2]
-        day_diff = (today_date - day_ignored).days
-        if day_diff > 7:
-            to_remove.append(aip)
-    for tr in to_remove:
-        GlobalVars.auto_ignored_posts.remove(tr)
-    dump_pickle("autoIgnoredPosts.p", GlobalVars.auto_ignored_posts)
+    expired = []
+    with auto_ignored_posts_lock:
+        while auto_ignored_posts_expiry and \
+                (today_date - auto_ignored_posts_expiry[0][0]).days > AUTO_IGNORED_POST_MAX_AGE_IN_DAYS:
+            date_ignored, _, post_site_id = heapq.heappop(auto_ignored_posts_expiry)
+            # Ignore heap entries which don't match the current entry for the post
+            if GlobalVars.auto_ignored_posts.get(post_site_id, None) == date_ignored:
+                del GlobalVars.auto_ignored_posts[post_site_id]
+                expired.append(post_site_id)
+    return expired
+
+
+def filter_auto_ignored_posts():
+    _expire_auto_ignored_posts()
+    store_journaled_pickle("autoIgnoredPosts.p")
 
 
 # methods to check whether a post/user is whitelisted/blacklisted/...
@@ -218,10 +404,7 @@ def is_ignored_post(postid_site_tuple):
 
 # noinspection PyMissingTypeHints
 def is_auto_ignored_post(postid_site_tuple):
-    for p in GlobalVars.auto_ignored_posts:
-        if p[0] == postid_site_tuple[0] and p[1] == postid_site_tuple[1]:
-            return True
-    return False
+    return (postid_site_tuple[0], postid_site_tuple[1]) in GlobalVars.auto_ignored_posts
 
 
 def update_code_privileged_users_list():
@@ -277,7 +460,7 @@ def resolve_ms_link(post_url):
         ms_post_id = max([post['id'] for post in ms_posts])
         ms_url = (GlobalVars.metasmoke_host.rstrip("/") + "/post/{}").format(ms_post_id)
     GlobalVars.metasmoke_ids[identifier] = ms_post_id  # Store numeric IDs, strings are hard to handle
-    dump_pickle("metasmokePostIds.p", GlobalVars.metasmoke_ids)
+    journal_pickle_change("metasmokePostIds.p", 'set', identifier, ms_post_id)
     return ms_url
 
 
@@ -289,28 +472,35 @@ def add_whitelisted_user(user):
     if user in GlobalVars.whitelisted_users or user is None:
         return
     GlobalVars.whitelisted_users.add(user)
-    dump_pickle("whitelistedUsers.p", GlobalVars.whitelisted_users)
+    journal_pickle_change("whitelistedUsers.p", 'add', user)
 
 
 def add_blacklisted_user(user, message_url, post_url):
     if is_blacklisted_user(user) or user is None:
         return
     GlobalVars.blacklisted_users[user] = (message_url, post_url)
-    dump_pickle("blacklistedUsers.p", GlobalVars.blacklisted_users)
+    journal_pickle_change("blacklistedUsers.p", 'set', user, (message_url, post_url))
 
 
 def add_auto_ignored_post(postid_site_tuple):
-    if postid_site_tuple is None or is_auto_ignored_post(postid_site_tuple):
+    if postid_site_tuple is None:
         return
-    GlobalVars.auto_ignored_posts.append(postid_site_tuple)
-    dump_pickle("autoIgnoredPosts.p", GlobalVars.auto_ignored_posts)
+    post_id, site, date_ignored = postid_site_tuple
+    with auto_ignored_posts_lock:
+        for post_site_id in _expire_auto_ignored_posts():
+            journal_pickle_change("autoIgnoredPosts.p", 'delete', post_site_id)
+        if is_auto_ignored_post(postid_site_tuple):
+            return
+        GlobalVars.auto_ignored_posts[(post_id, site)] = date_ignored
+        heapq.heappush(auto_ignored_posts_expiry, (date_ignored, next(auto_ignored_posts_sequence), (post_id, site)))
+    journal_pickle_change("autoIgnoredPosts.p", 'set', (post_id, site), date_ignored)
 
 
 def add_false_positive(site_post_id_tuple):
     if site_post_id_tuple is None or site_post_id_tuple in GlobalVars.false_positives:
         return
-    GlobalVars.false_positives.append(site_post_id_tuple)
-    dump_pickle("falsePositives.p", GlobalVars.false_positives)
+    GlobalVars.false_positives[site_post_id_tuple] = None
+    journal_pickle_change("falsePositives.p", 'add', site_post_id_tuple)
 
     global last_feedbacked
     last_feedbacked = (site_post_id_tuple, time.time() + 60)
@@ -320,8 +510,8 @@ def add_false_positive(site_post_id_tuple):
 def add_ignored_post(postid_site_tuple):
     if postid_site_tuple is None or postid_site_tuple in GlobalVars.ignored_posts:
         return
-    GlobalVars.ignored_posts.append(postid_site_tuple)
-    dump_pickle("ignoredPosts.p", GlobalVars.ignored_posts)
+    GlobalVars.ignored_posts[postid_site_tuple] = None
+    journal_pickle_change("ignoredPosts.p", 'add', postid_site_tuple)
 
     global last_feedbacked
     last_feedbacked = (postid_site_tuple, time.time() + 60)
@@ -332,7 +522,7 @@ def remove_blacklisted_user(user):
     if not blacklisted_user_data:
         return False
     GlobalVars.blacklisted_users.pop(blacklisted_user_data[0])
-    dump_pickle("blacklistedUsers.p", GlobalVars.blacklisted_users)
+    journal_pickle_change("blacklistedUsers.p", 'delete', blacklisted_user_data[0])
     return True
 
 
@@ -341,28 +531,29 @@ def remove_whitelisted_user(user):
     if user not in GlobalVars.whitelisted_users:
         return False
     GlobalVars.whitelisted_users.remove(user)
-    dump_pickle("whitelistedUsers.p", GlobalVars.whitelisted_users)
+    journal_pickle_change("whitelistedUsers.p", 'remove', user)
     return True
 
 
 def add_why(site, post_id, why):
     key = site + "/" + str(post_id)
-    why_data_tuple = (key, why)
-    GlobalVars.why_data.append(why_data_tuple)
+    # Re-adding a post makes it the newest, which replaying the journal only does if the key is deleted first.
+    if GlobalVars.why_data.pop(key, None) is not None:
+        journal_pickle_change("whyData.p", 'delete', key)
+    GlobalVars.why_data[key] = why
     filter_why()
-    dump_pickle("whyData.p", GlobalVars.why_data)
+    journal_pickle_change("whyData.p", 'set', key, why)
 
 
 def get_why(site, post_id):
     key = site + "/" + str(post_id)
-    for post in GlobalVars.why_data:
-        if post[0] == key:
-            return post[1]
-    return None
+    return GlobalVars.why_data.get(key, None)
 
 
 def filter_why(max_size=50):
-    GlobalVars.why_data = GlobalVars.why_data[-max_size:]
+    why_data = GlobalVars.why_data
+    for key in list(itertools.islice(why_data, max(len(why_data) - max_size, 0))):
+        why_data.pop(key, None)
 
 
 def add_post_site_id_link(post_site_id, question_id):
@@ -380,12 +571,34 @@ def add_or_update_api_data(site):
         GlobalVars.api_calls_per_site[site] += 1
     else:
         GlobalVars.api_calls_per_site[site] = 1
-    dump_pickle("apiCalls.p", GlobalVars.api_calls_per_site)
+    schedule_store_api_data()
 
 
 def clear_api_data():
     GlobalVars.api_calls_per_site = {}
-    dump_pickle("apiCalls.p", GlobalVars.api_calls_per_site)
+    schedule_store_api_data()
+
+
+def schedule_store_api_data():
+    # Changes made while a save is scheduled are included in that save.
+    global api_data_save_handle
+    with api_data_save_handle_lock:
+        if not api_data_save_handle:
+            api_data_save_handle = Tasks.later(store_api_data, after=API_DATA_SAVE_DELAY)
+
+
+def store_api_data():
+    global api_data_save_handle
+    with api_data_save_handle_lock:
+        if api_data_save_handle:
+            api_data_save_handle.cancel()
+        api_data_save_handle = None
+    # This must not be a top-level import in order to avoid a circular import. api_data_lock is a class attribute,
+    # so this works when there isn't a GlobalVars.bodyfetcher, e.g. at shutdown.
+    from bodyfetcher import BodyFetcher
+    with BodyFetcher.api_data_lock:
+        api_calls_copy = GlobalVars.api_calls_per_site.copy()
+    dump_pickle("apiCalls.p", api_calls_copy)
 
 
 def schedule_store_bodyfetcher_queue():
@@ -553,11 +766,45 @@ def check_site_and_get_full_name(site):
 # methods to add/remove/check users on the "notification" list
 # (that is, being pinged when Smokey reports something on a specific site)
 #
-# The list of notifications is stored in GlobalVars.notifications.
-# It is a tuple with the following format:
-# notification_tuple = (int(user_id), chat_site, int(room_id), se_site, always_ping)
+# The notifications are stored in GlobalVars.notifications, which is a dict with the format:
+# {(int(user_id), chat_site, int(room_id), se_site): always_ping}
 # always_ping is used to indicate if the user should always be pinged, or only pinged
 # when they are present in the room.
+#
+# GlobalVars.notifications is indexed by room and site and by user. The index is rebuilt whenever
+# GlobalVars.notifications is replaced (e.g. loaded or transferred) and is otherwise kept up to date
+# by the functions which change the notifications.
+notifications_lock = threading.RLock()
+# (the GlobalVars.notifications which is indexed,
+#  Key: (chat_site, room_id, se_site); Value: {user_id: always_ping},
+#  Key: user_id; Value: {(chat_site, room_id, se_site): None})
+notification_index = (None, {}, {})
+
+
+def get_notifications_from_list(notifications):
+    """
+    Convert the list of (user_id, chat_site, room_id, se_site[, always_ping]) tuples used by older versions.
+    """
+    return {tuple(notification[:4]): notification[4] if len(notification) > 4 else True
+            for notification in notifications}
+
+
+def get_notifications_as_list(notifications):
+    return [key + (always_ping,) for key, always_ping in notifications.items()]
+
+
+def _get_notification_index():
+    global notification_index
+    with notifications_lock:
+        if notification_index[0] is not GlobalVars.notifications:
+            by_room_site = {}
+            by_user = {}
+            for (user_id, chat_site, room_id, se_site), always_ping in GlobalVars.notifications.items():
+                by_room_site.setdefault((chat_site, room_id, se_site), {})[user_id] = always_ping
+                by_user.setdefault(user_id, {})[(chat_site, room_id, se_site)] = None
+            notification_index = (GlobalVars.notifications, by_room_site, by_user)
+        return notification_index
+
 
 # noinspection PyMissingTypeHints
 def add_to_notification_list(user_id, chat_site, room_id, se_site, always_ping=True):
@@ -565,11 +812,17 @@ def add_to_notification_list(user_id, chat_site, room_id, se_site, always_ping=T
         exists, se_site = check_site_and_get_full_name(se_site)
         if not exists:
             return -2, None
-    notification_tuple = (int(user_id), chat_site, int(room_id), se_site, Any())
-    if notification_tuple in GlobalVars.notifications:
-        return -1, None
-    GlobalVars.notifications.append((int(user_id), chat_site, int(room_id), se_site, always_ping))
-    dump_pickle("notifications.p", GlobalVars.notifications)
+    user_id = int(user_id)
+    room_id = int(room_id)
+    with notifications_lock:
+        _, by_room_site, by_user = _get_notification_index()
+        key = (user_id, chat_site, room_id, se_site)
+        if key in GlobalVars.notifications:
+            return -1, None
+        GlobalVars.notifications[key] = always_ping
+        by_room_site.setdefault((chat_site, room_id, se_site), {})[user_id] = always_ping
+        by_user.setdefault(user_id, {})[(chat_site, room_id, se_site)] = None
+        journal_pickle_change("notifications.p", 'set', key, always_ping)
     return 0, se_site
 
 
@@ -579,11 +832,26 @@ def remove_from_notification_list(user_id, chat_site, room_id, se_site):
         exists, se_site = check_site_and_get_full_name(se_site)
         if not exists:
             return False
-    notification_tuple = (int(user_id), chat_site, int(room_id), se_site, Any())
-    if notification_tuple not in GlobalVars.notifications:
-        return False
-    GlobalVars.notifications.remove(notification_tuple)
-    dump_pickle("notifications.p", GlobalVars.notifications)
+    return _remove_notification((int(user_id), chat_site, int(room_id), se_site))
+
+
+def _remove_notification(key):
+    user_id, chat_site, room_id, se_site = key
+    with notifications_lock:
+        _, by_room_site, by_user = _get_notification_index()
+        if key not in GlobalVars.notifications:
+            return False
+        del GlobalVars.notifications[key]
+        room_site_key = (chat_site, room_id, se_site)
+        room_site_users = by_room_site[room_site_key]
+        del room_site_users[user_id]
+        if not room_site_users:
+            del by_room_site[room_site_key]
+        user_room_sites = by_user[user_id]
+        del user_room_sites[room_site_key]
+        if not user_room_sites:
+            del by_user[user_id]
+        journal_pickle_change("notifications.p", 'delete', key)
     return True
 
 
@@ -592,37 +860,30 @@ def will_i_be_notified(user_id, chat_site, room_id, se_site):
     exists, site = check_site_and_get_full_name(se_site)
     if not exists:
         return False
-    notification_tuple = (int(user_id), chat_site, int(room_id), site, Any())
-    return notification_tuple in GlobalVars.notifications
+    return (int(user_id), chat_site, int(room_id), site) in GlobalVars.notifications
 
 
 # noinspection PyMissingTypeHints
 def remove_all_from_notification_list(user_id):
     user_id = int(user_id)
-    my_notifications = []
-
-    for notification in GlobalVars.notifications:
-        if notification[0] == user_id:
-            my_notifications.append(notification[:4])
-
-    for notification in my_notifications:
-        remove_from_notification_list(*notification)
+    with notifications_lock:
+        _, _, by_user = _get_notification_index()
+        for chat_site, room_id, se_site in list(by_user.get(user_id, {})):
+            _remove_notification((user_id, chat_site, room_id, se_site))
 
 
 def get_all_notification_sites(user_id, chat_site, room_id):
-    sites = []
-    for notification in GlobalVars.notifications:
-        if notification[0] == int(user_id) and notification[1] == chat_site and notification[2] == int(room_id):
-            sites.append(notification[3])
-    return sorted(sites)
+    room_id = int(room_id)
+    with notifications_lock:
+        _, _, by_user = _get_notification_index()
+        return sorted(se_site for notification_chat_site, notification_room_id, se_site in by_user.get(int(user_id), {})
+                      if notification_chat_site == chat_site and notification_room_id == room_id)
 
 
 def get_user_ids_on_notification_list(chat_site, room_id, se_site):
-    uids = []
-    for notification in GlobalVars.notifications:
-        if notification[1] == chat_site and notification[2] == int(room_id) and notification[3] == se_site:
-            uids.append((notification[0], notification[4]))
-    return uids
+    with notifications_lock:
+        _, by_room_site, _ = _get_notification_index()
+        return list(by_room_site.get((chat_site, int(room_id), se_site), {}).items())
 
 
 def get_user_names_on_notification_list(chat_site, room_id, se_site, client):
@@ -631,7 +892,7 @@ def get_user_names_on_notification_list(chat_site, room_id, se_site, client):
     for user_id, always in get_user_ids_on_notification_list(chat_site, room_id, se_site):
         if always:
             try:
-                names.append(client.get_user(user_id).name)
+                names.append(ChatUserCache.get_user_name(client, user_id))
             except Exception:
                 # The user is probably deleted, or we're having communication problems with chat.
                 log_current_exception()
@@ -643,16 +904,10 @@ def get_user_names_on_notification_list(chat_site, room_id, se_site, client):
 
     if non_always_ids:
         # If there are no users who have requested to be pinged only when present in the room, then we
-        # don't fetch the current_users list for this room (doing so makes an HTTPS request to chat).
-        # If people use the feature of not being pinged when not in the room for high-traffic rooms, then
-        # we should implement a cache for the current_users in each room, so we're not fetching it on each
-        # of a large number of messages/reports. If this feature is only used on low traffic rooms, then
-        # we don't really need a cache.
-        # Note: for a considerable time (years), we fetched the current users on *every* report, so it is
-        # something SD can do. It's just better if we don't have to have the extra request for *every*
-        # report posted into a high-traffic room.
+        # don't need the current_users list for this room. When we do, it's cached, and refreshed in the
+        # background, by ChatUserCache, so high-traffic rooms don't make an HTTPS request to chat for every report.
         try:
-            current_users = client._br.get_current_users_in_room(room_id)
+            current_users = ChatUserCache.get_current_users_in_room(client, room_id)
         except Exception:
             # ChatExchange had a problem getting the current users. This shouldn't be allowed to
             # cause us to crash, as it's on the path we take for going into standby.
@@ -683,15 +938,57 @@ def append_pings(original_message, names):
 # method to check if a post has been bumped by Community
 
 
-def has_community_bumped_post(post_url, post_content):
+def _community_bump_lookup_done(key, future):
+    # Failed lookups are only kept for a short time.
+    if future.exception() is None and future.result() is not None:
+        return
+    with community_bump_cache_lock:
+        entry = community_bump_cache.get(key, None)
+        if entry is not None and entry[1] is future:
+            community_bump_cache[key] = (time.time() + COMMUNITY_BUMP_ERROR_TTL, future)
+
+
+def get_ms_post_bodies_future(post_url):
+    """
+    Get a Future for the result of Metasmoke.get_post_bodies_from_ms(post_url), starting the lookup, if there isn't
+    a cached one.
+    """
+    key = to_protocol_relative(post_url)
+    now = time.time()
+    with community_bump_cache_lock:
+        entry = community_bump_cache.get(key, None)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        future = community_bump_executor.submit(metasmoke.Metasmoke.get_post_bodies_from_ms, post_url)
+        community_bump_cache.pop(key, None)
+        community_bump_cache[key] = (now + COMMUNITY_BUMP_CACHE_TTL, future)
+        if len(community_bump_cache) > COMMUNITY_BUMP_CACHE_MAXIMUM_ENTRIES:
+            for expired_key in [cache_key for cache_key, (expiry, _) in community_bump_cache.items()
+                                if expiry <= now]:
+                del community_bump_cache[expired_key]
+            # dicts are in insertion order, so these are the oldest entries
+            excess = len(community_bump_cache) - COMMUNITY_BUMP_CACHE_MAXIMUM_ENTRIES
+            for old_key in list(community_bump_cache)[:excess]:
+                del community_bump_cache[old_key]
+    future.add_done_callback(lambda done_future: _community_bump_lookup_done(key, done_future))
+    return future
+
+
+def has_community_bumped_post(post_url, post_content, wait=True):
+    """
+    Check if the post_content is the same as a version of the post which metasmoke already has. If wait is False
+    and the metasmoke lookup hasn't completed, None is returned, rather than waiting for the lookup.
+    """
+    future = get_ms_post_bodies_future(post_url)
+    if not wait and not future.done():
+        return None
     try:
-        ms_posts = metasmoke.Metasmoke.get_post_bodies_from_ms(post_url)
-        if not ms_posts:
-            return False
-
-        return any(post['body'] == post_content for post in ms_posts)
-    except (requests.exceptions.ConnectionError, ValueError):
+        ms_posts = future.result(timeout=COMMUNITY_BUMP_LOOKUP_TIMEOUT)
+    except (requests.exceptions.ConnectionError, ValueError, FutureTimeoutError):
         return False  # MS is down, so assume it is not bumped
+    if not ms_posts:
+        return False
+    return any(post['body'] == post_content for post in ms_posts)
 
 # methods to check if someone waited long enough to use another !!/report with multiple URLs
 # (to avoid SmokeDetector's chat messages to be rate-limited too much)
@@ -730,10 +1027,13 @@ class SmokeyTransfer:
 
     ITEMS = [
         # (dict_key, object, attr, type, post_processing)
+        # type, when not None, converts the item for transfer. post_processing, when not None, converts the
+        # transferred item back. ignored_posts and notifications are transferred as lists, which is what older
+        # versions expect.
         ('blacklisted_users', GlobalVars, 'blacklisted_users', None, None),
         ('whitelisted_users', GlobalVars, 'whitelisted_users', None, None),
-        ('ignored_posts', GlobalVars, 'ignored_posts', None, None),
-        ('notifications', GlobalVars, 'notifications', None, None),
+        ('ignored_posts', GlobalVars, 'ignored_posts', list, dict.fromkeys),
+        ('notifications', GlobalVars, 'notifications', get_notifications_as_list, get_notifications_from_list),
     ]
 
     @classmethod
@@ -748,6 +1048,8 @@ class SmokeyTransfer:
         for item_info in cls.ITEMS:
             key, obj, attr, obj_type, _ = item_info
             item = getattr(obj, attr)
+            if obj_type is not None:
+                item = obj_type(item)
             data[key] = item
             try:
                 length = len(item)
@@ -804,7 +1106,12 @@ class SmokeyTransfer:
                 if length != data['_metadata']['lengths'][key]:
                     warnings.append("Length of {!r} mismatch (recorded {}, actual {})".format(
                         key, data['_metadata']['lengths'][key], length))
+                if proc is not None:
+                    item = proc(item)
                 setattr(obj, attr, item)
+                for path, journaled_attr in JOURNALED_PICKLES.items():
+                    if obj is GlobalVars and attr == journaled_attr:
+                        store_journaled_pickle(path)
             if warnings:
                 raise Warning("Warning: " + ', '.join(warnings))
         except (ValueError, zlib.error) as e:
@@ -13,13 +13,14 @@ from globalvars import GlobalVars
 import metasmoke
 import datahandling
 from helpers import (log, get_se_api_default_params_questions_answers_posts_add_site, get_se_api_url_for_route,
-                     recover_websocket, chunk_list)
+                     recover_websocket, chunk_list, ExpiryIndex)
 from parsing import fetch_post_id_and_site_from_url, to_protocol_relative
 from tasks import Tasks
 
 
 PICKLE_FILENAME = "deletionIDs.p"
 DELETION_WATCH_MIN_SECONDS = 7200
+EXPIRE_INTERVAL = 5 * 60  # 5 minutes
 
 
 # noinspection PyClassHasNoInit,PyBroadException,PyMethodParameters
@@ -36,8 +37,11 @@ class DeletionWatcher:
         #   Actions are added when a post is subscribed. They are removed when a WebSocket message is received
         #   indicating the first post subscribed for that question is deleted.
         #   Upon reboot, questions are not resubscribed to if the last subscription was more than
-        #   DELETION_WATCH_MIN_SECONDS ago (currently 7200).
+        #   DELETION_WATCH_MIN_SECONDS ago (currently 7200). While running, posts are removed once their
+        #   max_watch_time has passed and the action is unsubscribed when its last post is removed.
         self.posts = {}
+        # The max_watch_time of each (action, post_id) in self.posts
+        self.expiry_index = ExpiryIndex()
         self.posts_lock = threading.RLock()
 
         try:
@@ -59,10 +63,14 @@ class DeletionWatcher:
             elif pickle_info['version'] == '2':
                 with self.posts_lock:
                     self.posts = pickle_info['posts']
+                    self.expiry_index = ExpiryIndex({(action, post_id): post[5]
+                                                     for action, action_posts in self.posts.items()
+                                                     for post_id, post in action_posts.items()})
                 self.expunge_expired_posts(False)
                 self._subscribe_to_all_saved_posts()
 
         threading.Thread(name=self.__class__.__name__, target=self._start, daemon=True).start()
+        Tasks.periodic(self.expunge_expired_posts, interval=EXPIRE_INTERVAL)
 
     def _start(self):
         while True:
@@ -85,6 +93,7 @@ class DeletionWatcher:
                                 with self.posts_lock:
                                     _, _, _, post_url, _, _, callbacks = self.posts[action][post_id]
                                     del self.posts[action][post_id]
+                                    self.expiry_index.discard((action, post_id))
                                     if len(self.posts[action]) == 0:
                                         del self.posts[action]
                                         Tasks.do(self._unsubscribe, action)
@@ -104,19 +113,22 @@ class DeletionWatcher:
                 self.hb_time = None
 
     def expunge_expired_posts(self, unsubscribe=True):
-        now = time.time()
+        to_unsubscribe = []
         with self.posts_lock:
-            actions = list(self.posts.keys())
-            for action in actions:
-                post_ids = list(self.posts[action].keys())
-                for post_id in post_ids:
-                    _, _, _, _, _, max_time, _ = self.posts[action][post_id]
-                    if now > max_time:
-                        del self.posts[action][post_id]
-                if len(self.posts[action]) == 0:
+            for action, post_id in self.expiry_index.pop_expired():
+                action_posts = self.posts.get(action, None)
+                if action_posts is None:
+                    continue
+                action_posts.pop(post_id, None)
+                if len(action_posts) == 0:
                     del self.posts[action]
-                    if unsubscribe:
-                        Tasks.do(self._unsubscribe, action)
+                    to_unsubscribe.append(action)
+        if unsubscribe and to_unsubscribe:
+            Tasks.do(self._unsubscribe_actions, to_unsubscribe)
+
+    def _unsubscribe_actions(self, actions):
+        for action in actions:
+            self._unsubscribe(action)
 
     def _subscribe_to_all_saved_posts(self):
         with self.posts_lock:
@@ -161,6 +173,7 @@ class DeletionWatcher:
             # This is fully replaced in order to update the max_watch_time
             self.posts[action][post_id] = (post_id, post_site, post_type, post_url, question_id,
                                            now + DELETION_WATCH_MIN_SECONDS, callbacks)
+            self.expiry_index.set((action, post_id), now + DELETION_WATCH_MIN_SECONDS)
         if needs_subscribe:
             Tasks.do(self._subscribe, action)
 
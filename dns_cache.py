@@ -0,0 +1,113 @@
+# coding=utf-8
+import threading
+import time
+from concurrent.futures import Future
+
+import dns.exception
+import dns.resolver
+
+
+class DNSCache:
+    """
+    A process wide cache of DNS resolutions, keyed by (label, qtype).
+
+    Answers are kept for the TTL of the records. Lookups for which the name or the record type doesn't exist are
+    cached for NEGATIVE_TTL seconds and lookups which failed for other reasons (e.g. timeouts) are cached for
+    ERROR_TTL seconds. When there's already a lookup in progress for a key, other threads wanting the same key
+    wait for that lookup, rather than making their own.
+    """
+    NEGATIVE_TTL = 5 * 60
+    ERROR_TTL = 30
+    MAXIMUM_TTL = 24 * 60 * 60
+    MAXIMUM_ENTRIES = 50000
+    NEGATIVE_EXCEPTIONS = (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer)
+    # Key: (label, qtype); Value: (expiry timestamp, answer, exception)
+    _cache = {}
+    # Key: (label, qtype); Value: Future for the lookup in progress
+    _in_flight = {}
+    # Counted here, rather than in GlobalVars.PostScanStat, so lookups don't contend on the global stats lock.
+    # Reported by !!/stats.
+    _stats = {'hits': 0, 'misses': 0, 'lookup_time': 0}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _get_key(label, qtype):
+        return str(label).lower(), str(qtype).lower()
+
+    @staticmethod
+    def _get_expiry(answer, exception):
+        now = time.time()
+        if exception is None:
+            return min(getattr(answer, 'expiration', now), now + DNSCache.MAXIMUM_TTL)
+        if isinstance(exception, DNSCache.NEGATIVE_EXCEPTIONS):
+            return now + DNSCache.NEGATIVE_TTL
+        return now + DNSCache.ERROR_TTL
+
+    @staticmethod
+    def _insert(key, answer, exception):
+        cache = DNSCache._cache
+        cache[key] = (DNSCache._get_expiry(answer, exception), answer, exception)
+        if len(cache) > DNSCache.MAXIMUM_ENTRIES:
+            now = time.time()
+            for expired_key in [cache_key for cache_key, entry in cache.items() if entry[0] <= now]:
+                del cache[expired_key]
+            # dicts are in insertion order, so these are the oldest entries
+            for old_key in list(cache.keys())[:len(cache) - DNSCache.MAXIMUM_ENTRIES]:
+                del cache[old_key]
+
+    @staticmethod
+    def resolve(label, qtype, **kwargs):
+        """
+        Resolve a DNS query, using the cached result when available. Any additional keyword arguments are passed to
+        dns.resolver.resolve(). Failed lookups raise the dns.exception.DNSException which the lookup raised.
+        """
+        key = DNSCache._get_key(label, qtype)
+        with DNSCache._lock:
+            entry = DNSCache._cache.get(key, None)
+            if entry is not None and entry[0] <= time.time():
+                del DNSCache._cache[key]
+                entry = None
+            in_flight = DNSCache._in_flight.get(key, None)
+            is_owner = entry is None and in_flight is None
+            if is_owner:
+                in_flight = Future()
+                DNSCache._in_flight[key] = in_flight
+                DNSCache._stats['misses'] += 1
+            else:
+                DNSCache._stats['hits'] += 1
+        if entry is not None:
+            _, answer, exception = entry
+        elif not is_owner:
+            # Another thread is already looking this up.
+            answer, exception = in_flight.result()
+        else:
+            start_time = time.time()
+            answer, exception = None, None
+            try:
+                answer = dns.resolver.resolve(label, qtype, search=True, **kwargs)
+            except dns.exception.DNSException as exc:
+                exception = exc
+            except Exception as exc:
+                # Not a DNS failure, so don't cache it, but don't leave the waiting threads hanging.
+                with DNSCache._lock:
+                    del DNSCache._in_flight[key]
+                in_flight.set_exception(exc)
+                raise
+            with DNSCache._lock:
+                DNSCache._stats['lookup_time'] += time.time() - start_time
+                DNSCache._insert(key, answer, exception)
+                del DNSCache._in_flight[key]
+            in_flight.set_result((answer, exception))
+        if exception is not None:
+            raise exception.with_traceback(None)
+        return answer
+
+    @staticmethod
+    def get_stats():
+        with DNSCache._lock:
+            return DNSCache._stats.copy()
+
+    @staticmethod
+    def clear():
+        with DNSCache._lock:
+            DNSCache._cache.clear()
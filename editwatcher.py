@@ -12,12 +12,13 @@ import websocket
 from globalvars import GlobalVars
 import chatcommunicate
 import datahandling
-from helpers import log, add_to_global_bodyfetcher_queue_in_new_thread, recover_websocket
+from helpers import log, add_to_global_bodyfetcher_queue_in_new_thread, recover_websocket, ExpiryIndex
 from parsing import fetch_post_id_and_site_from_url
 from tasks import Tasks
 
 PICKLE_FILENAME = "editActions.p"
 DEFAULT_TIMEOUT = 10 * 60  # 10 minutes
+EXPIRE_INTERVAL = 60  # 1 minute
 
 
 # noinspection PyClassHasNoInit,PyBroadException,PyMethodParameters
@@ -29,6 +30,8 @@ class EditWatcher:
         # posts is a dict with the WebSocket action, {site_id}-question-{question_id}, as keys
         # with each value being: (site_id, hostname, question_id, max_time)
         self.posts = {}
+        # The max_time of each action in self.posts
+        self.expiry_index = ExpiryIndex()
         self.posts_lock = threading.RLock()
 
         try:
@@ -45,9 +48,11 @@ class EditWatcher:
             pickle_data = datahandling.load_pickle(PICKLE_FILENAME)
             with self.posts_lock:
                 self.posts = pickle_data
+                self.expiry_index = ExpiryIndex({action: value[-1] for action, value in self.posts.items()})
             self._subscribe_to_saved_posts()  # This expunges old entries, so we don't need to do that here.
 
         threading.Thread(name=self.__class__.__name__, target=self._start, daemon=True).start()
+        Tasks.periodic(self._unsubscribe_to_expired_posts_and_expunge, interval=EXPIRE_INTERVAL)
 
     def _start(self):
         while True:
@@ -68,11 +73,11 @@ class EditWatcher:
                             site_id, hostname, question_id, max_time = self.posts.get(action, (None, None, None, now))
                             if site_id and max_time <= now:
                                 del self.posts[action]
+                                self.expiry_index.discard(action)
                                 Tasks.do(self._unsubscribe, action)
                         if max_time > now and data["a"] == "post-edit":
                             add_to_global_bodyfetcher_queue_in_new_thread(hostname, question_id, False,
                                                                           source=self.__class__.__name__)
-                    Tasks.do(self._unsubscribe_to_expired_posts_and_expunge)
             except websocket.WebSocketException as e:
                 ws = self.socket
                 self.socket = None
@@ -82,18 +87,19 @@ class EditWatcher:
                 self.hb_time = None
 
     def _unsubscribe_to_expired_posts_and_expunge(self):
-        now = time.time()
-        with self.posts_lock:
-            to_unsubscribe = list(action for action, value in self.posts.items() if value[-1] <= now)
-        self._expunge_expired_posts(now=now)
-        for action in to_unsubscribe:
+        # This runs every EXPIRE_INTERVAL, so the expired actions are unsubscribed in batches.
+        for action in self._expunge_expired_posts():
             self._unsubscribe(action)
 
     def _expunge_expired_posts(self, now=None):
-        if now is None:
-            now = time.time()
+        """
+        Remove the expired posts, returning their actions.
+        """
         with self.posts_lock:
-            self.posts = {action: value for action, value in self.posts.items() if value[-1] > now}
+            expired = self.expiry_index.pop_expired(now)
+            for action in expired:
+                self.posts.pop(action, None)
+        return expired
 
     def _subscribe_to_saved_posts(self):
         self._expunge_expired_posts()
@@ -148,11 +154,13 @@ class EditWatcher:
                 action = "{}-question-{}".format(site_id, question_id)
                 if action not in self.posts:
                     self.posts[action] = (site_id, hostname, question_id, max_time)
+                    self.expiry_index.set(action, max_time)
                     to_subscribe.append(action)
                 else:
-                    old_max_time = self.posts[action][2]
+                    old_max_time = self.posts[action][-1]
                     if max_time > old_max_time:
                         self.posts[action] = (site_id, hostname, question_id, max_time)
+                        self.expiry_index.set(action, max_time)
 
         for action in to_subscribe:
             Tasks.do(self._subscribe, action)
@@ -6,13 +6,16 @@ import math
 from difflib import SequenceMatcher
 from urllib.parse import urlparse, unquote_plus
 from itertools import chain
-from collections import Counter
+from collections import Counter, OrderedDict, namedtuple
 from datetime import datetime
 from string import punctuation
 import time
 import os
 import os.path as path
 import threading
+import contextvars
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 
 import regex
 # noinspection PyPackageRequirements
@@ -27,6 +30,8 @@ import chatcommunicate
 from helpers import log, regex_compile_no_cache, strip_pre_and_code_elements, strip_code_elements, \
     get_bookended_keyword_regex_text_from_entries, keyword_bookend_regex_text, KEYWORD_BOOKENDING_START, \
     get_non_bookended_keyword_regex_text_from_entries, chunk_list
+from keyword_prefilter import KeywordPrefilterMatcher
+from dns_cache import DNSCache
 import metasmoke_cache
 from globalvars import GlobalVars
 import blacklists
@@ -38,8 +43,14 @@ if tuple(int(x) for x in regex.__version__.split('.')) < (2, 5, 82):
         'Need regex >= 2020.6.8 (internal version number 2.5.82; got %s)' %
         regex.__version__)
 
-LINK_CACHE = dict()
-LINK_CACHE_lock = threading.RLock()
+# Key: frozenset of hostnames; Value: threading.Event which is set when the prefetch is complete
+DNS_PREFETCH_IN_FLIGHT = dict()
+DNS_PREFETCH_IN_FLIGHT_lock = threading.Lock()
+DNS_PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=40, thread_name_prefix='FindSpam DNS prefetch')
+# The most time, in seconds, which a DNS query, including retries, may take. HTTP requests made by rules use
+# IO_BOUND_REQUEST_TIMEOUT. These keep the I/O bound rules well within FindSpam.IO_BOUND_RULES_DEADLINE.
+DNS_QUERY_LIFETIME = 10
+IO_BOUND_REQUEST_TIMEOUT = 20
 LEVEN_DOMAIN_DISTANCE = 3
 SIMILAR_THRESHOLD = 0.95
 SIMILAR_ANSWER_THRESHOLD = 0.7
@@ -327,6 +338,82 @@ WHITELISTED_NS_HOSTNAMES = [
 ]
 
 
+class DomainWhitelist:
+    """
+    A single index of the domain whitelists used by the DNS based detections. Each whitelisted domain maps to the
+    names of the whitelists which contain it. A hostname is in a whitelist when it's listed or, for the whitelists
+    in INCLUDES_SUBDOMAINS, when one of its parent domains is listed, so a lookup costs one dict lookup per label
+    of the hostname. The metasmoke whitelist is merged in again whenever MetasmokeCache refreshes it.
+    """
+    ASN = 'asn'
+    IP = 'ip'
+    NS = 'ns'
+    METASMOKE = 'metasmoke'
+    INCLUDES_SUBDOMAINS = frozenset([ASN])
+    # Key: domain; Value: frozenset of whitelist names
+    _static_index = {}
+    _index = {}
+    _metasmoke_whitelist = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _add_domains(index, domains, whitelist_name):
+        for domain in domains:
+            domain = domain.lower()
+            index[domain] = index.get(domain, frozenset()) | {whitelist_name}
+
+    @staticmethod
+    def set_static_whitelists(whitelists):
+        """
+        Set the whitelists which don't come from metasmoke. whitelists is a dict of whitelist name: domains.
+        """
+        index = {}
+        for whitelist_name, domains in whitelists.items():
+            DomainWhitelist._add_domains(index, domains, whitelist_name)
+        with DomainWhitelist._lock:
+            DomainWhitelist._static_index = index
+            DomainWhitelist._metasmoke_whitelist = None
+            DomainWhitelist._index = index
+
+    @staticmethod
+    def _get_index(whitelist_names):
+        if DomainWhitelist.METASMOKE not in whitelist_names:
+            return DomainWhitelist._index
+        metasmoke_whitelist = metasmoke_cache.get_website_whitelist()
+        with DomainWhitelist._lock:
+            if metasmoke_whitelist is not DomainWhitelist._metasmoke_whitelist:
+                index = dict(DomainWhitelist._static_index)
+                DomainWhitelist._add_domains(index, metasmoke_whitelist or [], DomainWhitelist.METASMOKE)
+                DomainWhitelist._index = index
+                DomainWhitelist._metasmoke_whitelist = metasmoke_whitelist
+            return DomainWhitelist._index
+
+    @staticmethod
+    def is_whitelisted(hostname, *whitelist_names):
+        """
+        Check if hostname is in any of the named whitelists.
+        """
+        index = DomainWhitelist._get_index(whitelist_names)
+        domain = hostname.lower()
+        whitelists = index.get(domain, None)
+        if whitelists is not None and not whitelists.isdisjoint(whitelist_names):
+            return True
+        subdomain_whitelist_names = DomainWhitelist.INCLUDES_SUBDOMAINS.intersection(whitelist_names)
+        while subdomain_whitelist_names and '.' in domain:
+            domain = domain.split('.', 1)[1]
+            whitelists = index.get(domain, None)
+            if whitelists is not None and not whitelists.isdisjoint(subdomain_whitelist_names):
+                return True
+        return False
+
+
+DomainWhitelist.set_static_whitelists({
+    DomainWhitelist.ASN: ASN_WHITELISTED_WEBSITES,
+    DomainWhitelist.IP: WHITELISTED_IP_HOSTNAMES,
+    DomainWhitelist.NS: WHITELISTED_NS_HOSTNAMES,
+})
+
+
 if GlobalVars.perspective_key:
     PERSPECTIVE = "https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze?key=" + GlobalVars.perspective_key
     PERSPECTIVE_THRESHOLD = 0.85  # conservative
@@ -419,6 +506,62 @@ class PostFilter:
             return True
 
 
+class PostScanContext:
+    """
+    Work which is shared by many rules when scanning a single post: the cleaned body, the body with code
+    stripped and the links, hosts and domains found in each piece of text. Each value is computed when it's
+    first needed and is kept for the rest of the scan.
+
+    FindSpam.test_post() creates one for each post and passes it to Rule.match(), which makes it available
+    to the rule functions through PostScanContext.current().
+    """
+    _current = contextvars.ContextVar('PostScanContext', default=None)
+
+    def __init__(self, post):
+        self.post = post
+        # Key: tuple identifying the value; Value: the value.
+        # I/O bound rules run in other threads. Two threads may compute the same value, but setdefault() means
+        # they both end up using the same one.
+        self._values = {}
+
+    def get(self, key, compute, *args, **kwargs):
+        """
+        Get the value for key, calling compute(*args, **kwargs) to get it, if it hasn't already been computed.
+        """
+        try:
+            return self._values[key]
+        except KeyError:
+            return self._values.setdefault(key, compute(*args, **kwargs))
+
+    @staticmethod
+    def current():
+        """
+        Get the PostScanContext for the post which is being scanned in this thread, or None.
+        """
+        return PostScanContext._current.get()
+
+    def activate(self):
+        return PostScanContext._current.set(self)
+
+    @staticmethod
+    def deactivate(token):
+        PostScanContext._current.reset(token)
+
+    def get_cleaned_body(self):
+        return self.get(('cleaned body',), lambda: self.post.body.replace("&nsbp;", "").replace("\xAD", "")
+                        .replace("\u200B", "").replace("\u200C", ""))
+
+    def get_body_to_check(self, stripcodeblocks=False, strip_link_and_image_tags=False):
+        body = self.get_cleaned_body()
+        if stripcodeblocks:
+            # use a placeholder to avoid triggering "linked punctuation" on code-only links
+            body = self.get(('code stripped body',), strip_pre_and_code_elements, body, leave_note=True)
+        if strip_link_and_image_tags:
+            body = self.get(('link and image tags stripped body', stripcodeblocks),
+                            regex.sub, "<(?:a|img)[^>]+>", "", body)
+        return body
+
+
 class Rule:
     """
     A single spam-checking rule
@@ -428,7 +571,7 @@ class Rule:
 
     def __init__(self, item, reason, title=True, body=True, body_summary=True, username=True, filter=None,
                  stripcodeblocks=False, whole_post=False, skip_creation_sanity_check=False, rule_id=None,
-                 elapsed_time_reporting=None):
+                 elapsed_time_reporting=None, io_bound=False):
         self.regex = None
         self.func = None
         if isinstance(item, (str, URL_REGEX.__class__)):
@@ -445,6 +588,14 @@ class Rule:
         self.whole_post = whole_post
         self.rule_id = rule_id
         self.elapsed_time_reporting = elapsed_time_reporting
+        # I/O bound rules are run concurrently with the other rules. See FindSpam.test_post().
+        self.io_bound = io_bound
+        # When set, the regex is made from a list of entries and is matched using a literal prefilter.
+        # See _update_a_blacklist_dual_rule().
+        self.keyword_entries = None
+        self.keyword_regex_text_generator = None
+        # Held while compiling the regex, so it's only compiled once. See get_compiled_regex().
+        self.compiled_regex_lock = threading.Lock()
         if not skip_creation_sanity_check:
             self.sanity_check()
 
@@ -452,9 +603,9 @@ class Rule:
         if not self.func and not self.regex:
             raise TypeError("A rule must have either 'func' or 'regex' valid! : {}".format(self.reason))
 
-    def match(self, post):
+    def match(self, post, context=None):
         """
-        Run this rule against a post.
+        Run this rule against a post. The PostScanContext for the post is created, if it's not passed in.
 
         Returns a list of 3 tuples for [result_title, result_username, result_body],
         each in (match, reason, why) format
@@ -463,19 +614,22 @@ class Rule:
             # Post not matching the filter
             return [(False, "", "")] * 3
 
-        body_to_check = post.body.replace("&nsbp;", "").replace("\xAD", "") \
-                                 .replace("\u200B", "").replace("\u200C", "")
+        if context is None:
+            context = PostScanContext(post)
+        token = context.activate()
+        try:
+            return self._match(post, context)
+        finally:
+            PostScanContext.deactivate(token)
+
+    def _match(self, post, context):
         body_type = "body" if not post.is_answer else "answer"
         reason = self.reason
         reason_title = reason.replace("{}", "title")
         reason_username = reason.replace("{}", "username")
         reason_body = reason.replace("{}", body_type)
 
-        if self.stripcodeblocks:
-            # use a placeholder to avoid triggering "linked punctuation" on code-only links
-            body_to_check = strip_pre_and_code_elements(body_to_check, leave_note=True)
-        if reason == 'phone number detected in {}':
-            body_to_check = regex.sub("<(?:a|img)[^>]+>", "", body_to_check)
+        body_to_check = context.get_body_to_check(self.stripcodeblocks, reason == 'phone number detected in {}')
 
         matched_title, matched_username, matched_body = False, False, False
         result_title, result_username, result_body = None, None, None
@@ -513,11 +667,7 @@ class Rule:
                 else:
                     result_body = (False, "", "")
         elif self.regex:
-            try:
-                compiled_regex = self.compiled_regex
-            except AttributeError:
-                compiled_regex = regex_compile_no_cache(self.regex, regex.UNICODE, city=city_list, ignore_unused=True)
-                self.compiled_regex = compiled_regex
+            compiled_regex = self.get_compiled_regex()
 
             if self.title and not post.is_answer:
                 matches = list(compiled_regex.finditer(post.title))
@@ -547,6 +697,44 @@ class Rule:
         #                        (body_spam, body_reason, why))
         return result_title, result_username, result_body
 
+    def compile_regex(self):
+        if self.keyword_entries is not None:
+            # Provides a finditer() which produces the same matches as the full regex
+            return KeywordPrefilterMatcher(self.keyword_entries, self.keyword_regex_text_generator, city=city_list)
+        return regex_compile_no_cache(self.regex, regex.UNICODE, city=city_list, ignore_unused=True)
+
+    def get_compiled_regex(self):
+        try:
+            return self.compiled_regex
+        except AttributeError:
+            pass
+        with self.compiled_regex_lock:
+            # It may have been compiled while we were waiting for the lock.
+            try:
+                return self.compiled_regex
+            except AttributeError:
+                pass
+            regex_text = self.regex
+            self.compiled_regex = self.compile_regex()
+            self.compiled_regex_text = regex_text
+            return self.compiled_regex
+
+    def recompile_regex(self):
+        """
+        Compile the regex and then replace the compiled regex. Until then, any existing compiled regex continues
+        to be used, so that matching doesn't wait for the compilation.
+        """
+        with self.compiled_regex_lock:
+            regex_text = self.regex
+            if getattr(self, 'compiled_regex_text', None) == regex_text:
+                # Already compiled, e.g. by get_compiled_regex()
+                return
+            compiled_regex = self.compile_regex()
+            # Don't use the result if the regex was changed while compiling.
+            if regex_text == self.regex:
+                self.compiled_regex = compiled_regex
+                self.compiled_regex_text = regex_text
+
     def __call__(self, *args, **kwargs):
         # Preserve the functionality of a function
         if self.func:
@@ -582,6 +770,17 @@ class FindSpam:
         ('info', 'High ', 10),  # > 10 s: Log an "info" for the Rule and output to chat as "High "
         ('warning', '**Very High** ', 30),  # > 30 s: Log a "warning" and output to chat as bold "Very High"
     ]
+    # Rules which spend most of their time waiting on DNS or HTTP requests are run concurrently in this
+    # executor, while the other rules are run in the scan thread. The results from any of those rules which
+    # haven't completed within IO_BOUND_RULES_DEADLINE seconds of the start of the scan are discarded.
+    IO_BOUND_RULES_DEADLINE = 60
+    IO_BOUND_RULE_WORKERS = 20
+    io_bound_rule_executor = ThreadPoolExecutor(max_workers=IO_BOUND_RULE_WORKERS,
+                                                thread_name_prefix='FindSpam I/O bound rule')
+    # The number of rules which were still running at their deadline and haven't finished yet. Each one holds an
+    # io_bound_rule_executor worker, so if this gets close to IO_BOUND_RULE_WORKERS, I/O bound rules will be delayed.
+    abandoned_io_bound_rules = 0
+    abandoned_io_bound_rules_lock = threading.Lock()
 
     @staticmethod
     def _update_a_blacklist_dual_rule(rule_list, regex_text_generator, entries):
@@ -596,15 +795,28 @@ class FindSpam:
             entries_lists = [entries]
         if len(entries_lists) == 1:
             entries_lists.append([r'q(?<!q)'])
+        changed_rules = []
         for index in range(2):
             new_regex_text = regex_text_generator(entries_lists[index])
             if new_regex_text != rule_list[index].regex:
                 rule_list[index].regex = new_regex_text
-                try:
-                    del rule_list[index].compiled_regex
-                except AttributeError:
-                    pass
+                rule_list[index].keyword_entries = entries_lists[index]
+                rule_list[index].keyword_regex_text_generator = regex_text_generator
                 rule_list[index].sanity_check()
+                changed_rules.append(rule_list[index])
+        if changed_rules:
+            # Compile in the background, so the scans don't stall. Until the new regexes are ready, scans use the
+            # previous ones, if there are any. On a cold start there aren't any, so the first scans wait in
+            # get_compiled_regex() for the KeywordPrefilterMatcher to be built. That's faster than compiling the
+            # single alternation of all the entries, even without the cached literals, so isn't worth falling
+            # back to.
+            threading.Thread(name="recompile blacklist rules", target=FindSpam._recompile_rules,
+                             args=(changed_rules,), daemon=True).start()
+
+    @staticmethod
+    def _recompile_rules(rules):
+        for rule in rules:
+            rule.recompile_regex()
 
     @classmethod
     def reload_blacklists(cls):
@@ -630,36 +842,83 @@ class FindSpam:
             GlobalVars.watched_numbers_normalized = phone_numbers.process_numlist(GlobalVars.watched_numbers_raw)
         log('debug', "Global blacklists loaded")
 
+    @staticmethod
+    def _match_rule_timed(rule, post, context):
+        """ Run a Rule on a post, returning the Rule's results and the elapsed time """
+        start_time = time.time()
+        title, username, body = rule.match(post, context)
+        return title, username, body, time.time() - start_time
+
+    @staticmethod
+    def _abandoned_io_bound_rule_finished(future):
+        with FindSpam.abandoned_io_bound_rules_lock:
+            FindSpam.abandoned_io_bound_rules -= 1
+
+    @staticmethod
+    def _abandon_io_bound_rule(future):
+        """ Cancel a rule which missed its deadline, returning the number of abandoned rules still running """
+        if future.cancel():
+            with FindSpam.abandoned_io_bound_rules_lock:
+                return FindSpam.abandoned_io_bound_rules
+        with FindSpam.abandoned_io_bound_rules_lock:
+            FindSpam.abandoned_io_bound_rules += 1
+            abandoned_count = FindSpam.abandoned_io_bound_rules
+        # If it has finished in the meantime, this is called immediately.
+        future.add_done_callback(FindSpam._abandoned_io_bound_rule_finished)
+        return abandoned_count
+
+    @staticmethod
+    def _report_rule_elapsed_time(rule, elapsed_time, post_brief_id):
+        elapsed_time_draw_attention_min = FindSpam.ELAPSED_TIME_DRAW_ATTENTION_MIN
+        elapsed_time_levels = FindSpam.ELAPSED_TIME_LOG_AND_TELL_LEVELS
+        if type(rule.elapsed_time_reporting) is dict:
+            elapsed_time_draw_attention_min = rule.elapsed_time_reporting.get('draw_attention_min', 600)
+            elapsed_time_levels = rule.elapsed_time_reporting.get('levels', [])
+        draw_attention = ' <------------------' if elapsed_time > elapsed_time_draw_attention_min else ''
+        log_type = ''
+        tell_text = ''
+        for log_level, tell_level, minimum_elapsed_time in elapsed_time_levels:
+            if (elapsed_time >= minimum_elapsed_time):
+                log_type = log_level
+                tell_text = tell_level
+        if log_type or tell_text:
+            log_message = ('Rule elapsed time: {:.2f} s'.format(elapsed_time)
+                           + ': {}: {}'.format(rule.reason, rule.rule_id)
+                           + ' for [{}](https://{})'.format(post_brief_id, post_brief_id))
+            if log_type:
+                log(log_type, log_message + draw_attention)
+            if tell_text:
+                chatcommunicate.tell_rooms_with('long-rule-times', tell_text + log_message)
+
     @staticmethod
     def test_post(post):
         result = []
         why_title, why_username, why_body = [], [], []
         post_brief_id = "{}/{}/{}".format(post.post_site, "a" if post.is_answer else "q", post.post_id)
+        deadline = time.time() + FindSpam.IO_BOUND_RULES_DEADLINE
+        context = PostScanContext(post)
+        # I/O bound rules (DNS, HTTP) are started first, so they run while the CPU bound rules are run here.
+        # Rules which the post doesn't pass the filter for return immediately, so are just run in this thread.
+        io_bound_futures = []
+        other_rules = []
         for rule in FindSpam.rules:
-            start_time = time.time()
-            title, username, body = rule.match(post)
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            elapsed_time_draw_attention_min = FindSpam.ELAPSED_TIME_DRAW_ATTENTION_MIN
-            elapsed_time_levels = FindSpam.ELAPSED_TIME_LOG_AND_TELL_LEVELS
-            if type(rule.elapsed_time_reporting) is dict:
-                elapsed_time_draw_attention_min = rule.elapsed_time_reporting.get('draw_attention_min', 600)
-                elapsed_time_levels = rule.elapsed_time_reporting.get('levels', [])
-            draw_attention = ' <------------------' if elapsed_time > elapsed_time_draw_attention_min else ''
-            log_type = ''
-            tell_text = ''
-            for log_level, tell_level, minimum_elapsed_time in elapsed_time_levels:
-                if (elapsed_time >= minimum_elapsed_time):
-                    log_type = log_level
-                    tell_text = tell_level
-            if log_type or tell_text:
-                log_message = ('Rule elapsed time: {:.2f} s'.format(elapsed_time)
-                               + ': {}: {}'.format(rule.reason, rule.rule_id)
-                               + ' for [{}](https://{})'.format(post_brief_id, post_brief_id))
-                if log_type:
-                    log(log_type, log_message + draw_attention)
-                if tell_text:
-                    chatcommunicate.tell_rooms_with('long-rule-times', tell_text + log_message)
+            if rule.io_bound and rule.filter.match(post):
+                io_bound_futures.append((rule, FindSpam.io_bound_rule_executor.submit(FindSpam._match_rule_timed,
+                                                                                      rule, post, context)))
+            else:
+                other_rules.append(rule)
+        rule_results = [(rule, FindSpam._match_rule_timed(rule, post, context)) for rule in other_rules]
+        for rule, future in io_bound_futures:
+            try:
+                rule_results.append((rule, future.result(timeout=max(0, deadline - time.time()))))
+            except concurrent.futures.TimeoutError:
+                abandoned_count = FindSpam._abandon_io_bound_rule(future)
+                log('warning', 'Rule timed out after the {} s deadline: {}: {} for [{}](https://{})'.format(
+                    FindSpam.IO_BOUND_RULES_DEADLINE, rule.reason, rule.rule_id, post_brief_id, post_brief_id)
+                    + ': {} of {} I/O bound rule workers are held by rules which timed out'.format(
+                        abandoned_count, FindSpam.IO_BOUND_RULE_WORKERS))
+        for rule, (title, username, body, elapsed_time) in rule_results:
+            FindSpam._report_rule_elapsed_time(rule, elapsed_time, post_brief_id)
             if title[0]:
                 result.append(title[1])
                 why_title.append(title[2])
@@ -715,6 +974,7 @@ def create_rule(reason, regex=None, func=None, *, all=True, sites=[],
                 disabled=False,  # yeah, disabled=True is intuitive
                 rule_id=None,  # Unique rule ID [The "reason" may be on multiple rules; this is unique to the rule.]
                 elapsed_time_reporting=None,
+                io_bound=False,  # The rule spends most of its time waiting on DNS or HTTP requests
                 skip_creation_sanity_check=False):
     if not isinstance(reason, str):
         raise ValueError("reason must be a string")
@@ -744,7 +1004,7 @@ def create_rule(reason, regex=None, func=None, *, all=True, sites=[],
         rule = Rule(regex, reason=reason, filter=post_filter,
                     title=title, body=body, body_summary=body_summary, username=username,
                     stripcodeblocks=stripcodeblocks, skip_creation_sanity_check=skip_creation_sanity_check,
-                    rule_id=rule_id, elapsed_time_reporting=elapsed_time_reporting)
+                    rule_id=rule_id, elapsed_time_reporting=elapsed_time_reporting, io_bound=io_bound)
         if not disabled:
             FindSpam.rules.append(rule)
         return rule
@@ -760,7 +1020,7 @@ def create_rule(reason, regex=None, func=None, *, all=True, sites=[],
             rule = Rule(func, reason=reason, filter=post_filter, whole_post=whole_post,
                         title=title, body=body, body_summary=body_summary, username=username,
                         stripcodeblocks=stripcodeblocks, skip_creation_sanity_check=skip_creation_sanity_check,
-                        rule_id=rule_id, elapsed_time_reporting=elapsed_time_reporting)
+                        rule_id=rule_id, elapsed_time_reporting=elapsed_time_reporting, io_bound=io_bound)
             if not disabled:
                 FindSpam.rules.append(rule)
             return rule
@@ -781,7 +1041,8 @@ def create_multiple_rules(*args, rule_quantity=1, rule_id=None, **kwargs):
 
 def is_whitelisted_website(url):
     # Imported from method link_at_end
-    return bool(WHITELISTED_WEBSITES_REGEX.search(url)) or metasmoke_cache.is_website_whitelisted(url)
+    return bool(WHITELISTED_WEBSITES_REGEX.search(url)) or \
+        DomainWhitelist.is_whitelisted(url, DomainWhitelist.METASMOKE)
 
 
 def levenshtein(s1, s2):
@@ -1096,6 +1357,19 @@ def get_number_matches(candidates, normalized_candidates, deobfuscated_candidate
     return matches
 
 
+def get_number_candidates(s):
+    """
+    Get the phone number candidates in s, as returned by phone_numbers.get_all_candidates().
+
+    The blacklisted and watched number rules check the same text, so the candidates are kept in the
+    PostScanContext, when there is one.
+    """
+    context = PostScanContext.current()
+    if context is None:
+        return phone_numbers.get_all_candidates(s)
+    return context.get(('number candidates', s), phone_numbers.get_all_candidates, s)
+
+
 # noinspection PyMissingTypeHints
 def check_numbers(s, numlist, numlist_normalized=None):
     """
@@ -1106,7 +1380,7 @@ def check_numbers(s, numlist, numlist_normalized=None):
     """
     numlist_normalized = numlist_normalized or set()
     matches = []
-    candidates, normalized_candidates, deobfuscated_candidates = phone_numbers.get_all_candidates(s)
+    candidates, normalized_candidates, deobfuscated_candidates = get_number_candidates(s)
     matches = get_number_matches(candidates, normalized_candidates, deobfuscated_candidates,
                                  numlist, numlist_normalized)
     if matches:
@@ -1370,34 +1644,19 @@ def bad_pattern_in_url(s, site):
         return False, ""
 
 
-def purge_cache(cachevar, limit):
-    '''
-    Trim down cache variable to the specified number of newest entries.
-    '''
-    oldest = sorted(cachevar, key=lambda k: cachevar[k]['timestamp'])[0:limit + 1]
-    remaining = oldest.pop()
-    now = datetime.utcnow()
-    log('debug', 'purge_cache({0}): age of oldest entry is {1}'.format(
-        limit, now - cachevar[oldest[0]]['timestamp']))
-    log('debug', 'purge_cache({0}): oldest remaining entry is {1}'.format(
-        limit, now - cachevar[remaining]['timestamp']))
-    for old in oldest:
-        # Guard against KeyError; race condition?
-        if old in cachevar:
-            del cachevar[old]
-
-
-def dns_query(label, qtype):
-    # If there's no cache then assume *now* is important
+def dns_query(label, qtype, quiet=False):
+    # Results, including failures, are cached in DNSCache
     try:
         starttime = datetime.utcnow()
         # Extend lifetime if we are running a test
-        extra_params = dict()
+        extra_params = {'lifetime': DNS_QUERY_LIFETIME}
         if "pytest" in sys.modules:
             extra_params['lifetime'] = 20
-        answer = dns.resolver.resolve(label, qtype, search=True, **extra_params)
+        answer = DNSCache.resolve(label, qtype, **extra_params)
     except dns.exception.DNSException as exc:
-        if str(exc).startswith('None of DNS query names exist:'):
+        if quiet:
+            pass
+        elif str(exc).startswith('None of DNS query names exist:'):
             log('debug', 'DNS label {0} not found; skipping'.format(label))
         else:
             endtime = datetime.utcnow()
@@ -1408,20 +1667,90 @@ def dns_query(label, qtype):
     return answer
 
 
-def asn_query(ip):
+def asn_query(ip, quiet=False):
     '''
     http://www.team-cymru.com/IP-ASN-mapping.html
     '''
     pi = list(reversed(ip.split('.')))
-    asn = dns_query('.'.join(pi + ['origin.asn.cymru.com.']), 'txt')
+    asn = dns_query('.'.join(pi + ['origin.asn.cymru.com.']), 'txt', quiet=quiet)
     if asn is not None:
         for txt in set([str(x) for x in asn]):
-            log('debug', '{0}: Raw ASN lookup result: {1}'.format(ip, txt))
+            if not quiet:
+                log('debug', '{0}: Raw ASN lookup result: {1}'.format(ip, txt))
             if ' | ' in txt:
                 return txt.split(' | ')[0].strip('"')
     return None
 
 
+def _prefetch_dns_for_hosts(hostnames):
+    """
+    Concurrently make all the DNS queries which the DNS based rules will make for these hostnames.
+    """
+    def submit(func, *args):
+        future = DNS_PREFETCH_EXECUTOR.submit(func, *args, quiet=True)
+        futures[future] = (func, args)
+
+    futures = {}
+    # Hostnames for which asn_for_url_host() looks up the ASNs of the addresses
+    asn_hostnames = set()
+    for hostname in hostnames:
+        # Each DNS based rule skips the hostnames in its whitelists, so only look up what a rule will use.
+        skip_ns_is_host = DomainWhitelist.is_whitelisted(hostname, DomainWhitelist.METASMOKE)
+        skip_ip_for_url_host = DomainWhitelist.is_whitelisted(hostname, DomainWhitelist.IP)
+        skip_asn_for_url_host = skip_ns_is_host or DomainWhitelist.is_whitelisted(hostname, DomainWhitelist.ASN)
+        if not (skip_ns_is_host and skip_ip_for_url_host):
+            submit(dns_query, hostname, 'a')
+            if not skip_asn_for_url_host:
+                asn_hostnames.add(hostname)
+        fld = DomainParseCache.get_fld(hostname)
+        skip_ns_for_url_domain = (DomainWhitelist.is_whitelisted(hostname, DomainWhitelist.NS)
+                                  or (fld and DomainWhitelist.is_whitelisted(fld, DomainWhitelist.NS)))
+        if fld and not (skip_ns_for_url_domain and skip_ns_is_host and skip_ip_for_url_host):
+            submit(dns_query, fld, 'ns')
+    while futures:
+        done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            func, args = futures.pop(future)
+            answer = future.result()
+            if func is not dns_query or answer is None:
+                continue
+            label, qtype = args
+            if qtype == 'a' and label in asn_hostnames:
+                # asn_for_url_host()
+                for addr in set([str(x) for x in answer]):
+                    submit(asn_query, addr)
+            elif qtype == 'ns':
+                # get_ns_ips() and ns_for_url_domain()
+                for ns in answer:
+                    submit(dns_query, str(ns), 'a')
+
+
+def prefetch_dns_for_hosts(hostnames):
+    """
+    Fill DNSCache with the results of the queries which the DNS based rules make for the hostnames, by making
+    the queries concurrently, rather than one at a time in each rule. When called again for the same hostnames,
+    while a prefetch is in progress, this waits for that prefetch.
+    """
+    key = frozenset(hostnames)
+    if not key:
+        return
+    with DNS_PREFETCH_IN_FLIGHT_lock:
+        in_flight = DNS_PREFETCH_IN_FLIGHT.get(key, None)
+        is_owner = in_flight is None
+        if is_owner:
+            in_flight = threading.Event()
+            DNS_PREFETCH_IN_FLIGHT[key] = in_flight
+    if not is_owner:
+        in_flight.wait()
+        return
+    try:
+        _prefetch_dns_for_hosts(key)
+    finally:
+        with DNS_PREFETCH_IN_FLIGHT_lock:
+            del DNS_PREFETCH_IN_FLIGHT[key]
+        in_flight.set()
+
+
 def ns_for_url_domain(s, site, nslist):
     if "pytest" in sys.modules:
         for nsentry in nslist:
@@ -1434,9 +1763,11 @@ def ns_for_url_domain(s, site, nslist):
                 assert nsentry.endswith('.'), \
                     "Missing final dot on NS entry {0}".format(nsentry)
 
+    hostnames = post_hosts(s, check_tld=True)
+    prefetch_dns_for_hosts(hostnames)
     domains = []
-    for hostname in post_hosts(s, check_tld=True):
-        if hostname in WHITELISTED_NS_HOSTNAMES:
+    for hostname in hostnames:
+        if DomainWhitelist.is_whitelisted(hostname, DomainWhitelist.NS):
             continue
         try:
             domain_from_hostname = get_domain(hostname, full=True)
@@ -1445,17 +1776,14 @@ def ns_for_url_domain(s, site, nslist):
         domains.append(domain_from_hostname)
 
     for domain in set(domains):
-        if domain in WHITELISTED_NS_HOSTNAMES:
+        if DomainWhitelist.is_whitelisted(domain, DomainWhitelist.NS):
             continue
         ns = dns_query(domain, 'ns')
         if ns is not None:
             nameservers = set([server.target.to_text().lower() for server in ns])
-            for ns_candidate in nslist:
-                if (type(ns_candidate) is list and nameservers == set(ns_candidate)) \
-                    or any(ns.endswith('.{0}'.format(ns_candidate))
-                           for ns in nameservers):
-                    return True, '{domain} NS suspicious {ns}'.format(
-                        domain=domain, ns=','.join(nameservers))
+            if nslist.matches(nameservers):
+                return True, '{domain} NS suspicious {ns}'.format(
+                    domain=domain, ns=','.join(nameservers))
     return False, ""
 
 
@@ -1464,12 +1792,11 @@ def get_ns_ips(domain):
     Extract IP addresses of name server(s) for a domain
     """
     ns_ips = []
-    dom = tld.get_tld(
-        domain, fix_protocol=True, as_object=True, fail_silently=True)
-    if not dom:
+    fld = DomainParseCache.get_fld(domain)
+    if not fld:
         log('info', 'Could not get domain for %s' % (domain))
         return []
-    nameservers = dns_query(dom.fld, 'ns')
+    nameservers = dns_query(fld, 'ns')
     if nameservers is not None:
         log('info', 'Name servers: %s' % sorted(str(n) for n in nameservers))
         for ns in nameservers:
@@ -1479,14 +1806,17 @@ def get_ns_ips(domain):
     return ns_ips
 
 
-@create_rule("potentially problematic NS configuration in {}", stripcodeblocks=True, body_summary=True)
+@create_rule("potentially problematic NS configuration in {}", stripcodeblocks=True, body_summary=True,
+             io_bound=True)
 def ns_is_host(s, site):
     '''
     Check if the host name in a link resolves to the same IP address
     as the IP addresses of all its name servers.
     '''
-    for hostname in post_hosts(s, check_tld=True):
-        if metasmoke_cache.is_website_whitelisted(hostname):
+    hostnames = post_hosts(s, check_tld=True)
+    prefetch_dns_for_hosts(hostnames)
+    for hostname in hostnames:
+        if DomainWhitelist.is_whitelisted(hostname, DomainWhitelist.METASMOKE):
             continue
         host_ip = dns_query(hostname, 'a')
         if host_ip is None:
@@ -1502,48 +1832,56 @@ def ns_is_host(s, site):
     return False, ''
 
 
-@create_rule("bad NS for domain in {}", body_summary=True, stripcodeblocks=True)
+@create_rule("bad NS for domain in {}", body_summary=True, stripcodeblocks=True, io_bound=True)
 def bad_ns_for_url_domain(s, site):
     return ns_for_url_domain(s, site, GlobalVars.blacklisted_nses)
 
 
 # This applies to all answers, and non-SO questions
 @create_rule("potentially bad NS for domain in {}", body_summary=True, stripcodeblocks=True, answer=False,
-             sites=["stackoverflow.com"], rule_id="potentially bad NS for domain: questions only, not SO")
+             sites=["stackoverflow.com"], rule_id="potentially bad NS for domain: questions only, not SO",
+             io_bound=True)
 @create_rule("potentially bad NS for domain in {}", body_summary=True, stripcodeblocks=True, question=False,
-             rule_id="potentially bad NS for domain, answers only, all sites")
+             rule_id="potentially bad NS for domain, answers only, all sites", io_bound=True)
 def watched_ns_for_url_domain(s, site):
     return ns_for_url_domain(s, site, GlobalVars.watched_nses)
 
 
 def ip_for_url_host(s, site, ip_list):
     # ######## FIXME: code duplication
-    for hostname in post_hosts(s, check_tld=True):
-        if hostname in WHITELISTED_IP_HOSTNAMES:
+    hostnames = post_hosts(s, check_tld=True)
+    prefetch_dns_for_hosts(hostnames)
+    for hostname in hostnames:
+        if DomainWhitelist.is_whitelisted(hostname, DomainWhitelist.IP):
             continue
         a = dns_query(hostname, 'a')
         if a is not None:
-            # ######## TODO: allow blocking of IP ranges with regex or CIDR
             for addr in set([str(x) for x in a]):
                 log('debug', 'IP: IP {0} for hostname {1}'.format(
                     addr, hostname))
-                if addr in ip_list:
+                entry = ip_list.get_entry(addr)
+                if entry is not None:
                     return True, '{0} suspicious IP address {1}'.format(
-                        hostname, addr)
+                        hostname, describe_ip_list_entry(addr, entry))
         for ip in set(get_ns_ips(hostname)):
-            if ip in ip_list:
-                return True, '{0} suspicious IP address {1} for NS'.format(hostname, ip)
+            entry = ip_list.get_entry(ip)
+            if entry is not None:
+                return True, '{0} suspicious IP address {1} for NS'.format(hostname, describe_ip_list_entry(ip, entry))
     return False, ""
 
 
+def describe_ip_list_entry(ip, entry):
+    return ip if ip == entry else '{0} (in {1})'.format(ip, entry)
+
+
 @create_rule("potentially bad IP for hostname in {}",
-             stripcodeblocks=True, body_summary=True)
+             stripcodeblocks=True, body_summary=True, io_bound=True)
 def watched_ip_for_url_hostname(s, site):
     return ip_for_url_host(s, site, GlobalVars.watched_cidrs)
 
 
 @create_rule("bad IP for hostname in {}",
-             stripcodeblocks=True, body_summary=True)
+             stripcodeblocks=True, body_summary=True, io_bound=True)
 def bad_ip_for_url_hostname(s, site):
     return ip_for_url_host(
         s, site,
@@ -1551,9 +1889,10 @@ def bad_ip_for_url_hostname(s, site):
 
 
 def asn_for_url_host(s, site, asn_list):
-    for hostname in post_hosts(s, check_tld=True):
-        if any(hostname == x or hostname.endswith("." + x) or metasmoke_cache.is_website_whitelisted(hostname)
-               for x in ASN_WHITELISTED_WEBSITES):
+    hostnames = post_hosts(s, check_tld=True)
+    prefetch_dns_for_hosts(hostnames)
+    for hostname in hostnames:
+        if DomainWhitelist.is_whitelisted(hostname, DomainWhitelist.ASN, DomainWhitelist.METASMOKE):
             log('debug', 'Skipping ASN check for hostname {0}'.format(
                 hostname))
             continue
@@ -1569,7 +1908,7 @@ def asn_for_url_host(s, site, asn_list):
     return False, ""
 
 
-@create_rule("potentially bad ASN for hostname in {}", body_summary=True, stripcodeblocks=True)
+@create_rule("potentially bad ASN for hostname in {}", body_summary=True, stripcodeblocks=True, io_bound=True)
 def watched_asn_for_url_hostname(s, site):
     return asn_for_url_host(s, site, GlobalVars.watched_asns)
 
@@ -1640,17 +1979,7 @@ def character_utilization_ratio(s, site):
         return False, ""
 
 
-def post_links(post):
-    """
-    Helper function to extract URLs from a piece of HTML.
-    """
-    global LINK_CACHE
-
-    with LINK_CACHE_lock:
-        if post in LINK_CACHE:
-            log('debug', 'Returning cached links for post')
-            return LINK_CACHE[post]['links']
-
+def _get_post_links(post):
     # Fix stupid spammer tricks
     edited_post = post
     for p in COMMON_MALFORMED_PROTOCOLS:
@@ -1662,34 +1991,22 @@ def post_links(post):
             links.append(l)
         else:
             links.append(l[:-1])
+    return set(links)
 
-    with LINK_CACHE_lock:
-        if len(LINK_CACHE.keys()) >= 15:
-            log('debug', 'Trimming LINK_CACHE down to 5 entries')
-            purge_cache(LINK_CACHE, 10)
-            log('debug', 'LINK_CACHE purged')
-
-        linkset = set(links)
-        LINK_CACHE[post] = {'links': linkset, 'timestamp': datetime.utcnow()}
-        return linkset
 
+def post_links(post):
+    """
+    Helper function to extract URLs from a piece of HTML.
 
-def post_hosts(post, check_tld=False):
-    '''
-    Return list of hostnames from the post_links() output.
-
-    With check_tld=True, check if the links have valid TLDs; abandon and
-    return an empty result if too many do not (limit is currently hardcoded
-    at 3 invalid links).
-
-    Augment LINK_CACHE with parsed hostnames.
-    '''
-    global LINK_CACHE
+    The result is kept in the PostScanContext, when there is one.
+    """
+    context = PostScanContext.current()
+    if context is None:
+        return _get_post_links(post)
+    return context.get(('links', post), _get_post_links, post)
 
-    with LINK_CACHE_lock:
-        if post in LINK_CACHE and 'hosts' in LINK_CACHE[post]:
-            return LINK_CACHE[post]['hosts']
 
+def _get_post_hosts(post, check_tld):
     invalid_tld_count = 0
     hostnames = []
     for link in post_links(post):
@@ -1705,7 +2022,7 @@ def post_hosts(post, check_tld=False):
             continue
 
         if check_tld:
-            if not tld.get_tld(hostname, fix_protocol=True, fail_silently=True):
+            if not DomainParseCache.get_fld(hostname):
                 log('debug', '{0} has no valid tld; skipping'.format(hostname))
                 invalid_tld_count += 1
                 if invalid_tld_count > 3:
@@ -1715,11 +2032,23 @@ def post_hosts(post, check_tld=False):
                 continue
 
         hostnames.append(hostname)
+    return set(hostnames)
+
+
+def post_hosts(post, check_tld=False):
+    '''
+    Return list of hostnames from the post_links() output.
 
-    hostset = set(hostnames)
-    with LINK_CACHE_lock:
-        LINK_CACHE[post]['hosts'] = hostset
-    return hostset
+    With check_tld=True, check if the links have valid TLDs; abandon and
+    return an empty result if too many do not (limit is currently hardcoded
+    at 3 invalid links).
+
+    The result is kept in the PostScanContext, when there is one.
+    '''
+    context = PostScanContext.current()
+    if context is None:
+        return _get_post_hosts(post, check_tld)
+    return context.get(('hosts', post, check_tld), _get_post_hosts, post, check_tld)
 
 
 # noinspection PyMissingTypeHints
@@ -1761,41 +2090,95 @@ def similar_ratio(a, b):
     return SequenceMatcher(None, a.lower(), b.lower()).ratio()
 
 
-# noinspection PyMissingTypeHints
-def get_domain(s, full=False):
-    """
-    Extract the domain name; with full=True, keep the TLD tacked on.
-    """
+# fld: the domain with its TLD, if the TLD is valid, otherwise None
+# domain, full_domain: what get_domain() returns with full=False and full=True
+# exception: the exception get_domain() raises, if any
+DomainParse = namedtuple('DomainParse', ['fld', 'domain', 'full_domain', 'exception'])
+
+
+def _parse_domain(s):
     try:
         extract = tld.get_tld(s, fix_protocol=True, as_object=True, )
-        if full:
-            domain = extract.fld
-        else:
-            domain = extract.domain
+        return DomainParse(extract.fld, extract.domain, extract.fld, None)
     except TldDomainNotFound as e:
-        invalid_tld = RE_COMPILE.match(str(e)).group(1)
-        # Attempt to replace the invalid protocol
-        s1 = s.replace(invalid_tld, 'http', 1)
         try:
-            extract = tld.get_tld(s1, fix_protocol=True, as_object=True, )
-            if full:
-                domain = extract.fld
-            else:
-                domain = extract.domain
-        except TldDomainNotFound:
-            # Assume bad TLD and try one last fall back, just strip the trailing TLD and leading subdomain
-            parsed_uri = urlparse(s)
-            if len(parsed_uri.path.split(".")) >= 3:
-                if full:
-                    domain = '.'.join(parsed_uri.path.split(".")[1:])
+            invalid_tld = RE_COMPILE.match(str(e)).group(1)
+            # Attempt to replace the invalid protocol
+            s1 = s.replace(invalid_tld, 'http', 1)
+            try:
+                extract = tld.get_tld(s1, fix_protocol=True, as_object=True, )
+                return DomainParse(None, extract.domain, extract.fld, None)
+            except TldDomainNotFound:
+                # Assume bad TLD and try one last fall back, just strip the trailing TLD and leading subdomain
+                parsed_uri = urlparse(s)
+                if len(parsed_uri.path.split(".")) >= 3:
+                    return DomainParse(None, parsed_uri.path.split(".")[1],
+                                       '.'.join(parsed_uri.path.split(".")[1:]), None)
                 else:
-                    domain = parsed_uri.path.split(".")[1]
+                    return DomainParse(None, parsed_uri.path.split(".")[0], parsed_uri.path, None)
+        except Exception as exc:
+            return DomainParse(None, None, None, exc)
+    except Exception as exc:
+        return DomainParse(None, None, None, exc)
+
+
+class DomainParseCache:
+    """
+    A process wide LRU cache of the domain parts of hostnames and URLs, as used by get_domain(), post_hosts(),
+    get_ns_ips(), etc. Spam tends to reuse a small number of domains, so most parses are repeats.
+    """
+    MAXIMUM_ENTRIES = 20000
+    # Key: hostname or URL; Value: DomainParse
+    _cache = OrderedDict()
+    # Counted here, under _lock, rather than in GlobalVars.PostScanStat, which would have all the scan threads
+    # contending on the global stats lock. Reported by !!/stats.
+    _stats = {'hits': 0, 'misses': 0}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(s):
+        with DomainParseCache._lock:
+            parse = DomainParseCache._cache.get(s, None)
+            if parse is not None:
+                DomainParseCache._cache.move_to_end(s)
+                DomainParseCache._stats['hits'] += 1
             else:
-                if full:
-                    domain = parsed_uri.path
-                else:
-                    domain = parsed_uri.path.split(".")[0]
-    return domain
+                DomainParseCache._stats['misses'] += 1
+        if parse is None:
+            parse = _parse_domain(s)
+            with DomainParseCache._lock:
+                DomainParseCache._cache[s] = parse
+                while len(DomainParseCache._cache) > DomainParseCache.MAXIMUM_ENTRIES:
+                    DomainParseCache._cache.popitem(last=False)
+        return parse
+
+    @staticmethod
+    def get_fld(s):
+        """
+        Get the domain with its TLD, or None, if s doesn't have a valid TLD.
+        """
+        return DomainParseCache.get(s).fld
+
+    @staticmethod
+    def get_stats():
+        with DomainParseCache._lock:
+            return DomainParseCache._stats.copy()
+
+    @staticmethod
+    def clear():
+        with DomainParseCache._lock:
+            DomainParseCache._cache.clear()
+
+
+# noinspection PyMissingTypeHints
+def get_domain(s, full=False):
+    """
+    Extract the domain name; with full=True, keep the TLD tacked on.
+    """
+    parse = DomainParseCache.get(s)
+    if parse.exception is not None:
+        raise parse.exception.with_traceback(None)
+    return parse.full_domain if full else parse.domain
 
 
 # create_rule("answer similar to existing answer on post", whole_post=True, max_rep=52
@@ -1877,7 +2260,7 @@ def toxic_check(post):
         return False, False, False, ""
 
     try:
-        response = requests.post(PERSPECTIVE, timeout=GlobalVars.default_requests_timeout, json={
+        response = requests.post(PERSPECTIVE, timeout=IO_BOUND_REQUEST_TIMEOUT, json={
             "comment": {
                 "text": s
             },
@@ -1888,7 +2271,7 @@ def toxic_check(post):
                 }
             }
         }).json()
-    except (requests.exceptions.ConnectionError, ValueError):
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ValueError):
         return False, False, False, ""
 
     if "error" in response:
@@ -1906,7 +2289,8 @@ def toxic_check(post):
 
 
 if GlobalVars.perspective_key:  # don't bother if we don't have a key, since it's expensive
-    toxic_check = create_rule("toxic {} detected", func=toxic_check, whole_post=True, max_rep=101, max_score=2)
+    toxic_check = create_rule("toxic {} detected", func=toxic_check, whole_post=True, max_rep=101, max_score=2,
+                              io_bound=True)
 
 
 @create_rule("body starts with title and ends in URL", whole_post=True, answer=False,
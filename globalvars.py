@@ -55,7 +55,8 @@ def git_ref():
 class GlobalVars:
     on_windows = 'windows' in platform.platform().lower()
 
-    false_positives = []
+    # Key: (post_id, site); Value: None. Dicts are used as sets which keep the order the posts were added.
+    false_positives = {}
     whitelisted_users = set()
     blacklisted_users = dict()
     blacklisted_usernames = []
@@ -79,13 +80,17 @@ class GlobalVars:
     watched_numbers_full = None
     bad_keywords = []
     watched_keywords = {}
-    ignored_posts = []
-    auto_ignored_posts = []
+    # Key: (post_id, site); Value: None
+    ignored_posts = {}
+    # Key: (post_id, site); Value: datetime when the post was automatically ignored
+    auto_ignored_posts = {}
     startup_utc_date = datetime.utcnow()
     startup_utc = startup_utc_date.strftime("%H:%M:%S")
     latest_questions = []
     latest_questions_lock = threading.Lock()
     # recently_scanned_posts is not stored upon abnormal exit (exceptions, ctrl-C, etc.).
+    # Key: site; Value: recently_scanned_posts.RecentlyScannedPostsShard, which has its own lock.
+    # recently_scanned_posts_lock only guards adding shards and replacing/storing the whole dict.
     recently_scanned_posts = {}
     recently_scanned_posts_lock = threading.Lock()
     recently_scanned_posts_retention_time = 24 * 60 * 60  # 24 hours
@@ -140,8 +145,10 @@ class GlobalVars:
     bodyfetcher = None
     cookies = {}
     se_sites = []
-    why_data = []
-    notifications = []
+    # Key: "site/post_id"; Value: why text, oldest first
+    why_data = {}
+    # Key: (user_id, chat_site, room_id, se_site); Value: always_ping. See datahandling.add_to_notification_list()
+    notifications = {}
     listen_to_these_if_edited = []
     multiple_reporters = []
     api_calls_per_site = {}
@@ -351,6 +358,8 @@ class GlobalVars:
     dns_nameservers = config.get("dns_resolver", "system").lower()
     dns_cache_enabled = config.getboolean("dns_cache_enabled", fallback=True)
     dns_cache_interval = config.getfloat("dns_cache_cleanup_interval", fallback=300.0)
+    # Each recently scanned post takes a few hundred bytes, regardless of the post's size.
+    recently_scanned_posts_maximum_entries = config.getint("recently_scanned_posts_maximum_entries", fallback=500000)
 
     class MSStatus:
         """ Tracking metasmoke status """
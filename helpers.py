@@ -6,6 +6,7 @@ from datetime import datetime, timezone
 import time
 import importlib
 import threading
+import heapq
 # termcolor doesn't work properly in PowerShell or cmd on Windows, so use colorama.
 import platform
 platform_text = platform.platform().lower()
@@ -47,6 +48,10 @@ def exit_mode(*args, code=0):
         datahandling.store_post_scan_stats()
     except Exception:
         log_current_exception()
+    try:
+        datahandling.store_api_data()
+    except Exception:
+        log_current_exception()
     try:
         datahandling.store_recently_scanned_posts()
     except Exception:
@@ -270,17 +275,20 @@ core_files = {
     "apigetpost.py",
     "blacklists.py",
     "bodyfetcher.py",
+    "chat_user_cache.py",
     "chatcommands.py",
     "chatcommunicate.py",
     "chatexchange_extension.py",
     "datahandling.py",
     "deletionwatcher.py",
+    "dns_cache.py",
     "editwatcher.py",
     "excepthook.py",
     "flovis.py",
     "gitmanager.py",
     "globalvars.py",
     "helpers.py",
+    "keyword_prefilter.py",
     "metasmoke.py",
     "metasmoke_cache.py",
     "nocrash.py",
@@ -413,6 +421,113 @@ def chunk_list(list_in, chunk_size):
     return [list_in[i:i + chunk_size] for i in range(0, len(list_in), chunk_size)]
 
 
+class ExpiryIndex:
+    """
+    Finds which keys have expired without looking at all of them. This is a min-heap of (expiry time, key), with
+    the current expiry time of each key in a dict. Changing a key's expiry time pushes a new heap entry. The heap
+    entries which don't match the key's current expiry time are stale and are dropped when they reach the top of
+    the heap. This isn't thread safe: it's expected to be guarded by the lock for the data it indexes.
+    """
+    HEAP_SLACK = 64
+
+    def __init__(self, expiry_times=None):
+        # Key: key; Value: expiry time
+        self._expiry_times = dict(expiry_times or {})
+        self._heap = []
+        self._rebuild_heap()
+
+    def __len__(self):
+        return len(self._expiry_times)
+
+    def __contains__(self, key):
+        return key in self._expiry_times
+
+    def _rebuild_heap(self):
+        self._heap = [(expiry_time, key) for key, expiry_time in self._expiry_times.items()]
+        heapq.heapify(self._heap)
+
+    def set(self, key, expiry_time):
+        if self._expiry_times.get(key, None) == expiry_time:
+            return
+        self._expiry_times[key] = expiry_time
+        heapq.heappush(self._heap, (expiry_time, key))
+        if len(self._heap) > 2 * len(self._expiry_times) + self.HEAP_SLACK:
+            self._rebuild_heap()
+
+    def discard(self, key):
+        self._expiry_times.pop(key, None)
+
+    def get_oldest(self):
+        """
+        Get the (expiry time, key) with the earliest expiry time, or None, if there are no keys.
+        """
+        heap = self._heap
+        expiry_times = self._expiry_times
+        while heap:
+            expiry_time, key = heap[0]
+            if expiry_times.get(key, None) == expiry_time:
+                return expiry_time, key
+            heapq.heappop(heap)
+        return None
+
+    def pop_expired(self, now=None):
+        """
+        Remove and return the keys which have an expiry time which is less than or equal to now.
+        """
+        if now is None:
+            now = time.time()
+        heap = self._heap
+        expiry_times = self._expiry_times
+        expired = []
+        while heap and heap[0][0] <= now:
+            expiry_time, key = heapq.heappop(heap)
+            if expiry_times.get(key, None) == expiry_time:
+                del expiry_times[key]
+                expired.append(key)
+        return expired
+
+
+class TokenBucket:
+    """
+    A token bucket rate limiter. Tokens are added at rate tokens per second, up to capacity, and each action takes
+    one. block() empties the bucket and stops it refilling for a time, which is for when whatever we're modelling
+    tells us to wait anyway. This isn't thread safe: it's expected to be used by one thread.
+    """
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self._tokens = capacity
+        # The time from which tokens are added. This is in the future while the bucket is blocked.
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def get_delay(self, now=None):
+        """
+        Get the number of seconds until a token is available.
+        """
+        if now is None:
+            now = time.monotonic()
+        self._refill(now)
+        return max(0, self._updated - now) + max(0, (1 - self._tokens) / self.rate)
+
+    def take(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        self._refill(now)
+        self._tokens -= 1
+
+    def block(self, seconds, now=None):
+        if now is None:
+            now = time.monotonic()
+        self._refill(now)
+        self._tokens = 0
+        self._updated = max(self._updated, now + seconds)
+
+
 class SecurityError(Exception):
     pass
 
@@ -566,6 +681,167 @@ def recover_websocket(which_ws, ws, exception, connect_time, hb_time):
         raise
 
 
+def find_regex_closing_bracket(regex_text, index):
+    """
+    Get the index just past the end of the character class which starts at index.
+    """
+    index += 1
+    if regex_text[index:index + 1] == '^':
+        index += 1
+    if regex_text[index:index + 1] == ']':
+        index += 1
+    depth = 1
+    length = len(regex_text)
+    while index < length and depth:
+        character = regex_text[index]
+        if character == '\\':
+            index += 2
+            continue
+        if character == '[':
+            depth += 1
+        elif character == ']':
+            depth -= 1
+        index += 1
+    return index
+
+
+def find_regex_closing_parenthesis(regex_text, index):
+    """
+    Get the index just past the end of the group which starts at index.
+    """
+    index += 1
+    depth = 1
+    length = len(regex_text)
+    while index < length and depth:
+        character = regex_text[index]
+        if character == '\\':
+            index += 2
+            continue
+        if character == '[':
+            index = find_regex_closing_bracket(regex_text, index)
+            continue
+        if character == '(':
+            depth += 1
+        elif character == ')':
+            depth -= 1
+        index += 1
+    return index
+
+
+def regex_text_has_top_level_alternation(regex_text):
+    index = 0
+    length = len(regex_text)
+    while index < length:
+        character = regex_text[index]
+        if character == '\\':
+            index += 2
+            continue
+        if character == '[':
+            index = find_regex_closing_bracket(regex_text, index)
+            continue
+        if character == '(':
+            index = find_regex_closing_parenthesis(regex_text, index)
+            continue
+        if character == '|':
+            return True
+        index += 1
+    return False
+
+
+# Entries which the alternation factoring leaves as they are: inline flags which aren't scoped to a group and
+# backreferences, which could be affected by moving the entry.
+UNFACTORABLE_ENTRY_REGEX = regex.compile(r'\(\?[a-zA-Z0-9-]+\)|\\[1-9g]|\(\?P[=>]')
+QUANTIFIER_START_CHARACTERS = frozenset('?*+{')
+FIRST_CHARACTER_GROUP_STARTS = ('(?:', '(?-i:')
+
+
+def _get_factorable_first_character(entry):
+    """
+    Get the lower case first character of entry, if it's an ASCII letter or digit which isn't quantified,
+    otherwise None.
+    """
+    character = entry[:1]
+    if character.isascii() and character.isalnum() and entry[1:2] not in QUANTIFIER_START_CHARACTERS:
+        return character.lower()
+    return None
+
+
+def _get_first_character_key(entry):
+    """
+    Get the lower case character with which every match of entry starts, if that's easily found, otherwise None.
+    """
+    first_character = _get_factorable_first_character(entry)
+    if first_character is not None or not entry.startswith(FIRST_CHARACTER_GROUP_STARTS):
+        return first_character
+    end = find_regex_closing_parenthesis(entry, 0)
+    if entry[end:end + 1] in QUANTIFIER_START_CHARACTERS:
+        return None
+    body = entry[entry.index(':') + 1:end - 1]
+    if regex_text_has_top_level_alternation(body):
+        return None
+    return _get_first_character_key(body)
+
+
+def _factor_alternation(entries):
+    # At any position, alternatives which start with different characters can't both match, so, between entries
+    # whose first character isn't known, alternatives can be grouped by their first character without changing
+    # which alternative matches. Within a group, the entries stay in their original order. Returns the alternatives.
+    parts = []
+    groups = {}
+
+    def add_groups():
+        for first_character, items in groups.items():
+            rests = []
+            for is_rest, text in items + [(False, None)]:
+                if is_rest:
+                    rests.append(text)
+                    continue
+                if rests:
+                    rest_parts = _factor_alternation(rests) if len(rests) > 1 else rests
+                    if len(rest_parts) == 1:
+                        parts.append(first_character + rest_parts[0])
+                    else:
+                        parts.append("{}(?:{})".format(first_character, '|'.join(rest_parts)))
+                rests = []
+                if text is not None:
+                    parts.append(text)
+        groups.clear()
+
+    for entry in entries:
+        first_character = _get_first_character_key(entry)
+        if first_character is None:
+            add_groups()
+            parts.append(entry)
+        elif entry[:1].lower() == first_character:
+            groups.setdefault(first_character, []).append((True, entry[1:]))
+        else:
+            # The first character is inside a group, so it can't be factored out.
+            groups.setdefault(first_character, []).append((False, entry))
+    add_groups()
+    return parts
+
+
+def get_factored_case_insensitive_alternation(entries):
+    """
+    Join the entries into a case-insensitive alternation, with their common leading literal characters factored
+    out, e.g. ['abc', 'abd', 'x'] becomes 'ab(?:c|d)|x'. Within a (?i) regex, this matches the same text, at the
+    same positions, as '|'.join(entries), but tests each shared prefix once, rather than once per entry.
+    """
+    factorable = []
+    parts = []
+    for entry in entries:
+        if entry and not UNFACTORABLE_ENTRY_REGEX.search(entry) and not regex_text_has_top_level_alternation(entry):
+            factorable.append(entry)
+            continue
+        if factorable:
+            parts.extend(_factor_alternation(factorable))
+            factorable = []
+        parts.append(entry)
+    if factorable:
+        parts.extend(_factor_alternation(factorable))
+    return '|'.join(parts)
+
+
 # See PR 2322 for the reason for (?:^|\b) and (?:\b|$)
 # (?w:\b) is also useful
 KEYWORD_BOOKENDING_START = r"(?is)(?:^|\b|(?w:\b))(*PRUNE)"
@@ -579,7 +855,7 @@ def keyword_bookend_regex_text(regex_text):
 
 
 def get_bookended_keyword_regex_text_from_entries(entries):
-    return keyword_bookend_regex_text('|'.join(entries))
+    return keyword_bookend_regex_text(get_factored_case_insensitive_alternation(entries))
 
 
 def keyword_non_bookend_regex_text(regex_text):
@@ -587,4 +863,4 @@ def keyword_non_bookend_regex_text(regex_text):
 
 
 def get_non_bookended_keyword_regex_text_from_entries(entries):
-    return keyword_non_bookend_regex_text('|'.join(entries))
+    return keyword_non_bookend_regex_text(get_factored_case_insensitive_alternation(entries))
@@ -0,0 +1,336 @@
+# coding=utf-8
+# keyword_prefilter.py
+# Literal prefiltering for the large keyword alternation rules (bad_keywords.txt, watched_keywords.txt, etc.).
+#
+# Running a single regex made from tens of thousands of alternatives costs time for every alternative at every
+# position in the text. Most entries contain a run of literal characters which must appear in any text the entry
+# matches. We index the entries by that required literal, so that for each text only the entries whose literal is
+# present in the text, plus the entries from which no literal could be extracted, need to be run.
+import threading
+from collections import OrderedDict
+
+import regex
+
+from helpers import (log, regex_compile_no_cache, find_regex_closing_bracket, find_regex_closing_parenthesis,
+                     regex_text_has_top_level_alternation)
+
+
+# Entries with a required literal shorter than this are always run.
+MINIMUM_LITERAL_LENGTH = 3
+# Number of compiled regexes for candidate entry sets which are cached per matcher.
+CANDIDATE_REGEX_CACHE_SIZE = 256
+# Extracting the literals from the ~90k list entries takes most of the time needed to build the matchers, so the
+# literal for each entry is kept on disk. Change the version when get_required_literal() changes what it returns.
+LITERALS_CACHE_FILENAME = "keywordPrefilterLiterals.p"
+LITERALS_CACHE_VERSION = 2
+LITERALS_CACHE_MAXIMUM_ENTRIES = 250000
+
+QUANTIFIER_REGEX = regex.compile(r'\{(\d*)(?:,(\d*))?\}')
+VERBOSE_FLAG_REGEX = regex.compile(r'\(\?[a-zA-Z0-9-]*x[a-zA-Z0-9-]*[:)]')
+# regex's simple case folding makes (?i)i match U+0130, which str.casefold() turns into two characters.
+# U+017F and U+212A are handled by str.casefold().
+PREFILTER_TRANSLATION = str.maketrans({'İ': 'i'})
+
+
+def fold_text_for_prefilter(text):
+    """
+    Case fold text in the same way as the required literals, so a literal which can match case-insensitively
+    is always found in the folded text.
+    """
+    return text.translate(PREFILTER_TRANSLATION).casefold()
+
+
+def _is_usable_literal_character(character):
+    # Non-ASCII characters are only used when they have no case, so there's no question about how the
+    # regex package's case folding compares to str.casefold().
+    if character.isascii():
+        return True
+    return character == character.lower() == character.upper() == character.casefold()
+
+
+def _get_quantifier(regex_text, index):
+    """
+    Get the quantifier at index as (minimum repeats, index after the quantifier), or None, if there's no
+    quantifier. A '{' which isn't a counted repeat (e.g. a fuzzy constraint) is reported as having a minimum of 0,
+    and is skipped up to its matching '}', so nothing in it is taken as a literal.
+    """
+    character = regex_text[index:index + 1]
+    if character in ('?', '*'):
+        return 0, index + 1
+    if character == '+':
+        return 1, index + 1
+    if character == '{':
+        quantifier_match = QUANTIFIER_REGEX.match(regex_text, index)
+        if quantifier_match:
+            minimum = quantifier_match.group(1)
+            return (int(minimum) if minimum else 0), quantifier_match.end()
+        closing = regex_text.find('}', index)
+        return 0, (closing + 1 if closing >= 0 else len(regex_text))
+    return None
+
+
+def _get_group_body(regex_text, start, end):
+    """
+    Get the text of a group's contents, if the group's contents must match when the group matches.
+    Returns None for lookarounds, comments, conditionals, inline flags, verbs, etc.
+    """
+    body = regex_text[start + 1:end - 1]
+    if not body.startswith(('?', '*')):
+        # Capture group
+        return body
+    if body.startswith('*'):
+        # Backtracking control verb: (*PRUNE), (*SKIP), etc.
+        return None
+    flags_match = regex.match(r'\?(?:[a-zA-Z0-9]*(?:-[a-zA-Z0-9]*)?:|>|P?<\w+>)', body)
+    if flags_match:
+        return body[flags_match.end():]
+    return None
+
+
+def _get_literal_runs(regex_text, runs):
+    """
+    Add to runs the runs of literal characters which must appear in any match of regex_text, which
+    has no top-level alternation.
+    """
+    current = []
+
+    def end_run():
+        if current:
+            runs.append(''.join(current))
+            current.clear()
+
+    index = 0
+    length = len(regex_text)
+    while index < length:
+        character = regex_text[index]
+        literal = None
+        if character == '\\':
+            escaped = regex_text[index + 1:index + 2]
+            if not escaped:
+                return
+            if escaped.isalnum() or escaped == '_':
+                # Character class shorthand, anchor, named list, backreference, or a code point: not a literal
+                end_run()
+                index += 2
+                if escaped in 'pPNLg' and regex_text[index:index + 1] in ('{', '<'):
+                    closing = regex_text.find('}' if regex_text[index] == '{' else '>', index)
+                    index = closing + 1 if closing >= 0 else length
+                quantifier = _get_quantifier(regex_text, index)
+                if quantifier:
+                    index = quantifier[1]
+                continue
+            literal = escaped
+            index += 2
+        elif character == '[':
+            end_run()
+            index = find_regex_closing_bracket(regex_text, index)
+            quantifier = _get_quantifier(regex_text, index)
+            if quantifier:
+                index = quantifier[1]
+            continue
+        elif character == '(':
+            end_run()
+            end = find_regex_closing_parenthesis(regex_text, index)
+            body = _get_group_body(regex_text, index, end)
+            index = end
+            quantifier = _get_quantifier(regex_text, index)
+            minimum = 1
+            if quantifier:
+                minimum, index = quantifier
+            if body is not None and minimum > 0 and not regex_text_has_top_level_alternation(body):
+                _get_literal_runs(body, runs)
+            continue
+        elif character == '{':
+            end_run()
+            index = _get_quantifier(regex_text, index)[1]
+            continue
+        elif character in '.^$)|?*+':
+            end_run()
+            index += 1
+            continue
+        else:
+            literal = character
+            index += 1
+        if not _is_usable_literal_character(literal):
+            end_run()
+            continue
+        quantifier = _get_quantifier(regex_text, index)
+        if quantifier:
+            minimum, index = quantifier
+            if minimum > 0:
+                current.append(literal)
+            end_run()
+            continue
+        current.append(literal)
+    end_run()
+
+
+def get_required_literal(regex_text):
+    """
+    Get a (case folded) run of literal characters which must be present in any text which regex_text
+    matches. An empty string is returned when no such literal could be determined.
+    """
+    if VERBOSE_FLAG_REGEX.search(regex_text) or regex_text_has_top_level_alternation(regex_text):
+        return ''
+    runs = []
+    _get_literal_runs(regex_text, runs)
+    if not runs:
+        return ''
+    return max((fold_text_for_prefilter(run) for run in runs), key=len)
+
+
+# Key: entry; Value: the entry's required literal. None until loaded from disk.
+_literals_cache = None
+_literals_cache_lock = threading.Lock()
+
+
+def _load_literals_cache():
+    # This must not be a top-level import in order to avoid a circular import
+    import datahandling
+    if datahandling.has_pickle(LITERALS_CACHE_FILENAME):
+        try:
+            version, literals = datahandling.load_pickle(LITERALS_CACHE_FILENAME)
+            if version == LITERALS_CACHE_VERSION:
+                return literals
+        except Exception as exc:
+            log('warning', 'Unable to load {}: {!r}'.format(LITERALS_CACHE_FILENAME, exc))
+    return {}
+
+
+def _store_literals_cache(literals_cache):
+    import datahandling
+    try:
+        datahandling.dump_pickle(LITERALS_CACHE_FILENAME, (LITERALS_CACHE_VERSION, literals_cache))
+    except Exception as exc:
+        log('warning', 'Unable to save {}: {!r}'.format(LITERALS_CACHE_FILENAME, exc))
+
+
+def get_required_literals(entries):
+    """
+    Get the get_required_literal() for each of the entries, using the on-disk cache of the literals. Only entries
+    which haven't been seen before (e.g. new list entries) need their literal extracted.
+    """
+    global _literals_cache
+    with _literals_cache_lock:
+        if _literals_cache is None:
+            _literals_cache = _load_literals_cache()
+        literals_cache = _literals_cache
+        literals = []
+        missed = 0
+        for entry in entries:
+            literal = literals_cache.get(entry, None)
+            if literal is None:
+                literal = get_required_literal(entry)
+                literals_cache[entry] = literal
+                missed += 1
+            literals.append(literal)
+        if missed:
+            if len(literals_cache) > LITERALS_CACHE_MAXIMUM_ENTRIES:
+                # Keep only the entries which are in use
+                _literals_cache = dict(zip(entries, literals))
+            _store_literals_cache(_literals_cache)
+    return literals
+
+
+class KeywordPrefilterMatcher:
+    """
+    Produces the same matches as compiling regex_text_generator(entries) and running finditer(), but
+    only runs the entries which could match the text.
+
+    Entries without a usable required literal are combined into an "unfiltered" regex, which is run on every
+    text. The entries which pass the literal prefilter are combined, in their original order, into a "candidate"
+    regex. As long as the matches from those two regexes don't overlap, the combined result is identical to what
+    the single alternation of all the entries finds. If they do overlap, a regex with both sets of entries is used.
+    """
+
+    def __init__(self, entries, regex_text_generator, **compile_kwargs):
+        self.entries = list(entries)
+        self.regex_text_generator = regex_text_generator
+        self.compile_kwargs = compile_kwargs
+        self.literals = get_required_literals(self.entries)
+        self.unfiltered_indexes = []
+        # Key: the first MINIMUM_LITERAL_LENGTH characters of the literal; Value: list of entry indexes
+        self.literal_index = {}
+        for entry_index, literal in enumerate(self.literals):
+            if len(literal) < MINIMUM_LITERAL_LENGTH:
+                self.unfiltered_indexes.append(entry_index)
+            else:
+                self.literal_index.setdefault(literal[:MINIMUM_LITERAL_LENGTH], []).append(entry_index)
+        self.unfiltered_regex = self._compile_indexes(self.unfiltered_indexes)
+        self._candidate_regex_cache = OrderedDict()
+        # Also guards stats, which is updated from the scan threads
+        self._candidate_regex_cache_lock = threading.Lock()
+        self.stats = {'texts': 0, 'candidates': 0, 'overlaps': 0}
+
+    def _compile_indexes(self, indexes):
+        if not indexes:
+            return None
+        regex_text = self.regex_text_generator([self.entries[index] for index in indexes])
+        return regex_compile_no_cache(regex_text, regex.UNICODE, ignore_unused=True, **self.compile_kwargs)
+
+    def _get_regex_for_indexes(self, indexes):
+        key = tuple(indexes)
+        with self._candidate_regex_cache_lock:
+            compiled = self._candidate_regex_cache.get(key, None)
+            if compiled is not None:
+                self._candidate_regex_cache.move_to_end(key)
+                return compiled
+        compiled = self._compile_indexes(indexes)
+        with self._candidate_regex_cache_lock:
+            self._candidate_regex_cache[key] = compiled
+            while len(self._candidate_regex_cache) > CANDIDATE_REGEX_CACHE_SIZE:
+                self._candidate_regex_cache.popitem(last=False)
+        return compiled
+
+    def _add_stats(self, **new_stats):
+        with self._candidate_regex_cache_lock:
+            for key, value in new_stats.items():
+                self.stats[key] += value
+
+    def get_stats(self):
+        with self._candidate_regex_cache_lock:
+            return self.stats.copy()
+
+    def get_candidate_indexes(self, text):
+        """
+        Get the indexes of the entries which have a required literal which is in the text.
+        """
+        folded = fold_text_for_prefilter(text)
+        literal_index = self.literal_index
+        literals = self.literals
+        keys = {folded[index:index + MINIMUM_LITERAL_LENGTH]
+                for index in range(len(folded) - MINIMUM_LITERAL_LENGTH + 1)}
+        candidates = []
+        for key in keys:
+            for entry_index in literal_index.get(key, ()):
+                if literals[entry_index] in folded:
+                    candidates.append(entry_index)
+        candidates.sort()
+        return candidates
+
+    def finditer(self, text):
+        """
+        Get a list of the matches, identical to list(compiled_regex.finditer(text)) for the full regex.
+        """
+        candidates = self.get_candidate_indexes(text)
+        self._add_stats(texts=1, candidates=len(candidates))
+        unfiltered_matches = list(self.unfiltered_regex.finditer(text)) if self.unfiltered_regex else []
+        if not candidates:
+            return unfiltered_matches
+        candidate_matches = list(self._get_regex_for_indexes(candidates).finditer(text))
+        if not unfiltered_matches:
+            return candidate_matches
+        if not candidate_matches:
+            return unfiltered_matches
+        matches = sorted(unfiltered_matches + candidate_matches, key=lambda match: match.span())
+        for previous, following in zip(matches, matches[1:]):
+            if previous.end() > following.start() or previous.start() == following.start():
+                break
+        else:
+            if all(match.end() > match.start() for match in matches):
+                return matches
+        # The two sets of matches interact, so we can't be sure they are the same as the full regex would find.
+        self._add_stats(overlaps=1)
+        log('debug', 'KeywordPrefilterMatcher: overlapping matches: using combined regex')
+        combined_indexes = sorted(self.unfiltered_indexes + candidates)
+        return list(self._get_regex_for_indexes(combined_indexes).finditer(text))
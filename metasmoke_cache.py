@@ -163,10 +163,16 @@ def dump_cache_data():
                              {'cache': MetasmokeCache._cache, 'expiries': MetasmokeCache._expiries})
 
 
-def is_website_whitelisted(domain):
+def get_website_whitelist():
+    """
+    Get the list of domains whitelisted on metasmoke, or None, if it isn't available. A new list is returned each
+    time the cached value is refreshed.
+
+    :returns: list or None
+    """
     whitelist, hit_info = MetasmokeCache.fetch_from_api('whitelisted-domains',
                                                         '/api/v2.0/tags/name/whitelisted/domains',
                                                         params={'filter': 'MFILNMJJGMMLLJ', 'per_page': '100'},
                                                         expiry=3600,
                                                         property_as_list='domain')
-    return whitelist is not None and len(whitelist) > 0 and isinstance(whitelist, list) and domain.lower() in whitelist
+    return whitelist if isinstance(whitelist, list) else None
@@ -32,6 +32,15 @@ NUMBER_REGEX_MIDDLE_TEXT = r'(?:\d(?:[\W_]*+|\D(?:(?=\d)|(?<=\d\D)))){{{}}}'
 NUMBER_REGEX_END_TEXT = r'\d(?=\D|$)'
 
 
+# get_candidates() splits the text into runs of these digits and the gaps between them.
+CANDIDATE_DIGITS_REGEX = regex.compile(r'[0-9]+')
+# A candidate can't extend across a gap of more than this many characters, nor across a gap which has more than
+# one ASCII letter. The length limit is moderately high, in order to account for potential zalgo text and/or
+# combining characters, which would leave the number still readable by humans.
+CANDIDATE_MAXIMUM_GAP_LENGTH = 50
+CANDIDATE_GAP_TOO_MANY_ALPHA_REGEX = regex.compile(r'[A-Za-z][^A-Za-z]*[A-Za-z]')
+
+
 def get_number_regex_with_quantfier(quantifier):
     return NUMBER_REGEX_START_TEXT + NUMBER_REGEX_MIDDLE_TEXT.format(quantifier) + NUMBER_REGEX_END_TEXT
 
@@ -161,113 +170,41 @@ def get_candidates(text, also_normalized=False):
     #      result. In the meantime, normalized matching has been improved and more emphasis placed on it.
     #   3. The regex version routinely returned duplicate entries. This implementation only returns duplicate
     #      entries if there are duplicates in the input text.
+    #
+    # The text is split into runs of digits and the gaps between them. A candidate is the text from the start
+    # of one run (including up to two VALID_NON_DIGIT_START_CHARACTERS directly before it) to the end of the
+    # same or a later run, with NUMBER_REGEX_MINIMUM_DIGITS to NUMBER_REGEX_MAXIMUM_DIGITS digits in total.
+    # Candidates don't extend across a gap which is too long or has too many ASCII letters, nor across a run of
+    # more than NUMBER_REGEX_MAXIMUM_DIGITS digits.
     candidates = []
     candidates_normalized = []
-    in_process_normalized = []
+    # The runs which can still start a candidate, as (start index in text, digit count, digits)
     in_process = []
-    in_process_digit_counts = []
-    non_digits = ''
-    prev_non_digit = ''
-    prev_prev_non_digit = ''
-    digits = ''
-    # alpha_count is, primarily, the number of alpha characters encountered since the last digit. However, it's
-    # also used as a flag, by setting alpha_count = max_alpha + 1, to indicate that some other criteria has
-    # been reached which should cause the same behavior.
-    # Specifically, it's used for when len_digits > NUMBER_REGEX_MAXIMUM_DIGITS or when
-    # len(non_digits) > max_non_digits.
-    alpha_count = 0
-    max_alpha = 1
-    # max_non_digits is moderately high, but is intended to account for potential zalgo text, and/or
-    # combining characters, which would leave the number still readable by humans.
-    max_non_digits = 50
-
-    def promote_any_in_process_with_appropriate_digit_count():
-        for index in range(len(in_process)):
-            cur_count = in_process_digit_counts[index]
-            if cur_count >= NUMBER_REGEX_MINIMUM_DIGITS and cur_count <= NUMBER_REGEX_MAXIMUM_DIGITS:
-                candidates.append(in_process[index])
-                if in_process_normalized[index][0] != 'z':
-                    # The 'z' at the start is used as a flag that this isn't a valid normalized entry.
-                    candidates_normalized.append(in_process_normalized[index])
-
-    def evict_any_in_process_with_too_many_digits():
-        for index in reversed(range(len(in_process))):
-            if in_process_digit_counts[index] > NUMBER_REGEX_MAXIMUM_DIGITS:
-                del in_process[index]
-                del in_process_normalized[index]
-                del in_process_digit_counts[index]
-
-    def clear_in_process_if_more_than_limit_alpha():
-        nonlocal in_process
-        nonlocal in_process_normalized
-        nonlocal in_process_digit_counts
-        if in_process and alpha_count > max_alpha:
-            # No sequences continue passed limit alpha characters
-            in_process_normalized = []
+    gap_start = 0
+    for digits_match in CANDIDATE_DIGITS_REGEX.finditer(text):
+        start, end = digits_match.span()
+        digits = digits_match.group()
+        gap = text[gap_start:start]
+        gap_start = end
+        if in_process and (len(gap) > CANDIDATE_MAXIMUM_GAP_LENGTH or CANDIDATE_GAP_TOO_MANY_ALPHA_REGEX.search(gap)):
+            in_process = []
+        len_digits = len(digits)
+        if len_digits > NUMBER_REGEX_MAXIMUM_DIGITS:
             in_process = []
-            in_process_digit_counts = []
-
-    def if_digits_add_digits_to_all_in_process_and_promote():
-        nonlocal in_process
-        nonlocal in_process_normalized
-        nonlocal in_process_digit_counts
-        nonlocal digits
-        nonlocal alpha_count
-        nonlocal prev_non_digit
-        nonlocal prev_prev_non_digit
-        if digits:
-            len_digits = len(digits)
-            if len_digits > NUMBER_REGEX_MAXIMUM_DIGITS:
-                # Too many digits. No need to try adding them, nor remembering the next alpha chars
-                alpha_count = max_alpha + 1
-                clear_in_process_if_more_than_limit_alpha()
-            else:
-                in_process = [to_add + digits for to_add in in_process]
-                in_process_normalized = [to_add + digits for to_add in in_process_normalized]
-                in_process_digit_counts = [to_add + len_digits for to_add in in_process_digit_counts]
-                # The original regex was written so that if a sequence started with '+(123...', then
-                # both '+(123...' and '(123...' ended up as candidates.
-                if prev_non_digit in VALID_NON_DIGIT_START_CHARACTERS:
-                    if prev_prev_non_digit in VALID_NON_DIGIT_START_CHARACTERS:
-                        in_process.append(prev_prev_non_digit + prev_non_digit + digits)
-                    else:
-                        in_process.append(prev_non_digit + digits)
-                else:
-                    in_process.append(digits)
-                in_process_normalized.append(digits)
-                in_process_digit_counts.append(len_digits)
-                promote_any_in_process_with_appropriate_digit_count()
-                evict_any_in_process_with_too_many_digits()
-            digits = ''
-            prev_non_digit = ''
-            prev_prev_non_digit = ''
-
-    for char in text:
-        if char >= '0' and char <= '9':
-            # It's a digit
-            digits += char
-            alpha_count = 0
-            if non_digits:
-                in_process = [to_add + non_digits for to_add in in_process]
-                non_digits = ''
-        else:
-            # Not a digit
-            if_digits_add_digits_to_all_in_process_and_promote()
-            prev_prev_non_digit = prev_non_digit
-            prev_non_digit = char
-            if (char >= 'A' and char <= 'Z') or (char >= 'a' and char <= 'z'):
-                alpha_count += 1
-                clear_in_process_if_more_than_limit_alpha()
-            if alpha_count > max_alpha:
-                non_digits = ''
-            else:
-                non_digits += char
-                if len(non_digits) > max_non_digits:
-                    alpha_count = max_alpha + 1  # Secondary use is as a flag that all in_process should end.
-                    clear_in_process_if_more_than_limit_alpha()
-                    non_digits = ''
-    if_digits_add_digits_to_all_in_process_and_promote()
-    # We can look at returning the normalized in a bit
+            continue
+        # The original regex was written so that if a sequence started with '+(123...', then
+        # both '+(123...' and '(123...' ended up as candidates. An empty string is "in" any string, so
+        # this also covers runs at the start of the text.
+        if gap[-1:] in VALID_NON_DIGIT_START_CHARACTERS:
+            start -= len(gap[-2:]) if gap[-2:-1] in VALID_NON_DIGIT_START_CHARACTERS else 1
+        in_process = [(in_process_start, digit_count + len_digits, in_process_digits + digits)
+                      for in_process_start, digit_count, in_process_digits in in_process
+                      if digit_count + len_digits <= NUMBER_REGEX_MAXIMUM_DIGITS]
+        in_process.append((start, len_digits, digits))
+        for in_process_start, digit_count, in_process_digits in in_process:
+            if digit_count >= NUMBER_REGEX_MINIMUM_DIGITS:
+                candidates.append(text[in_process_start:end])
+                candidates_normalized.append(in_process_digits)
     if also_normalized:
         return candidates, candidates_normalized
     return candidates
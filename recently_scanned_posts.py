@@ -1,20 +1,68 @@
 # coding=utf-8
+import hashlib
+import threading
 import time
 
 from globalvars import GlobalVars
-from helpers import log
+from helpers import log, ExpiryIndex
 from tasks import Tasks
 
 
 POST_STRAIGHT_COPY_KEYS = [
     'response_timestamp',
     'last_edit_date',
+]
+# Whether these have changed is all that's needed, so only a digest of each is kept.
+POST_DIGEST_KEYS = [
     'title',
+    'owner_name',
     'body_markdown',
 ]
+FIELD_DIGEST_SIZE = 8
+NONE_FIELD_DIGEST = bytes(FIELD_DIGEST_SIZE)
 POSTS_EXPIRE_INTERVAL = 10 * 60  # 10 minutes
 
 
+class RecentlyScannedPost:
+    """
+    What's kept about a recently scanned post. Instead of the post's title, owner name and body, there's a fixed
+    size digest of each, so a record takes roughly the same small amount of memory, regardless of the post's size.
+    """
+    __slots__ = ('response_timestamp', 'last_edit_date', 'content_digest', 'scan_timestamp', 'is_spam', 'reasons',
+                 'why', 'scan_time')
+
+    def __init__(self, rs_post, is_spam=None, reasons=None, why=None, scan_time=None):
+        self.response_timestamp = rs_post.get('response_timestamp', None)
+        self.last_edit_date = rs_post.get('last_edit_date', None)
+        self.content_digest = rs_post.get('content_digest', None)
+        self.scan_timestamp = time.time()
+        self.is_spam = is_spam
+        self.reasons = reasons
+        self.why = why
+        self.scan_time = scan_time
+
+    def __getstate__(self):
+        # A tuple pickles much smaller than the default dict of slot names to values.
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+
+def get_field_digest(value):
+    if value is None:
+        return NONE_FIELD_DIGEST
+    return hashlib.blake2b(str(value).encode('utf-8', 'surrogatepass'), digest_size=FIELD_DIGEST_SIZE).digest()
+
+
+def get_content_digest(fields):
+    """
+    Get the digests of the POST_DIGEST_KEYS values in the dict fields, joined together.
+    """
+    return b''.join(get_field_digest(fields.get(key, None)) for key in POST_DIGEST_KEYS)
+
+
 def get_key_for_post(post):
     if 'is_recently_scanned_post' in post:
         return post.get('post_key', None)
@@ -29,77 +77,160 @@ def get_key_for_post(post):
     return "{}/{}".format(site, post_id)
 
 
+class RecentlyScannedPostsShard:
+    """
+    The recently scanned posts for one site, with the lock which guards them. expiry_index indexes the posts by
+    scan_timestamp, so expiring posts only touches the posts which are expired. Unless noted otherwise, the caller
+    must hold the lock.
+    """
+
+    def __init__(self, posts=None):
+        self.lock = threading.Lock()
+        # Key: "site/post_id"; Value: RecentlyScannedPost
+        self.posts = {} if posts is None else posts
+        self.expiry_index = ExpiryIndex({key: record.scan_timestamp for key, record in self.posts.items()})
+
+    def __getstate__(self):
+        # Only the posts are stored. This acquires the lock.
+        with self.lock:
+            return dict(self.posts)
+
+    def __setstate__(self, posts):
+        self.__init__(posts)
+
+    def update_expiry(self, key, record):
+        self.expiry_index.set(key, record.scan_timestamp)
+
+    def store(self, key, record):
+        self.posts[key] = record
+        self.update_expiry(key, record)
+
+    def get_oldest_timestamp(self):
+        """
+        Get the scan_timestamp of the oldest post, or None, if there are no posts.
+        """
+        oldest = self.expiry_index.get_oldest()
+        return None if oldest is None else oldest[0]
+
+    def remove_oldest(self, before=None):
+        """
+        Remove the oldest post, if there is one and, when before is provided, its scan_timestamp is less than before.
+        Returns True, if a post was removed.
+        """
+        oldest = self.expiry_index.get_oldest()
+        if oldest is None or (before is not None and oldest[0] >= before):
+            return False
+        key = oldest[1]
+        self.expiry_index.discard(key)
+        del self.posts[key]
+        return True
+
+
+def get_shard(post_key):
+    """
+    Get the RecentlyScannedPostsShard for the site of the post_key, creating it if needed. The caller must not hold
+    any shard's lock.
+    """
+    site = post_key.partition('/')[0]
+    shard = GlobalVars.recently_scanned_posts.get(site, None)
+    if shard is None:
+        with GlobalVars.recently_scanned_posts_lock:
+            shard = GlobalVars.recently_scanned_posts.setdefault(site, RecentlyScannedPostsShard())
+    return shard
+
+
+def get_recently_scanned_post_count():
+    return sum(len(shard.posts) for shard in list(GlobalVars.recently_scanned_posts.values()))
+
+
 def add_post(post, is_spam=None, reasons=None, why=None, scan_time=None, have_lock=None):
+    """
+    Add the post. have_lock indicates that the caller holds the lock for the post's shard.
+    """
     if 'is_recently_scanned_post' not in post:
         post = get_recently_scanned_post_from_post(post)
     new_key = post['post_key']
     if new_key is None:
         raise KeyError('post key is None')
-    new_record = {'post': post, 'scan_timestamp': time.time(),
-                  'is_spam': is_spam, 'reasons': reasons, 'why': why,
-                  'scan_time': scan_time}
+    new_record = RecentlyScannedPost(post, is_spam=is_spam, reasons=reasons, why=why, scan_time=scan_time)
+    shard = get_shard(new_key)
     if have_lock:
-        GlobalVars.recently_scanned_posts[new_key] = new_record
+        shard.store(new_key, new_record)
+        evict_posts_over_maximum_entries(shard)
     else:
-        with GlobalVars.recently_scanned_posts_lock:
-            GlobalVars.recently_scanned_posts[new_key] = new_record
+        with shard.lock:
+            shard.store(new_key, new_record)
+            evict_posts_over_maximum_entries(shard)
+
+
+def evict_posts_over_maximum_entries(shard):
+    """
+    While there are more than GlobalVars.recently_scanned_posts_maximum_entries posts across all sites, remove the
+    oldest posts from the shard, keeping at least its newest post, so there can be up to one post per site beyond the
+    maximum. The caller must hold the shard's lock. The other shards are only counted, so their locks aren't needed.
+    """
+    excess = get_recently_scanned_post_count() - GlobalVars.recently_scanned_posts_maximum_entries
+    while excess > 0 and len(shard.posts) > 1 and shard.remove_oldest():
+        excess -= 1
 
 
 def apply_timestamps_to_entry_from_post_and_time_if_newer(post, scanned_entry):
-    scanned_post = scanned_entry['post']
-    scanned_post_reponse_timestamp = scanned_post.get('response_timestamp', 0)
+    """
+    Returns True, if the entry's timestamps were changed. The entry's shard then needs to be told about the new
+    scan_timestamp, using update_expiry().
+    """
+    scanned_post_reponse_timestamp = scanned_entry.response_timestamp or 0
     post_reponse_timestamp = post.get('response_timestamp', 0)
     if post_reponse_timestamp > scanned_post_reponse_timestamp:
-        scanned_entry['scan_timestamp'] = time.time()
-        scanned_entry['post']['response_timestamp'] = post.get('response_timestamp', None)
+        scanned_entry.scan_timestamp = time.time()
+        scanned_entry.response_timestamp = post.get('response_timestamp', None)
+        return True
+    return False
 
 
 def update_entry_timestamp_if_newer(post, have_lock=None):
     key = get_key_for_post(post)
     if key is None:
         raise KeyError('post key is None')
+    shard = get_shard(key)
+
+    def update_entry():
+        rs_entry = shard.posts[key]
+        if apply_timestamps_to_entry_from_post_and_time_if_newer(post, rs_entry):
+            shard.update_expiry(key, rs_entry)
+
     try:
         if have_lock:
-            rs_entry = GlobalVars.recently_scanned_posts[key]
-            apply_timestamps_to_entry_from_post_and_time_if_newer(post, rs_entry)
+            update_entry()
         else:
-            with GlobalVars.recently_scanned_posts_lock:
-                rs_entry = GlobalVars.recently_scanned_posts[key]
-                apply_timestamps_to_entry_from_post_and_time_if_newer(post, rs_entry)
+            with shard.lock:
+                update_entry()
     except KeyError:
         # If the record doesn't exist, we add it.
         add_post(post, have_lock=have_lock)
 
 
-def get_check_equality_data(post):
-    return (
-        post.get('last_edit_date', None),
-        post.get('title', None),
-        post.get('owner_name', None),
-        post.get('body_markdown', None),
-    )
-
-
-def compare_posts(post, scanned_post):
+def compare_posts(post, scanned_entry):
     result = {}
     post_resonse_timestamp = post.get('response_timestamp', 0)
-    scanned_post_resonse_timestamp = scanned_post.get('response_timestamp', 0)
+    scanned_post_resonse_timestamp = scanned_entry.response_timestamp or 0
     post_is_older = post_resonse_timestamp < scanned_post_resonse_timestamp
     result['is_older'] = post_is_older
     if post_is_older:
         result['is_older_or_unchanged'] = True
         return result
-    scanned_equality_data = get_check_equality_data(scanned_post)
-    post_equality_data = get_check_equality_data(post)
-    scanned_equality_data = get_check_equality_data(scanned_post)
-    is_unchanged = post_equality_data == scanned_equality_data
+    post_last_edit_date = post.get('last_edit_date', None)
+    post_content_digest = post.get('content_digest', None)
+    is_unchanged = (post_last_edit_date == scanned_entry.last_edit_date
+                    and post_content_digest == scanned_entry.content_digest)
     result['is_unchanged'] = is_unchanged
     result['is_older_or_unchanged'] = is_unchanged or post_is_older
     result['is_grace_edit'] = False
-    if not is_unchanged and post_equality_data[0] == scanned_equality_data[0]:
+    if not is_unchanged and post_last_edit_date == scanned_entry.last_edit_date:
         # This should be a grace period edit
-        what_changed = [post_equality_data[count] == scanned_equality_data[count]
-                        for count in range(len(post_equality_data))]
+        what_changed = [True] + [post_content_digest[start:start + FIELD_DIGEST_SIZE]
+                                 == scanned_entry.content_digest[start:start + FIELD_DIGEST_SIZE]
+                                 for start in range(0, len(POST_DIGEST_KEYS) * FIELD_DIGEST_SIZE, FIELD_DIGEST_SIZE)]
         post_key = post.get('post_key', None)
         log('debug', 'GRACE period edit: {}::  matching(ED,T,U,MD):{}::  '.format(post_key, what_changed))
         result['is_grace_edit'] = True
@@ -113,60 +244,87 @@ def get_recently_scanned_post_from_post(post):
     rs_post = {key: post.get(key, None) for key in POST_STRAIGHT_COPY_KEYS}
     rs_post['is_recently_scanned_post'] = True
     owner_dict = post.get('owner', {})
-    owner_name = owner_dict.get('display_name', None)
-    rs_post['owner_name'] = owner_name
+    rs_post['content_digest'] = get_content_digest({
+        'title': post.get('title', None),
+        'owner_name': owner_dict.get('display_name', None),
+        'body_markdown': post.get('body_markdown', None),
+    })
     rs_post['post_key'] = get_key_for_post(post)
     return rs_post
 
 
 def atomic_compare_update_and_get_spam_data(post, have_lock=False, update=True):
+    """
+    Compare the post with the recently scanned post and get the spam data from the last scan. have_lock indicates
+    that the caller holds the lock for the post's shard.
+    """
+    post_rs = post
+    if 'is_recently_scanned_post' not in post:
+        post_rs = get_recently_scanned_post_from_post(post)
+    post_key = post_rs.get('post_key', None)
+    if post_key is None:
+        # Without a post_key, we can't check or store.
+        raise KeyError('post key is None')
+    shard = get_shard(post_key)
     try:
         my_lock = False
         if not have_lock:
-            my_lock = GlobalVars.recently_scanned_posts_lock.acquire()
-        post_rs = post
-        if 'is_recently_scanned_post' not in post:
-            post_rs = get_recently_scanned_post_from_post(post)
-        post_key = post_rs.get('post_key', None)
-        if post_key is None:
-            # Without a post_key, we can't check or store.
-            raise KeyError('post key is None')
-        scanned_entry = GlobalVars.recently_scanned_posts.get(post_key, None)
-        if scanned_entry is None or scanned_entry.get('is_spam', None) is None:
+            my_lock = shard.lock.acquire()
+        scanned_entry = shard.posts.get(post_key, None)
+        if scanned_entry is None or scanned_entry.is_spam is None:
             if update:
-                add_post(post_rs, have_lock=True)
+                shard.store(post_key, RecentlyScannedPost(post_rs))
             return {'is_older_or_unchanged': False, 'no_scanned_entry': True}
-        scanned_post = scanned_entry['post']
-        compare_info = compare_posts(post_rs, scanned_post)
-        if update:
-            apply_timestamps_to_entry_from_post_and_time_if_newer(post_rs, scanned_entry)
-        for key in ['is_spam', 'reasons', 'why']:
-            compare_info[key] = scanned_entry.get(key, None)
+        compare_info = compare_posts(post_rs, scanned_entry)
+        if update and apply_timestamps_to_entry_from_post_and_time_if_newer(post_rs, scanned_entry):
+            shard.update_expiry(post_key, scanned_entry)
+        compare_info['is_spam'] = scanned_entry.is_spam
+        compare_info['reasons'] = scanned_entry.reasons
+        compare_info['why'] = scanned_entry.why
         return compare_info
     except Exception:
         raise
     finally:
         if my_lock:
-            GlobalVars.recently_scanned_posts_lock.release()
+            shard.lock.release()
+
+
+def get_recently_scanned_posts_from_pickle(loaded):
+    """
+    Get the recently scanned posts store from the contents of recentlyScannedPosts.p, converting the single dict of
+    posts and the dicts of full posts stored by older versions.
+    """
+    if all(isinstance(value, RecentlyScannedPostsShard) for value in loaded.values()):
+        return loaded
+    shards = {}
+    for key, value in loaded.items():
+        if isinstance(value, dict):
+            old_rs_post = value['post']
+            rs_post = {key: old_rs_post.get(key, None) for key in POST_STRAIGHT_COPY_KEYS}
+            rs_post['content_digest'] = get_content_digest(old_rs_post)
+            record = RecentlyScannedPost(rs_post, is_spam=value.get('is_spam', None),
+                                         reasons=value.get('reasons', None), why=value.get('why', None),
+                                         scan_time=value.get('scan_time', None))
+            record.scan_timestamp = value['scan_timestamp']
+            value = record
+        shards.setdefault(key.partition('/')[0], {})[key] = value
+    return {site: RecentlyScannedPostsShard(posts) for site, posts in shards.items()}
 
 
 def expire_posts():
+    """
+    Remove the posts scanned longer ago than the retention time. The maximum number of posts is kept to when posts
+    are added. Only one shard's lock is held at a time, so only scans for that site wait on this.
+    """
     min_retained_timestamp = time.time() - GlobalVars.recently_scanned_posts_retention_time
-    with GlobalVars.recently_scanned_posts_lock:
-        # A dict comprehension can be used to do this:
-        #   GlobalVars.recently_scanned_posts = {key: value for key, value in GlobalVars.recently_scanned_posts.items()
-        #                                        if value['scan_timestamp'] > min_retained_timestamp}
-        # But, that has a notably higher memory requirement than deleting the entries.
-        # Where the right trade-off wrt. higher memory use vs. maybe more time for del/pop isn't clear and will depend
-        # on the size of the dict and memory/CPU available for the particular SD instance.
-        rs_posts = GlobalVars.recently_scanned_posts
-        original_length = len(rs_posts)
-        keys_to_delete = [key for key, value in rs_posts.items() if value['scan_timestamp'] < min_retained_timestamp]
-        for key in keys_to_delete:
-            rs_posts.pop(key, None)
-        new_length = len(rs_posts)
-        log('debug', 'Expire recently scanned posts: start: '
-                     '{}::  now: {}:: expired: {}'.format(original_length, new_length, original_length - new_length))
+    original_length = get_recently_scanned_post_count()
+    for shard in list(GlobalVars.recently_scanned_posts.values()):
+        with shard.lock:
+            while shard.remove_oldest(before=min_retained_timestamp):
+                pass
+    new_length = get_recently_scanned_post_count()
+    log('debug', 'Expire recently scanned posts: start: {}::  now: {}:: expired: {}'.format(
+        original_length, new_length, original_length - new_length))
 
 
 Tasks.periodic(expire_posts, interval=POSTS_EXPIRE_INTERVAL)
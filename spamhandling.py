@@ -44,7 +44,9 @@ def sum_weight(reasons: list):
 
 
 # noinspection PyMissingTypeHints
-def check_if_spam(post, dont_ignore_for=None):
+def check_if_spam(post, dont_ignore_for=None, defer_community_bump_check=False):
+    # When defer_community_bump_check is True, this doesn't wait for metasmoke to say if the post was bumped by
+    # Community. Such posts need to be reported using handle_spam_unless_community_bumped().
     test, why = findspam.FindSpam.test_post(post)
     if datahandling.is_blacklisted_user(parsing.get_user_from_url(post.user_url)):
         test.append("blacklisted user")
@@ -76,7 +78,7 @@ def check_if_spam(post, dont_ignore_for=None):
             result = "post is ignored"
         elif datahandling.is_auto_ignored_post((post.post_id, post.post_site)):
             result = "post is automatically ignored"
-        elif datahandling.has_community_bumped_post(post.post_url, post.body):
+        elif datahandling.has_community_bumped_post(post.post_url, post.body, wait=not defer_community_bump_check):
             result = "post is bumped by Community \u2666\uFE0F"
         # Dirty approach
         if result is None or (dont_ignore_for is not None and result in dont_ignore_for):  # Post not ignored
@@ -99,10 +101,31 @@ def check_if_spam_json(json_data):
         log('error', 'Parse error {0} when parsing json_data {1!r}'.format(
             err, json_data))
         return False, '', ''
-    is_spam, reason, why = check_if_spam(post)
+    # This is only used to prioritize fetching the post, which is then scanned again.
+    is_spam, reason, why = check_if_spam(post, defer_community_bump_check=True)
     return is_spam, reason, why
 
 
+def handle_spam_unless_community_bumped(post, reasons, why):
+    """
+    Call handle_spam() for a post which check_if_spam(..., defer_community_bump_check=True) found to be spam. If the
+    metasmoke lookup for whether the post was bumped by Community hasn't completed, the report is made when it
+    completes, unless the post was bumped. That's handed off to Tasks, so the lookup's thread is free for other
+    lookups.
+    """
+    bumped = datahandling.has_community_bumped_post(post.post_url, post.body, wait=False)
+    if bumped is None:
+        datahandling.get_ms_post_bodies_future(post.post_url).add_done_callback(
+            lambda _: Tasks.do(handle_spam_unless_community_bumped, post, reasons, why))
+    elif bumped:
+        log('info', 'Not reporting {}: post is bumped by Community'.format(post.post_url))
+    else:
+        try:
+            handle_spam(post=post, reasons=reasons, why=why)
+        except Exception as e:
+            log('error', "Exception in handle_spam:", e)
+
+
 # noinspection PyBroadException,PyProtectedMember
 def handle_spam(post, reasons, why):
     datahandling.append_to_latest_questions(post.post_site, post.post_id, post.title if not post.is_answer else "")
@@ -5,7 +5,7 @@ from globalvars import GlobalVars
 
 import pytest
 
-from blacklists import Blacklist, YAMLParserCIDR, YAMLParserASN, YAMLParserNS, load_blacklists
+from blacklists import Blacklist, IPIndex, NSIndex, YAMLParserCIDR, YAMLParserASN, YAMLParserNS, load_blacklists
 from helpers import files_changed, blacklist_integrity_check, not_regex_search_ascii_and_unicode
 from phone_numbers import NUMBER_REGEX, NUMBER_REGEX_START, NUMBER_REGEX_END, NUMBER_REGEX_MINIMUM_DIGITS, NUMBER_REGEX_MAXIMUM_DIGITS, \
     process_numlist, get_maybe_north_american_not_in_normalized_but_in_all, is_digit_count_in_number_regex_range, matches_number_regex, \
@@ -177,6 +177,64 @@ def test_yaml_blacklist():
     yaml_validate_existing('watched_cidrs.yml', YAMLParserCIDR)
 
 
+def test_yaml_blacklist_cidr():
+    with open('test_cidr.yml', 'w') as y:
+        yaml.dump({
+            'Schema': 'yaml_cidr',
+            'Schema_version': '2019120601',
+            'items': [
+                {'ip': '1.2.3.4'},
+                {'cidr': {'base': '5.6.0.0', 'mask': 16}},
+            ]}, y)
+    blacklist = Blacklist(('test_cidr.yml', YAMLParserCIDR))
+    with pytest.raises(ValueError):
+        blacklist.add({'cidr': {'base': '5.6.7.0'}})
+    with pytest.raises(ValueError):
+        blacklist.add({'cidr': {'base': '5.6.7.0', 'mask': 33}})
+    with pytest.raises(KeyError):
+        blacklist.add({'cidr': {'base': '5.6.0.0', 'mask': 16}})
+    blacklist.add({'cidr': {'base': '7.8.9.0', 'mask': 24}})
+    assert blacklist.parse() == ['1.2.3.4', '5.6.0.0/16', '7.8.9.0/24']
+    blacklist.remove({'cidr': {'base': '5.6.0.0', 'mask': 16}})
+    assert blacklist.parse() == ['1.2.3.4', '7.8.9.0/24']
+    unlink('test_cidr.yml')
+
+
+@pytest.mark.parametrize("address, expected_entry", [
+    ('1.2.3.4', '1.2.3.4'),
+    ('1.2.3.5', None),
+    ('10.1.2.3', '10.1.2.0/24'),
+    ('10.1.3.3', '10.1.0.0/16'),
+    ('10.2.0.1', '10.0.0.0/8'),
+    ('10.1.2.200', '10.1.2.200'),
+    ('11.0.0.0', None),
+    ('9.255.255.255', None),
+    ('2001:db8::1', '2001:db8::/32'),
+    ('2001:db9::1', None),
+    ('not an address', None),
+])
+def test_ip_index(address, expected_entry):
+    index = IPIndex(['10.0.0.0/8', '1.2.3.4', '10.1.2.0/24', '2001:db8::/32', '10.1.0.0/16', '10.1.2.200'])
+    assert index.get_entry(address) == expected_entry
+    assert (address in index) == (expected_entry is not None)
+
+
+@pytest.mark.parametrize("name_servers, expected", [
+    ({'ns1.bad.example.'}, True),
+    ({'ns1.example.', 'a.b.Bad.example.'.lower()}, True),
+    ({'bad.example.'}, False),
+    ({'ns1.notbad.example.'}, False),
+    ({'ns1.example.', 'ns2.example.'}, True),
+    ({'ns1.example.'}, False),
+    ({'ns1.example.', 'ns2.example.', 'ns3.example.'}, False),
+    ({'dns.host.test.'}, True),
+    (set(), False),
+])
+def test_ns_index(name_servers, expected):
+    index = NSIndex(['bad.example.', ['ns1.example.', 'NS2.example.'], 'test.', 'nodot.example'])
+    assert index.matches(name_servers) == expected
+
+
 def test_yaml_asn():
     with open('test_asn.yml', 'w') as y:
         yaml.dump({
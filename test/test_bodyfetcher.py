@@ -0,0 +1,118 @@
+# coding=utf-8
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import bodyfetcher as bodyfetcher_module
+from bodyfetcher import BodyFetcher
+
+
+def test_dispatch_ready_sites_in_order(monkeypatch):
+    bodyfetcher = BodyFetcher()
+    monkeypatch.setattr(bodyfetcher, 'queue', {})
+    monkeypatch.setattr(bodyfetcher, 'ready_sites', {})
+    monkeypatch.setattr(bodyfetcher, 'ready_special_sites', {})
+    monkeypatch.setattr(bodyfetcher, 'special_cases', {'math.stackexchange.com': 2})
+    monkeypatch.setattr(bodyfetcher, 'time_sensitive', [])
+    monkeypatch.setattr(bodyfetcher, 'get_cpu_use', lambda: 0)
+    with bodyfetcher.queue_lock:
+        for site, post_id in [('superuser.com', '1'), ('askubuntu.com', '2'), ('math.stackexchange.com', '3'),
+                              ('superuser.com', '4')]:
+            bodyfetcher.queue.setdefault(site, {})[post_id] = None
+            bodyfetcher.update_site_readiness(site)
+    # math.stackexchange.com needs 2 posts
+    assert list(bodyfetcher.ready_sites) == ['superuser.com', 'askubuntu.com']
+    assert list(bodyfetcher.ready_special_sites) == []
+    with bodyfetcher.queue_lock:
+        bodyfetcher.queue['math.stackexchange.com']['5'] = None
+        bodyfetcher.update_site_readiness('math.stackexchange.com')
+
+    thread_stats = {'high_CPU': 0}
+    dispatched = []
+    start_time = time.time()
+    while True:
+        site_and_posts = bodyfetcher.get_first_queue_item_to_process(thread_stats)
+        if not site_and_posts:
+            break
+        dispatched.append((site_and_posts[0], sorted(site_and_posts[1])))
+        bodyfetcher.release_site_processing_lock(site_and_posts[0])
+    assert time.time() - start_time < 0.5
+    assert dispatched == [('math.stackexchange.com', ['3', '5']), ('superuser.com', ['1', '4']),
+                          ('askubuntu.com', ['2'])]
+    assert bodyfetcher.queue == {}
+    assert bodyfetcher.ready_sites == {}
+    assert bodyfetcher.ready_special_sites == {}
+
+
+def test_time_sensitive_sites_are_moved_when_the_window_changes(monkeypatch):
+    bodyfetcher = BodyFetcher()
+    monkeypatch.setattr(bodyfetcher, 'queue', {})
+    monkeypatch.setattr(bodyfetcher, 'ready_sites', {})
+    monkeypatch.setattr(bodyfetcher, 'ready_special_sites', {})
+    monkeypatch.setattr(bodyfetcher, 'special_cases', {})
+    monkeypatch.setattr(bodyfetcher, 'time_sensitive', ['security.stackexchange.com'])
+    monkeypatch.setattr(bodyfetcher, 'get_cpu_use', lambda: 0)
+    monkeypatch.setattr(bodyfetcher, 'is_time_sensitive_window', lambda: False)
+    monkeypatch.setattr(bodyfetcher, 'time_sensitive_window', False)
+    with bodyfetcher.queue_lock:
+        for site, post_id in [('superuser.com', '1'), ('security.stackexchange.com', '2')]:
+            bodyfetcher.queue.setdefault(site, {})[post_id] = None
+            bodyfetcher.update_site_readiness(site)
+    assert list(bodyfetcher.ready_sites) == ['superuser.com', 'security.stackexchange.com']
+
+    # The time sensitive site is taken first once the window starts, without any change to its queue.
+    monkeypatch.setattr(bodyfetcher, 'is_time_sensitive_window', lambda: True)
+    site_and_posts = bodyfetcher.get_first_queue_item_to_process({'high_CPU': 0})
+    bodyfetcher.release_site_processing_lock(site_and_posts[0])
+    assert site_and_posts[0] == 'security.stackexchange.com'
+    assert list(bodyfetcher.ready_sites) == ['superuser.com']
+
+
+def test_recently_queued_sites_wait_to_coalesce(monkeypatch):
+    bodyfetcher = BodyFetcher()
+    monkeypatch.setattr(bodyfetcher, 'queue', {})
+    monkeypatch.setattr(bodyfetcher, 'ready_sites', {})
+    monkeypatch.setattr(bodyfetcher, 'ready_special_sites', {})
+    monkeypatch.setattr(bodyfetcher, 'special_cases', {})
+    monkeypatch.setattr(bodyfetcher, 'time_sensitive', [])
+    monkeypatch.setattr(bodyfetcher, 'get_cpu_use', lambda: 0)
+    monkeypatch.setattr(BodyFetcher, 'coalesced_dispatch_handle', None)
+    scheduled = []
+    monkeypatch.setattr(bodyfetcher_module.Tasks, 'later', lambda func, after=None: scheduled.append(after) or after)
+    now = datetime.utcnow()
+    with bodyfetcher.queue_lock:
+        for site, post_id, queued_time in [('superuser.com', '1', now), ('askubuntu.com', '2', now - timedelta(seconds=5)),
+                                           ('serverfault.com', '3', now - timedelta(seconds=0.5))]:
+            bodyfetcher.queue.setdefault(site, {})[post_id] = queued_time
+            bodyfetcher.update_site_readiness(site)
+
+    # Only the site which has waited long enough is dispatched. The others are left for a scheduled dispatch.
+    site_and_posts = bodyfetcher.get_first_queue_item_to_process({'high_CPU': 0})
+    bodyfetcher.release_site_processing_lock(site_and_posts[0])
+    assert site_and_posts[0] == 'askubuntu.com'
+    assert bodyfetcher.get_first_queue_item_to_process({'high_CPU': 0}) is None
+    assert list(bodyfetcher.ready_sites) == ['superuser.com', 'serverfault.com']
+    assert len(scheduled) == 1 and 0 < scheduled[0] <= 0.5
+    # There's only one scheduled dispatch at a time
+    assert bodyfetcher.get_first_queue_item_to_process({'high_CPU': 0}) is None
+    assert len(scheduled) == 1
+
+
+def test_cpu_use_sampler_survives_errors(monkeypatch):
+    samples = [OSError('No CPU for you'), 12.5, 37.5]
+
+    def fake_cpu_percent(interval=None):
+        if not samples:
+            raise SystemExit
+        sample = samples.pop(0)
+        if isinstance(sample, Exception):
+            raise sample
+        return sample
+
+    monkeypatch.setattr(bodyfetcher_module.psutil, 'cpu_percent', fake_cpu_percent)
+    monkeypatch.setattr(BodyFetcher, 'CPU_USE_SAMPLE_INTERVAL', 0)
+    monkeypatch.setattr(BodyFetcher, 'cpu_use', 0.0)
+    with pytest.raises(SystemExit):
+        BodyFetcher.sample_cpu_use()
+    assert BodyFetcher.cpu_use == 37.5
@@ -0,0 +1,83 @@
+# coding=utf-8
+import threading
+import time
+
+import pytest
+
+from chat_user_cache import ChatUserCache
+import datahandling
+from globalvars import GlobalVars
+
+
+class FakeUser:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeBrowser:
+    def __init__(self, client):
+        self.client = client
+
+    def get_current_users_in_room(self, room_id):
+        self.client.requests.append(('current users', room_id))
+        return [(3, 'present user'), (4, 'another user')]
+
+
+class FakeClient:
+    host = 'stackexchange.com'
+
+    def __init__(self):
+        self.requests = []
+        self.names = {1: 'user one', 2: 'user two'}
+        self._br = FakeBrowser(self)
+
+    def get_user(self, user_id):
+        self.requests.append(('user', user_id))
+        if user_id not in self.names:
+            raise ValueError('No such user')
+        return FakeUser(self.names[user_id])
+
+
+def test_chat_user_cache(monkeypatch):
+    ChatUserCache.clear()
+    client = FakeClient()
+    for _ in range(3):
+        assert ChatUserCache.get_user_name(client, 1) == 'user one'
+        with pytest.raises(ValueError):
+            ChatUserCache.get_user_name(client, 5)
+    assert client.requests == [('user', 1), ('user', 5)]
+
+    # Once it's due for a refresh, the cached name is used, while it's fetched again in the background.
+    refreshed = threading.Event()
+    client.names[1] = 'renamed user'
+    original_fetch = ChatUserCache._fetch
+    monkeypatch.setattr(ChatUserCache, 'NAME_REFRESH_AFTER', 0)
+    monkeypatch.setattr(ChatUserCache, '_fetch',
+                        lambda *args, **kwargs: (original_fetch(*args, **kwargs), refreshed.set())[0])
+    assert ChatUserCache.get_user_name(client, 1) == 'user one'
+    assert refreshed.wait(5)
+    monkeypatch.setattr(ChatUserCache, 'NAME_REFRESH_AFTER', 60)
+    assert ChatUserCache.get_user_name(client, 1) == 'renamed user'
+    assert client.requests == [('user', 1), ('user', 5), ('user', 1)]
+
+    # Expired entries are fetched while waiting
+    monkeypatch.setattr(ChatUserCache, 'NAME_TTL', 0)
+    time.sleep(0.01)
+    assert ChatUserCache.get_user_name(client, 2) == 'user two'
+    assert ChatUserCache.get_user_name(client, 2) == 'user two'
+    assert client.requests.count(('user', 2)) == 2
+
+
+def test_user_names_on_notification_list_are_cached(monkeypatch):
+    ChatUserCache.clear()
+    client = FakeClient()
+    monkeypatch.setattr(GlobalVars, 'notifications', datahandling.get_notifications_from_list([
+        (1, 'stackexchange.com', 11540, 'stackoverflow.com', True),
+        (2, 'stackexchange.com', 11540, 'stackoverflow.com', True),
+        (3, 'stackexchange.com', 11540, 'stackoverflow.com', False),
+        (5, 'stackexchange.com', 11540, 'stackoverflow.com', False),
+    ]))
+    for _ in range(5):
+        assert datahandling.get_user_names_on_notification_list('stackexchange.com', 11540, 'stackoverflow.com',
+                                                                client) == ['user one', 'user two', 'present user']
+    assert client.requests == [('user', 1), ('user', 2), ('current users', 11540)]
@@ -272,33 +272,58 @@ def test_pickle_rick(dump_pickle):
         remove_pickle("messageData.p")
 
 
+def make_sender_room(room_id, responses, client=None):
+    """
+    Make a room which gets the responses for its messages in order. Rooms which share a client share its responses.
+    """
+    room = chatcommunicate.RoomData(Mock(), -1, False)
+    room.room.id = room_id
+    if client is None:
+        room.room._client.host = "stackexchange.com"
+        room.room._client.responses = {}
+    else:
+        room.room._client = client
+    room.room._client.responses[room_id] = responses
+
+    def send(action):
+        response = room.room._client.responses[action[1]].pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return Fake({"json": lambda: response})
+
+    room.room._client._do_action_despite_throttling.side_effect = send
+    return room
+
+
+def get_sent_messages(room):
+    return [call[0][0] for call in room.room._client._do_action_despite_throttling.call_args_list]
+
+
+def wait_for_host_senders():
+    chatcommunicate._msg_queue.join()
+    with chatcommunicate._host_senders_lock:
+        host_senders = list(chatcommunicate._host_senders.values())
+    for host_sender in host_senders:
+        host_sender.join()
+
+
+@patch("chatcommunicate._host_senders", {})
 @patch("chatcommunicate._pickle_run")
 def test_message_sender(pickle_rick):
     chatcommunicate._last_messages = chatcommunicate.LastMessages({}, collections.OrderedDict())
 
     threading.Thread(target=chatcommunicate.send_messages, daemon=True).start()
 
-    room = chatcommunicate.RoomData(Mock(), -1, False)
-
-    room.room.id = 11540
-    room.room._client.host = "stackexchange.com"
-
-    room.room._client._do_action_despite_throttling.return_value = Fake({"json": lambda: {"id": 1}})
+    room = make_sender_room(11540, [{"id": 1}])
     chatcommunicate._msg_queue.put((room, "test", None))
-
-    while not chatcommunicate._msg_queue.empty():
-        time.sleep(0)
+    wait_for_host_senders()
 
     room.room._client._do_action_despite_throttling.assert_called_once_with(("send", 11540, "test"))
-    room.room.reset_mock()
     assert chatcommunicate._last_messages.messages[("stackexchange.com", 11540)] == collections.deque((1,))
 
-    room.room.id = 30332
-    room.room._client._do_action_despite_throttling.return_value = Fake({"json": lambda: {"id": 2}})
+    room = make_sender_room(30332, [{"id": 2}])
     chatcommunicate._msg_queue.put((room, "test", "did you hear about what happened to pluto"))
-
-    while not chatcommunicate._msg_queue.empty():
-        time.sleep(0)
+    wait_for_host_senders()
 
     room.room._client._do_action_despite_throttling.assert_called_once_with(("send", 30332, "test"))
     with chatcommunicate._last_messages_lock:
@@ -306,6 +331,45 @@ def test_message_sender(pickle_rick):
         assert chatcommunicate._last_messages.reports == collections.OrderedDict({("stackexchange.com", 2): "did you hear about what happened to pluto"})
 
 
+@patch("chatcommunicate._host_senders", {})
+@patch("chatcommunicate._pickle_run")
+def test_host_senders(pickle_rick, monkeypatch):
+    chatcommunicate._last_messages = chatcommunicate.LastMessages({}, collections.OrderedDict())
+    monkeypatch.setattr(chatcommunicate.HostSender, "BURST", 1)
+    monkeypatch.setattr(chatcommunicate.HostSender, "MESSAGES_PER_SECOND", 10)
+    errors = []
+    monkeypatch.setattr(chatcommunicate, "log", lambda level, *args: errors.append(args) if level == 'error' else None)
+    monkeypatch.setattr(chatcommunicate, "log_current_exception", lambda: None)
+
+    # The rooms on a host share the host's rate limit.
+    busy_room = make_sender_room(11540, [{"id": 1}, {"id": 2}, {"id": 3}, {"id": 4}])
+    room = make_sender_room(30332, [{"id": 5}, ValueError("chat is down"), ValueError("chat is down"),
+                                    ValueError("chat is down")], client=busy_room.room._client)
+    host_sender = chatcommunicate.get_host_sender(busy_room)
+    assert chatcommunicate.get_host_sender(room) is host_sender
+    with host_sender.condition:
+        for msg in ["first", "second", "third"]:
+            host_sender.put(busy_room, msg, None)
+        host_sender.put(room, "test", None)
+        host_sender.put(room, "doomed", None)
+        # Reports are sent before other messages which are waiting.
+        host_sender.put(busy_room, "report", ("https://stackoverflow.com/q/1", "link"))
+    start = time.monotonic()
+    host_sender.join()
+    # Seven attempts, after the first, at 10 per second
+    assert time.monotonic() - start > 0.5
+    # Otherwise, the rooms take turns, so the busy room doesn't hold up the other room.
+    assert [action[1:] for action in get_sent_messages(busy_room)] == [
+        (11540, "report"), (30332, "test"), (11540, "first"), (30332, "doomed"), (11540, "second"),
+        (30332, "doomed"), (11540, "third"), (30332, "doomed")]
+    # A message which can't be sent is given up on, with an error.
+    assert len(errors) == 1 and "doomed" in errors[0][0]
+    with chatcommunicate._last_messages_lock:
+        assert chatcommunicate._last_messages.messages[("stackexchange.com", 11540)] == collections.deque((1, 2, 3, 4))
+        assert chatcommunicate._last_messages.messages[("stackexchange.com", 30332)] == collections.deque((5,))
+        assert list(chatcommunicate._last_messages.reports) == [("stackexchange.com", 1)]
+
+
 @patch("chatcommunicate._msg_queue.put")
 @patch("chatcommunicate.get_last_messages")
 def test_on_msg(get_last_messages, post_msg):
@@ -1,7 +1,19 @@
 # -*- coding: utf-8 -*-
 
-from datahandling import append_pings, SmokeyTransfer
+import time
+from datetime import datetime, timedelta
+
+import datahandling
+from datahandling import append_pings, SmokeyTransfer, add_or_update_api_data, store_api_data, load_pickle, \
+    add_false_positive, add_blacklisted_user, remove_blacklisted_user, replay_pickle_journal, dump_pickle, \
+    load_files, add_auto_ignored_post, is_auto_ignored_post, filter_auto_ignored_posts, is_false_positive, \
+    add_ignored_post, is_ignored_post, add_why, get_why, add_to_notification_list, remove_from_notification_list, \
+    remove_all_from_notification_list, will_i_be_notified, get_all_notification_sites, \
+    get_user_ids_on_notification_list
 from globalvars import GlobalVars
+from helpers import log
+from post_corpus import RUN_BENCHMARKS
+from tasks import Tasks
 import pytest
 
 
@@ -30,3 +42,208 @@ def test_smokey_transfer(monkeypatch):
 
     with pytest.raises(ValueError):
         SmokeyTransfer.load(SmokeyTransfer.HEADER + "\nmmmmmm\n" + SmokeyTransfer.ENDING)
+
+
+class FakeHandle:
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def test_api_data_saves_are_coalesced(monkeypatch, tmp_path):
+    scheduled = []
+
+    def fake_later(func, *args, after=None, **kwargs):
+        scheduled.append((func, after))
+        handle = FakeHandle()
+        scheduled_handles.append(handle)
+        return handle
+
+    scheduled_handles = []
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Tasks, 'later', fake_later)
+    monkeypatch.setattr(datahandling, 'api_data_save_handle', None)
+    # The save can run when there isn't a BodyFetcher
+    monkeypatch.setattr(GlobalVars, 'bodyfetcher', None)
+    monkeypatch.setattr(GlobalVars, 'api_calls_per_site', {})
+    for site in ['stackoverflow.com', 'stackoverflow.com', 'superuser.com']:
+        add_or_update_api_data(site)
+    assert scheduled == [(store_api_data, datahandling.API_DATA_SAVE_DELAY)]
+    assert not (tmp_path / 'pickles' / 'apiCalls.p').exists()
+
+    store_api_data()
+    assert scheduled_handles[0].cancelled
+    assert load_pickle('apiCalls.p') == {'stackoverflow.com': 2, 'superuser.com': 1}
+    assert [path.name for path in (tmp_path / 'pickles').iterdir()] == ['apiCalls.p']
+    add_or_update_api_data('superuser.com')
+    assert len(scheduled) == 2
+
+
+def test_journaled_pickles(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(datahandling, 'journal_lengths', {})
+    monkeypatch.setattr(datahandling, 'JOURNAL_COMPACTION_THRESHOLD', 5)
+    monkeypatch.setattr(GlobalVars, 'false_positives', {})
+    monkeypatch.setattr(GlobalVars, 'blacklisted_users', {})
+    pickles = tmp_path / 'pickles'
+
+    add_false_positive((1, 'stackoverflow.com'))
+    add_false_positive((2, 'stackoverflow.com'))
+    add_blacklisted_user((3, 'stackoverflow.com'), 'message url', 'post url')
+    add_blacklisted_user((4, 'stackoverflow.com'), 'message url', 'post url')
+    assert remove_blacklisted_user((3, 'stackoverflow.com'))
+    # Only the journals have been written
+    journals = ['blacklistedUsers.p.journal', 'falsePositives.p.journal']
+    assert sorted(path.name for path in pickles.iterdir()) == journals
+    # A partially written entry at the end of a journal is ignored
+    with open(pickles / 'falsePositives.p.journal', 'ab') as f:
+        f.write(b'\x80\x05\x95')
+
+    monkeypatch.setattr(GlobalVars, 'false_positives', {})
+    monkeypatch.setattr(GlobalVars, 'blacklisted_users', {})
+    replay_pickle_journal('falsePositives.p')
+    replay_pickle_journal('blacklistedUsers.p')
+    assert list(GlobalVars.false_positives) == [(1, 'stackoverflow.com'), (2, 'stackoverflow.com')]
+    assert GlobalVars.blacklisted_users == {(4, 'stackoverflow.com'): ('message url', 'post url')}
+    # Replaying compacts the journal into the pickle
+    assert sorted(path.name for path in pickles.iterdir()) == ['blacklistedUsers.p', 'falsePositives.p']
+    assert load_pickle('falsePositives.p') == GlobalVars.false_positives
+
+    for post_id in range(3, 8):
+        add_false_positive((post_id, 'stackoverflow.com'))
+    # Reaching JOURNAL_COMPACTION_THRESHOLD compacts the journal
+    assert not (pickles / 'falsePositives.p.journal').exists()
+    assert len(load_pickle('falsePositives.p')) == 7
+
+
+def test_auto_ignored_posts(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(datahandling, 'journal_lengths', {})
+    monkeypatch.setattr(GlobalVars, 'auto_ignored_posts', {})
+    now = datetime.utcnow()
+    # Pickles from before auto_ignored_posts was a dict are a list of tuples
+    dump_pickle('autoIgnoredPosts.p', [(1, 'stackoverflow.com', now - timedelta(days=10)),
+                                       (2, 'stackoverflow.com', now - timedelta(days=1))])
+    monkeypatch.setattr(datahandling.blacklists, 'load_blacklists', lambda: None)
+    load_files()
+    assert is_auto_ignored_post((1, 'stackoverflow.com'))
+    assert is_auto_ignored_post((2, 'stackoverflow.com'))
+    assert not is_auto_ignored_post((2, 'superuser.com'))
+
+    filter_auto_ignored_posts()
+    assert not is_auto_ignored_post((1, 'stackoverflow.com'))
+    assert is_auto_ignored_post((2, 'stackoverflow.com'))
+
+    add_auto_ignored_post((3, 'superuser.com', now - timedelta(days=9)))
+    add_auto_ignored_post((4, 'superuser.com', now))
+    # Adding expires the old entries
+    assert GlobalVars.auto_ignored_posts == {(2, 'stackoverflow.com'): now - timedelta(days=1),
+                                             (4, 'superuser.com'): now}
+    monkeypatch.setattr(GlobalVars, 'auto_ignored_posts', {})
+    load_files()
+    assert set(GlobalVars.auto_ignored_posts) == {(2, 'stackoverflow.com'), (4, 'superuser.com')}
+
+
+def test_false_positives_ignored_posts_and_why_data(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(datahandling, 'journal_lengths', {})
+    monkeypatch.setattr(datahandling.blacklists, 'load_blacklists', lambda: None)
+    for attr in ['false_positives', 'ignored_posts', 'why_data', 'auto_ignored_posts']:
+        monkeypatch.setattr(GlobalVars, attr, {})
+    # Pickles from before these were dicts are lists
+    dump_pickle('falsePositives.p', [(1, 'stackoverflow.com'), (2, 'stackoverflow.com')])
+    dump_pickle('ignoredPosts.p', [(3, 'stackoverflow.com')])
+    dump_pickle('whyData.p', [('stackoverflow.com/{}'.format(post_id), 'why {}'.format(post_id))
+                              for post_id in range(60)])
+    load_files()
+    assert list(GlobalVars.false_positives) == [(1, 'stackoverflow.com'), (2, 'stackoverflow.com')]
+    assert is_false_positive((2, 'stackoverflow.com')) and not is_false_positive((3, 'stackoverflow.com'))
+    assert is_ignored_post((3, 'stackoverflow.com')) and not is_ignored_post((1, 'stackoverflow.com'))
+    # Only the newest 50 are kept
+    assert get_why('stackoverflow.com', 9) is None
+    assert get_why('stackoverflow.com', 10) == 'why 10'
+
+    add_false_positive((4, 'superuser.com'))
+    add_ignored_post((5, 'superuser.com'))
+    add_why('stackoverflow.com', 10, 'new why 10')
+    add_why('superuser.com', 6, 'why 6')
+    for attr in ['false_positives', 'ignored_posts', 'why_data']:
+        monkeypatch.setattr(GlobalVars, attr, {})
+    load_files()
+    assert list(GlobalVars.false_positives)[-1] == (4, 'superuser.com')
+    assert list(GlobalVars.ignored_posts) == [(3, 'stackoverflow.com'), (5, 'superuser.com')]
+    assert get_why('stackoverflow.com', 10) == 'new why 10'
+    assert get_why('stackoverflow.com', 11) is None
+    assert list(GlobalVars.why_data)[-2:] == ['stackoverflow.com/10', 'superuser.com/6']
+
+    # Older versions expect ignored_posts to be transferred as a list
+    s, metadata = SmokeyTransfer.dump()
+    monkeypatch.setattr(GlobalVars, 'ignored_posts', {})
+    SmokeyTransfer.load(s)
+    assert list(GlobalVars.ignored_posts) == [(3, 'stackoverflow.com'), (5, 'superuser.com')]
+
+
+def test_notifications(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(datahandling, 'journal_lengths', {})
+    monkeypatch.setattr(datahandling.blacklists, 'load_blacklists', lambda: None)
+    monkeypatch.setattr(datahandling, 'check_site_and_get_full_name',
+                        lambda site: (True, site if site.endswith('.com') else site + '.com'))
+    monkeypatch.setattr(GlobalVars, 'notifications', {})
+    # Pickles from before notifications were a dict are lists, which may not have always_ping
+    dump_pickle('notifications.p', [(1, 'stackexchange.com', 11540, 'stackoverflow.com', False),
+                                    (2, 'stackexchange.com', 11540, 'stackoverflow.com')])
+    load_files()
+    assert will_i_be_notified(1, 'stackexchange.com', 11540, 'stackoverflow.com')
+    assert not will_i_be_notified(1, 'stackexchange.com', 11540, 'superuser.com')
+    assert get_user_ids_on_notification_list('stackexchange.com', 11540, 'stackoverflow.com') == \
+        [(1, False), (2, True)]
+
+    assert add_to_notification_list(1, 'stackexchange.com', 11540, 'superuser') == (0, 'superuser.com')
+    assert add_to_notification_list(1, 'stackexchange.com', 11540, 'superuser') == (-1, None)
+    assert add_to_notification_list(3, 'stackexchange.com', 11540, 'superuser', always_ping=False)[0] == 0
+    assert remove_from_notification_list(2, 'stackexchange.com', 11540, 'stackoverflow')
+    assert not remove_from_notification_list(2, 'stackexchange.com', 11540, 'stackoverflow')
+    assert get_all_notification_sites(1, 'stackexchange.com', 11540) == ['stackoverflow.com', 'superuser.com']
+    assert get_user_ids_on_notification_list('stackexchange.com', 11540, 'superuser.com') == [(1, True), (3, False)]
+
+    # Changes are journaled, so they're there after reloading.
+    monkeypatch.setattr(GlobalVars, 'notifications', {})
+    load_files()
+    assert GlobalVars.notifications == {(1, 'stackexchange.com', 11540, 'stackoverflow.com'): False,
+                                        (1, 'stackexchange.com', 11540, 'superuser.com'): True,
+                                        (3, 'stackexchange.com', 11540, 'superuser.com'): False}
+    remove_all_from_notification_list(1)
+    assert get_all_notification_sites(1, 'stackexchange.com', 11540) == []
+    assert get_user_ids_on_notification_list('stackexchange.com', 11540, 'stackoverflow.com') == []
+    assert get_user_ids_on_notification_list('stackexchange.com', 11540, 'superuser.com') == [(3, False)]
+
+    # Older versions expect notifications to be transferred as a list
+    s, metadata = SmokeyTransfer.dump()
+    monkeypatch.setattr(GlobalVars, 'notifications', {})
+    assert not will_i_be_notified(3, 'stackexchange.com', 11540, 'superuser.com')
+    SmokeyTransfer.load(s)
+    assert will_i_be_notified(3, 'stackexchange.com', 11540, 'superuser.com')
+
+
+@pytest.mark.skipif(not RUN_BENCHMARKS, reason="SD_BENCHMARKS isn't set")
+def test_false_positive_lookup_benchmark(monkeypatch):
+    lookup_count = 2000
+    lookup_times = {}
+    for size in [1000, 10000, 100000, 400000]:
+        posts = [(post_id, 'stackoverflow.com') for post_id in range(size)]
+        monkeypatch.setattr(GlobalVars, 'false_positives', dict.fromkeys(posts))
+        start = time.perf_counter()
+        for post_id in range(size - lookup_count, size + lookup_count):
+            is_false_positive((post_id, 'stackoverflow.com'))
+        lookup_times[size] = (time.perf_counter() - start) / (2 * lookup_count)
+        start = time.perf_counter()
+        for post_id in range(size - lookup_count // 100, size + lookup_count // 100):
+            (post_id, 'stackoverflow.com') in posts
+        list_lookup_time = (time.perf_counter() - start) / (2 * lookup_count // 100)
+        log('info', '{} false positives: {:.2f}us per lookup; {:.2f}us per lookup as a list'.format(
+            size, lookup_times[size] * 1e6, list_lookup_time * 1e6))
+    # The lookup cost doesn't grow with the number of false positives. There's slack for noise.
+    assert lookup_times[400000] < 3 * lookup_times[1000]
@@ -0,0 +1,125 @@
+# coding=utf-8
+import threading
+import time
+
+import dns.resolver
+import pytest
+
+from dns_cache import DNSCache
+import findspam
+from findspam import prefetch_dns_for_hosts
+
+
+@pytest.fixture(autouse=True)
+def clear_dns_cache():
+    # DNSCache is process wide, so don't leave fake answers in it for other tests.
+    DNSCache.clear()
+    yield
+    DNSCache.clear()
+
+
+class FakeName(str):
+    def to_text(self):
+        return str(self)
+
+
+class FakeRecord:
+    """ Like a dnspython rdata: the text of the record is str(record) and an NS record has the name server in target """
+    def __init__(self, text):
+        self.text = text
+        self.target = FakeName(text)
+
+    def __str__(self):
+        return self.text
+
+
+class FakeAnswer(list):
+    def __init__(self, label, ttl, records=()):
+        super().__init__(records)
+        self.label = label
+        self.expiration = time.time() + ttl
+
+
+def test_dns_cache_positive_and_negative(monkeypatch):
+    lookups = []
+
+    def fake_resolve(label, qtype, search=True, **kwargs):
+        lookups.append((label, qtype))
+        if label == 'nonexistent.example.com':
+            raise dns.resolver.NXDOMAIN()
+        if label == 'expired.example.com':
+            return FakeAnswer(label, -1)
+        return FakeAnswer(label, 300)
+
+    monkeypatch.setattr(dns.resolver, 'resolve', fake_resolve)
+    stats_before = DNSCache.get_stats()
+    first = DNSCache.resolve('example.com', 'a')
+    assert DNSCache.resolve('EXAMPLE.com', 'A') is first
+    assert lookups == [('example.com', 'a')]
+    for _ in range(2):
+        with pytest.raises(dns.resolver.NXDOMAIN):
+            DNSCache.resolve('nonexistent.example.com', 'ns')
+    assert lookups.count(('nonexistent.example.com', 'ns')) == 1
+    DNSCache.resolve('expired.example.com', 'a')
+    DNSCache.resolve('expired.example.com', 'a')
+    assert lookups.count(('expired.example.com', 'a')) == 2
+    stats = DNSCache.get_stats()
+    assert stats['hits'] - stats_before['hits'] == 2
+    assert stats['misses'] - stats_before['misses'] == 4
+
+
+def test_dns_cache_merges_concurrent_lookups(monkeypatch):
+    lookups = []
+
+    def fake_resolve(label, qtype, search=True, **kwargs):
+        lookups.append((label, qtype))
+        time.sleep(0.5)
+        return FakeAnswer(label, 300)
+
+    monkeypatch.setattr(dns.resolver, 'resolve', fake_resolve)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(DNSCache.resolve('slow.example.com', 'a')))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(lookups) == 1
+    assert len(results) == 5
+    assert all(result is results[0] for result in results)
+
+
+def test_prefetch_dns_for_hosts(monkeypatch):
+    lookups = []
+    records = {
+        ('spam.example.com', 'a'): ['192.0.2.1'],
+        ('example.com', 'ns'): ['ns1.example.net.', 'ns2.example.net.'],
+        ('ns1.example.net.', 'a'): ['192.0.2.53'],
+        ('ns2.example.net.', 'a'): ['192.0.2.54'],
+        ('eggs.example.org', 'a'): ['198.51.100.1'],
+        ('1.2.0.192.origin.asn.cymru.com.', 'txt'): ['"64496 | 192.0.2.0/24 | ZZ | test | 2020-01-01"'],
+    }
+
+    def fake_resolve(label, qtype, search=True, **kwargs):
+        lookups.append((label, qtype))
+        time.sleep(0.5)
+        if (label, qtype) not in records:
+            raise dns.resolver.NXDOMAIN()
+        return FakeAnswer(label, 300, [FakeRecord(record) for record in records[(label, qtype)]])
+
+    monkeypatch.setattr(dns.resolver, 'resolve', fake_resolve)
+    # nextjs.org is in the IP and NS whitelists, so with the metasmoke whitelist, every DNS based rule skips it.
+    monkeypatch.setattr(findspam.metasmoke_cache, "get_website_whitelist", lambda: ['nextjs.org'])
+    start_time = time.time()
+    prefetch_dns_for_hosts(['spam.example.com', 'eggs.example.org', 'nextjs.org'])
+    # Three dependent rounds of lookups, rather than one lookup after another. There's slack for a loaded machine.
+    elapsed = time.time() - start_time
+    assert elapsed < 2.5 < len(lookups) * 0.5
+    assert set(records) <= set(lookups)
+    assert ('example.org', 'ns') in lookups
+    assert ('1.100.51.198.origin.asn.cymru.com.', 'txt') in lookups
+    assert len(lookups) == len(set(lookups))
+    assert not [label for label, qtype in lookups if 'nextjs' in label]
+    lookups.clear()
+    prefetch_dns_for_hosts(['spam.example.com', 'eggs.example.org', 'nextjs.org'])
+    assert lookups == []
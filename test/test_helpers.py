@@ -1,7 +1,10 @@
 # coding=utf-8
 import os
+import time
 import pytest
 import helpers
+from helpers import log
+from post_corpus import RUN_BENCHMARKS, get_post_texts
 
 
 @pytest.mark.skipif("CHINA" in os.environ, reason="")
@@ -12,3 +15,90 @@ import helpers
 ])
 def test_unshorten_link(shortened, original):
     assert helpers.unshorten_link(shortened) == original
+
+
+@pytest.mark.parametrize('entries, expected', [
+    (['abc', 'abd', 'x'], 'ab(?:c|d)|x'),
+    (['abc', 'x', 'abd'], 'ab(?:c|d)|x'),
+    (['ab', 'Abc'], 'ab(?:|c)'),
+    (['abc', r'\d+', 'abd'], r'abc|\d+|abd'),
+    (['ab?c', 'abd'], 'a(?:b?c|bd)'),
+    (['abc', 'a|b', 'abd'], 'abc|a|b|abd'),
+    (['abc', '(?-i:aBd)', 'abe'], 'abc|(?-i:aBd)|abe'),
+    (['abc', '(?-i:xyz)', 'abe'], 'ab(?:c|e)|(?-i:xyz)'),
+    (['abc', '(?:x|y)z', 'abe'], 'abc|(?:x|y)z|abe'),
+])
+def test_get_factored_case_insensitive_alternation(entries, expected):
+    assert helpers.get_factored_case_insensitive_alternation(entries) == expected
+
+
+@pytest.mark.parametrize('list_name, bookended', [
+    ('bad_keywords', True),
+    ('watched_keywords', True),
+    ('blacklisted_websites', False),
+    ('blacklisted_usernames', False),
+])
+def test_factored_keyword_alternation_matches_joined_entries(list_name, bookended):
+    import regex
+    import findspam
+    from globalvars import GlobalVars
+
+    entries = list(getattr(GlobalVars, list_name))
+    make_regex_text = helpers.keyword_bookend_regex_text if bookended else helpers.keyword_non_bookend_regex_text
+    joined = helpers.regex_compile_no_cache(make_regex_text('|'.join(entries)), regex.UNICODE,
+                                            city=findspam.city_list, ignore_unused=True)
+    factored = helpers.regex_compile_no_cache(
+        make_regex_text(helpers.get_factored_case_insensitive_alternation(entries)), regex.UNICODE,
+        city=findspam.city_list, ignore_unused=True)
+    texts = get_post_texts()
+    joined_time = 0
+    factored_time = 0
+    for text in texts:
+        start_time = time.perf_counter()
+        expected = [(match.span(), match.group()) for match in joined.finditer(text)]
+        joined_time += time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        actual = [(match.span(), match.group()) for match in factored.finditer(text)]
+        factored_time += time.perf_counter() - start_time
+        assert actual == expected
+    if RUN_BENCHMARKS:
+        log('info', '{}: {} texts: joined entries {:.2f} s, factored {:.2f} s'.format(
+            list_name, len(texts), joined_time, factored_time))
+        # Allow for noise: for some lists, there's little to factor.
+        assert factored_time < joined_time * 1.2
+
+
+def test_expiry_index():
+    expiry_index = helpers.ExpiryIndex({'a': 10, 'b': 20})
+    expiry_index.set('c', 5)
+    expiry_index.set('b', 30)  # Leaves a stale entry for 'b' at 20
+    expiry_index.set('d', 15)
+    expiry_index.discard('d')
+    assert expiry_index.get_oldest() == (5, 'c')
+    assert expiry_index.pop_expired(now=4) == []
+    assert expiry_index.pop_expired(now=20) == ['c', 'a']
+    assert len(expiry_index) == 1 and 'b' in expiry_index
+    assert expiry_index.get_oldest() == (30, 'b')
+    assert expiry_index.pop_expired(now=30) == ['b']
+    assert expiry_index.pop_expired(now=100) == []
+    assert expiry_index.get_oldest() is None
+
+
+def test_token_bucket():
+    bucket = helpers.TokenBucket(2, 0.5)
+    bucket._updated = 100
+    assert bucket.get_delay(now=100) == 0
+    bucket.take(now=100)
+    bucket.take(now=100)
+    assert bucket.get_delay(now=100) == 2
+    assert bucket.get_delay(now=101) == 1
+    bucket.take(now=102)
+    # Blocking empties the bucket, and it doesn't refill until the block ends.
+    bucket.block(10, now=103)
+    assert bucket.get_delay(now=103) == 12
+    assert bucket.get_delay(now=113) == 2
+    # It's never more than full
+    assert bucket.get_delay(now=1000) == 0
+    bucket.take(now=1000)
+    bucket.take(now=1000)
+    assert bucket.get_delay(now=1000) == 2
@@ -0,0 +1,95 @@
+# coding=utf-8
+import threading
+
+import regex
+import pytest
+
+import keyword_prefilter
+from keyword_prefilter import get_required_literal, get_required_literals, KeywordPrefilterMatcher
+from helpers import get_bookended_keyword_regex_text_from_entries, get_non_bookended_keyword_regex_text_from_entries, \
+    keyword_bookend_regex_text, keyword_non_bookend_regex_text, regex_compile_no_cache
+from globalvars import GlobalVars
+import findspam
+from post_corpus import get_post_texts
+
+
+@pytest.mark.parametrize("regex_text, expected_literal", [
+    (r"fifabay", "fifabay"),
+    (r"baba[\W_]*+ji", "baba"),
+    (r"l[\W_]*+argin(?:ine)?", "argin"),
+    (r"dr\.?abaherbalhome", "abaherbalhome"),
+    (r"Testerone[\W_]*+XL", "testerone"),
+    (r"(?-i:zna0xbJPBXM)(?# youtube)", "zna0xbjpbxm"),
+    (r"(?:skin|eye)\Wnovela", "novela"),
+    (r"writing(?<!code\Wwriting)[\W_]*+service", "writing"),
+    (r"(?:fifa)?coins", "coins"),
+    (r"fifa|coins", ""),
+    (r"ab?cd*ef", "ef"),
+    (r"ab+cd", "ab"),
+    (r"x{0,3}yz{2}", "yz"),
+    (r"(?x)some thing", ""),
+    (r"\L<city>\Wescorts?", "escort"),
+    # Fuzzy constraints aren't literals
+    (r"(?:foo){e<=1}barbaz", "barbaz"),
+    (r"(?:foobar){e<=1}", ""),
+    (r"fooo{e<=1}bar", "foo"),
+    (r"ab\d{i<=1,s<=2}cdefgh", "cdefgh"),
+])
+def test_get_required_literal(regex_text, expected_literal):
+    assert get_required_literal(regex_text) == expected_literal
+
+
+@pytest.mark.parametrize('list_name, bookended', [
+    ('bad_keywords', True),
+    ('watched_keywords', True),
+    ('blacklisted_websites', False),
+    ('blacklisted_usernames', False),
+])
+def test_prefilter_matches_full_regex(list_name, bookended):
+    entries = list(getattr(GlobalVars, list_name))
+    if bookended:
+        make_regex_text = keyword_bookend_regex_text
+        regex_text_generator = get_bookended_keyword_regex_text_from_entries
+    else:
+        make_regex_text = keyword_non_bookend_regex_text
+        regex_text_generator = get_non_bookended_keyword_regex_text_from_entries
+    matcher = KeywordPrefilterMatcher(entries, regex_text_generator, city=findspam.city_list)
+    full_regex = regex_compile_no_cache(make_regex_text('|'.join(entries)), regex.UNICODE,
+                                        city=findspam.city_list, ignore_unused=True)
+    for text in get_post_texts() + ["Nothing to see here.", ""]:
+        expected = [(match.span(), match.group()) for match in full_regex.finditer(text)]
+        actual = [(match.span(), match.group()) for match in matcher.finditer(text)]
+        assert actual == expected
+
+
+def test_required_literals_are_cached_on_disk(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(keyword_prefilter, '_literals_cache', None)
+    entries = [r"fifabay", r"baba[\W_]*+ji", r"fifa|coins"]
+    assert get_required_literals(entries) == ["fifabay", "baba", ""]
+    assert (tmp_path / 'pickles' / keyword_prefilter.LITERALS_CACHE_FILENAME).exists()
+
+    def fail_get_required_literal(regex_text):
+        raise AssertionError("Literal should have been cached: {}".format(regex_text))
+
+    # Reload from disk
+    monkeypatch.setattr(keyword_prefilter, '_literals_cache', None)
+    monkeypatch.setattr(keyword_prefilter, 'get_required_literal', fail_get_required_literal)
+    assert get_required_literals(entries) == ["fifabay", "baba", ""]
+
+
+def test_prefilter_stats_from_concurrent_scans():
+    matcher = KeywordPrefilterMatcher([r"fifabay", r"baba[\W_]*+ji", r"fifa|coins"],
+                                      get_bookended_keyword_regex_text_from_entries)
+
+    def scan():
+        for _ in range(500):
+            matcher.finditer("buy fifa coins from fifabay")
+
+    threads = [threading.Thread(target=scan) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert matcher.get_stats()['texts'] == 4000
+    assert matcher.get_stats()['candidates'] == 4000
@@ -1,7 +1,13 @@
 # coding=utf-8
 # noinspection PyUnresolvedReferences
+import random
+import time
+
 import phone_numbers
+import number_homoglyphs
 import pytest
+from helpers import log
+from post_corpus import RUN_BENCHMARKS, get_post_texts
 
 
 @pytest.mark.parametrize("text, expected_unprocessed, expected_normalized, expected_deobfuscated", [
@@ -35,3 +41,166 @@ def test_process_numlist(numlist, processed_in, normalized_in, expected_full_lis
     assert full_list == expected_full_list
     assert processed == expected_processed
     assert normalized == expected_normalized
+
+
+def get_candidates_by_character(text, also_normalized=False):
+    """
+    The previous, character by character, implementation of phone_numbers.get_candidates(), which is used to
+    check that the current implementation returns the same candidates and to compare their speed.
+    """
+    # The differences between this implementation and the original get_candidates(), which was based on a
+    # regex implementation, are:
+    #   1. This doesn't have the same potential for catistrophic CPU usage based on input text.
+    #   2. When the first character in the candidate is not a digit, this returns only one candidate.
+    #      For example "+(123..." will return ["+(123..."]. The regex version returns two candidates, but not
+    #      the version without the non-digit start characters (i.e. it returns ["+(123...", "(123..."]).
+    #      The characters other than digits which are valid at the start are in phone_numbers.VALID_NON_DIGIT_START_CHARACTERS.
+    #      The intent at that time was to generate more verbatim matches, but it's better to just have the one
+    #      result. In the meantime, normalized matching has been improved and more emphasis placed on it.
+    #   3. The regex version routinely returned duplicate entries. This implementation only returns duplicate
+    #      entries if there are duplicates in the input text.
+    candidates = []
+    candidates_normalized = []
+    in_process_normalized = []
+    in_process = []
+    in_process_digit_counts = []
+    non_digits = ''
+    prev_non_digit = ''
+    prev_prev_non_digit = ''
+    digits = ''
+    # alpha_count is, primarily, the number of alpha characters encountered since the last digit. However, it's
+    # also used as a flag, by setting alpha_count = max_alpha + 1, to indicate that some other criteria has
+    # been reached which should cause the same behavior.
+    # Specifically, it's used for when len_digits > phone_numbers.NUMBER_REGEX_MAXIMUM_DIGITS or when
+    # len(non_digits) > max_non_digits.
+    alpha_count = 0
+    max_alpha = 1
+    # max_non_digits is moderately high, but is intended to account for potential zalgo text, and/or
+    # combining characters, which would leave the number still readable by humans.
+    max_non_digits = 50
+
+    def promote_any_in_process_with_appropriate_digit_count():
+        for index in range(len(in_process)):
+            cur_count = in_process_digit_counts[index]
+            if cur_count >= phone_numbers.NUMBER_REGEX_MINIMUM_DIGITS and cur_count <= phone_numbers.NUMBER_REGEX_MAXIMUM_DIGITS:
+                candidates.append(in_process[index])
+                if in_process_normalized[index][0] != 'z':
+                    # The 'z' at the start is used as a flag that this isn't a valid normalized entry.
+                    candidates_normalized.append(in_process_normalized[index])
+
+    def evict_any_in_process_with_too_many_digits():
+        for index in reversed(range(len(in_process))):
+            if in_process_digit_counts[index] > phone_numbers.NUMBER_REGEX_MAXIMUM_DIGITS:
+                del in_process[index]
+                del in_process_normalized[index]
+                del in_process_digit_counts[index]
+
+    def clear_in_process_if_more_than_limit_alpha():
+        nonlocal in_process
+        nonlocal in_process_normalized
+        nonlocal in_process_digit_counts
+        if in_process and alpha_count > max_alpha:
+            # No sequences continue passed limit alpha characters
+            in_process_normalized = []
+            in_process = []
+            in_process_digit_counts = []
+
+    def if_digits_add_digits_to_all_in_process_and_promote():
+        nonlocal in_process
+        nonlocal in_process_normalized
+        nonlocal in_process_digit_counts
+        nonlocal digits
+        nonlocal alpha_count
+        nonlocal prev_non_digit
+        nonlocal prev_prev_non_digit
+        if digits:
+            len_digits = len(digits)
+            if len_digits > phone_numbers.NUMBER_REGEX_MAXIMUM_DIGITS:
+                # Too many digits. No need to try adding them, nor remembering the next alpha chars
+                alpha_count = max_alpha + 1
+                clear_in_process_if_more_than_limit_alpha()
+            else:
+                in_process = [to_add + digits for to_add in in_process]
+                in_process_normalized = [to_add + digits for to_add in in_process_normalized]
+                in_process_digit_counts = [to_add + len_digits for to_add in in_process_digit_counts]
+                # The original regex was written so that if a sequence started with '+(123...', then
+                # both '+(123...' and '(123...' ended up as candidates.
+                if prev_non_digit in phone_numbers.VALID_NON_DIGIT_START_CHARACTERS:
+                    if prev_prev_non_digit in phone_numbers.VALID_NON_DIGIT_START_CHARACTERS:
+                        in_process.append(prev_prev_non_digit + prev_non_digit + digits)
+                    else:
+                        in_process.append(prev_non_digit + digits)
+                else:
+                    in_process.append(digits)
+                in_process_normalized.append(digits)
+                in_process_digit_counts.append(len_digits)
+                promote_any_in_process_with_appropriate_digit_count()
+                evict_any_in_process_with_too_many_digits()
+            digits = ''
+            prev_non_digit = ''
+            prev_prev_non_digit = ''
+
+    for char in text:
+        if char >= '0' and char <= '9':
+            # It's a digit
+            digits += char
+            alpha_count = 0
+            if non_digits:
+                in_process = [to_add + non_digits for to_add in in_process]
+                non_digits = ''
+        else:
+            # Not a digit
+            if_digits_add_digits_to_all_in_process_and_promote()
+            prev_prev_non_digit = prev_non_digit
+            prev_non_digit = char
+            if (char >= 'A' and char <= 'Z') or (char >= 'a' and char <= 'z'):
+                alpha_count += 1
+                clear_in_process_if_more_than_limit_alpha()
+            if alpha_count > max_alpha:
+                non_digits = ''
+            else:
+                non_digits += char
+                if len(non_digits) > max_non_digits:
+                    alpha_count = max_alpha + 1  # Secondary use is as a flag that all in_process should end.
+                    clear_in_process_if_more_than_limit_alpha()
+                    non_digits = ''
+    if_digits_add_digits_to_all_in_process_and_promote()
+    # We can look at returning the normalized in a bit
+    if also_normalized:
+        return candidates, candidates_normalized
+    return candidates
+
+
+def get_number_test_texts():
+    rand = random.Random(0)
+    characters = '0123456789' * 4 + '(+{[ -.)/' + 'abcXYZ' + '\u2160\u0663\uff2foOlI|' + '\u0301'
+    texts = [''.join(rand.choice(characters) for _ in range(rand.randint(0, 60))) for _ in range(5000)]
+    texts.extend([' ' * 49 + '1234' + ' ' * 50 + '5678901', '12' + 'x' * 60 + '345678901', '9' * 21 + '-1234567'])
+    return texts + [number_homoglyphs.normalize(text) for text in texts]
+
+
+def test_get_candidates_matches_character_by_character_implementation():
+    for text in get_number_test_texts():
+        assert phone_numbers.get_candidates(text, True) == get_candidates_by_character(text, True)
+
+
+def test_get_candidates_benchmark():
+    rand = random.Random(0)
+    table = '\n'.join(' | '.join(str(rand.randint(0, 10 ** rand.randint(1, 9))) for _ in range(8))
+                      for _ in range(2000))
+    prose = ' '.join(rand.choice(['call', 'us', 'at', '+1 (866) 978-6819', 'or', 'the', 'quick', 'brown', 'fox'])
+                     for _ in range(20000))
+    mixed = '\n'.join(get_number_test_texts())
+    posts = '\n'.join(get_post_texts())
+    for name, text in [('table', table), ('prose', prose), ('mixed', mixed), ('posts', posts)]:
+        start = time.perf_counter()
+        expected = get_candidates_by_character(text, True)
+        character_by_character_time = time.perf_counter() - start
+        start = time.perf_counter()
+        actual = phone_numbers.get_candidates(text, True)
+        current_time = time.perf_counter() - start
+        assert actual == expected
+        if RUN_BENCHMARKS:
+            log('info', 'get_candidates() on {} ({} characters): {:.3f}s; character by character: {:.3f}s'.format(
+                name, len(text), current_time, character_by_character_time))
+            assert current_time < character_by_character_time
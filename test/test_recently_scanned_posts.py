@@ -0,0 +1,104 @@
+# coding=utf-8
+import pickle
+import time
+
+import pytest
+
+import recently_scanned_posts as rsp
+from globalvars import GlobalVars
+
+
+def make_post(post_id, title='A title', body='A body', owner='A user', last_edit_date=1000, response_timestamp=None):
+    return {'site': 'stackoverflow.com', 'question_id': post_id, 'title': title, 'body_markdown': body,
+            'owner': {'display_name': owner}, 'last_edit_date': last_edit_date,
+            'response_timestamp': time.time() if response_timestamp is None else response_timestamp}
+
+
+@pytest.mark.parametrize("changes, is_unchanged, is_grace_edit", [
+    ({}, True, False),
+    ({'title': 'Another title'}, False, True),
+    ({'body': 'Another body'}, False, True),
+    ({'owner': 'Another user'}, False, True),
+    ({'body': 'Another body', 'last_edit_date': 2000}, False, False),
+])
+def test_compare_scanned_posts(monkeypatch, changes, is_unchanged, is_grace_edit):
+    monkeypatch.setattr(GlobalVars, 'recently_scanned_posts', {})
+    rsp.add_post(make_post(1), is_spam=False, reasons=[], why='')
+    compare_info = rsp.atomic_compare_update_and_get_spam_data(make_post(1, **changes))
+    assert compare_info['is_unchanged'] == is_unchanged
+    assert compare_info['is_older_or_unchanged'] == is_unchanged
+    assert compare_info['is_grace_edit'] == is_grace_edit
+    assert compare_info['is_spam'] is False
+
+
+def set_scan_timestamps(scan_timestamps):
+    for key, scan_timestamp in scan_timestamps.items():
+        shard = rsp.get_shard(key)
+        shard.posts[key].scan_timestamp = scan_timestamp
+        shard.update_expiry(key, shard.posts[key])
+
+
+def get_stored_keys():
+    return sorted(key for shard in GlobalVars.recently_scanned_posts.values() for key in shard.posts)
+
+
+def test_recently_scanned_posts_expire(monkeypatch):
+    monkeypatch.setattr(GlobalVars, 'recently_scanned_posts', {})
+    now = time.time()
+    for post_id in range(1, 6):
+        rs_post = make_post(post_id)
+        rs_post['site'] = 'askubuntu.com' if post_id % 2 else 'stackoverflow.com'
+        rsp.add_post(rs_post, is_spam=False)
+    retention_time = GlobalVars.recently_scanned_posts_retention_time
+    set_scan_timestamps({
+        'askubuntu.com/1': now - retention_time - 10,
+        'stackoverflow.com/2': now - retention_time - 20,
+        'askubuntu.com/3': now - retention_time - 30,
+        'stackoverflow.com/4': now - 100,
+        'askubuntu.com/5': now - 200,
+    })
+    # A later scan makes the earlier index entry stale.
+    set_scan_timestamps({'askubuntu.com/3': now - 50})
+    rsp.expire_posts()
+    assert get_stored_keys() == ['askubuntu.com/3', 'askubuntu.com/5', 'stackoverflow.com/4']
+
+
+def test_recently_scanned_posts_maximum_entries(monkeypatch):
+    monkeypatch.setattr(GlobalVars, 'recently_scanned_posts', {})
+    monkeypatch.setattr(GlobalVars, 'recently_scanned_posts_maximum_entries', 3)
+
+    def add_post(key):
+        site, _, post_id = key.partition('/')
+        rs_post = make_post(int(post_id))
+        rs_post['site'] = site
+        rsp.add_post(rs_post, is_spam=False)
+
+    for key in ['askubuntu.com/1', 'stackoverflow.com/2', 'askubuntu.com/3']:
+        add_post(key)
+    # Adding a post evicts the oldest post for the same site.
+    set_scan_timestamps({'askubuntu.com/3': 100})
+    add_post('askubuntu.com/4')
+    assert get_stored_keys() == ['askubuntu.com/1', 'askubuntu.com/4', 'stackoverflow.com/2']
+    # A site keeps its newest post, even when other sites have older posts.
+    monkeypatch.setattr(GlobalVars, 'recently_scanned_posts_maximum_entries', 1)
+    add_post('superuser.com/5')
+    assert get_stored_keys() == ['askubuntu.com/1', 'askubuntu.com/4', 'stackoverflow.com/2', 'superuser.com/5']
+    add_post('askubuntu.com/6')
+    assert get_stored_keys() == ['askubuntu.com/6', 'stackoverflow.com/2', 'superuser.com/5']
+
+
+def test_recently_scanned_posts_from_pickle(monkeypatch):
+    monkeypatch.setattr(GlobalVars, 'recently_scanned_posts', {})
+    post = make_post(1, response_timestamp=100)
+    rsp.add_post(post, is_spam=True, reasons=['a reason'], why='why')
+    stored = pickle.loads(pickle.dumps(GlobalVars.recently_scanned_posts))
+    # The format stored by older versions
+    old_rs_post = {key: post[key] for key in ['response_timestamp', 'last_edit_date', 'title', 'body_markdown']}
+    old_rs_post.update({'is_recently_scanned_post': True, 'owner_name': 'A user', 'post_key': 'stackoverflow.com/1'})
+    old_stored = {'stackoverflow.com/1': {'post': old_rs_post, 'scan_timestamp': 200, 'is_spam': True,
+                                          'reasons': ['a reason'], 'why': 'why', 'scan_time': 1}}
+    for loaded in [stored, old_stored]:
+        monkeypatch.setattr(GlobalVars, 'recently_scanned_posts', rsp.get_recently_scanned_posts_from_pickle(loaded))
+        compare_info = rsp.atomic_compare_update_and_get_spam_data(make_post(1, response_timestamp=300))
+        assert compare_info['is_unchanged']
+        assert compare_info['reasons'] == ['a reason']
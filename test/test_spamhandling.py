@@ -1,5 +1,10 @@
 # coding=utf-8
-from spamhandling import check_if_spam, check_if_spam_json, handle_spam
+import threading
+
+import spamhandling
+import datahandling
+import metasmoke
+from spamhandling import check_if_spam, check_if_spam_json, handle_spam, handle_spam_unless_community_bumped
 from datahandling import add_blacklisted_user, add_whitelisted_user, remove_pickle
 from blacklists import load_blacklists
 from parsing import get_user_from_url
@@ -243,3 +248,39 @@ def test_whitelisted_user():
     assert is_spam is False
     # cleanup
     remove_pickle("whitelistedUsers.p")
+
+
+@pytest.mark.parametrize("ms_body, is_reported", [
+    ('<p>Buy baba ji now</p>', False),
+    ('<p>Another version</p>', True),
+])
+def test_community_bump_check_is_deferred(monkeypatch, ms_body, is_reported):
+    lookup_can_finish = threading.Event()
+    lookups = []
+
+    def get_post_bodies_from_ms(post_url):
+        lookups.append(post_url)
+        lookup_can_finish.wait(10)
+        return [{'id': 1, 'body': ms_body}]
+
+    reported = threading.Event()
+    monkeypatch.setattr(datahandling, 'community_bump_cache', {})
+    monkeypatch.setattr(metasmoke.Metasmoke, 'get_post_bodies_from_ms', get_post_bodies_from_ms)
+    monkeypatch.setattr(spamhandling, 'handle_spam', lambda post, reasons, why: reported.set())
+    post = Post(api_response={'title': 'baba ji', 'body': '<p>Buy baba ji now</p>',
+                              'owner': {'display_name': 'a user', 'reputation': 1,
+                                        'link': 'https://stackoverflow.com/users/4/a-user'},
+                              'site': 'stackoverflow.com', 'question_id': '4', 'IsAnswer': False, 'score': 0})
+    # The scan doesn't wait for metasmoke
+    is_spam, reasons, why = check_if_spam(post, defer_community_bump_check=True)
+    assert is_spam is True
+    handle_spam_unless_community_bumped(post, reasons, why)
+    assert not reported.is_set()
+
+    lookup_can_finish.set()
+    assert reported.wait(5 if is_reported else 1) == is_reported
+    # The metasmoke result is cached
+    is_spam, _, ignore_info = check_if_spam(post)
+    assert is_spam is is_reported
+    assert (ignore_info == 'post is bumped by Community \u2666\uFE0F') is not is_reported
+    assert len(lookups) == 1